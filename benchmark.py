@@ -0,0 +1,333 @@
+"""
+Benchmark de ponta a ponta do redirecionamento (Linux).
+
+Executa o servidor e os clientes reais (server.run_server / client.run_client)
+sobre pares de pseudo-terminais (pty) no lugar das portas seriais: o benchmark
+escreve jobs ZPL sintéticos na "serial" de cada cliente e lê o que o servidor
+escreve na sua, medindo vazão, latência por job e CPU por MB.
+
+Exemplos:
+    python benchmark.py
+    python benchmark.py --workload labels graphics --clients 1 4 --mode session legacy
+    python benchmark.py --engine threads asyncio --json resultados.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+# Cargas sintéticas: (quantidade de jobs por cliente, tamanho aproximado de cada job, tipo de conteúdo).
+WORKLOADS = {
+    'labels': {"jobs": 2000, "job_size": 120, "content": "text"},
+    'receipts': {"jobs": 400, "job_size": 2 * 1024, "content": "text"},
+    'graphics': {"jobs": 16, "job_size": 256 * 1024, "content": "graphics"},
+}
+
+JOB_ID_PATTERN = re.compile(rb"\^FDBENCH-(\d+)-(\d+)\^FS")
+JOB_END = b"^XZ"
+
+
+def make_zpl_job(client_index, job_index, job_size, content="text"):
+    """
+    Monta um job ZPL sintético com cerca de job_size bytes.
+
+    O identificador BENCH-<cliente>-<job> permite casar a saída do servidor com
+    o momento em que o job foi escrito na serial do cliente.
+    """
+    header = b"^XA^FO50,50^ADN,36,20^FDBENCH-%d-%d^FS" % (client_index, job_index)
+    body = bytearray()
+    if content == "graphics":
+        rng = random.Random(job_index)
+        row_bytes = 100
+        rows = max(1, (job_size - len(header)) // (row_bytes * 2))
+        body += b"^FO0,100^GFA,%d,%d,%d," % (rows * row_bytes, rows * row_bytes, row_bytes)
+        pattern = bytes(rng.choice((0x00, 0x0F, 0xF0, 0xFF)) for _ in range(row_bytes))
+        for row in range(rows):
+            body += pattern[row % row_bytes:].hex().upper().encode() + pattern[:row % row_bytes].hex().upper().encode()
+    else:
+        line = 0
+        while len(header) + len(body) + len(JOB_END) < job_size:
+            body += b"^FO50,%d^A0N,24,24^FDItem %04d - Quantidade %d^FS" % (100 + line * 30, line, line % 7 + 1)
+            line += 1
+    return header + bytes(body) + JOB_END
+
+def open_pty_pair():
+    """Cria um par de pseudo-terminais em modo raw. Retorna (fd do mestre, caminho do escravo)."""
+    import tty
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(master_fd)
+    tty.setraw(slave_fd)
+    return master_fd, os.ttyname(slave_fd)
+
+def _free_tcp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def _client_process(client_config, work_dir, stop_event):
+    """Processo de um cliente: executa client.run_client até o benchmark terminar."""
+    os.chdir(work_dir)
+    import client
+    if not client.run_client(client_config):
+        return
+    stop_event.wait()
+    client.stop_client()
+
+def _feed_client(master_fd, jobs, send_times, rate):
+    """Escreve os jobs na serial de um cliente, registrando o instante de cada um."""
+    interval = 1.0 / rate if rate else 0.0
+    next_send = time.perf_counter()
+    for job_id, job in jobs:
+        if interval:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+        send_times[job_id] = time.perf_counter()
+        view = memoryview(job)
+        while view:
+            written = os.write(master_fd, view)
+            view = view[written:]
+
+def _collect_output(master_fd, expected_jobs, receive_times, deadline):
+    """
+    Lê a serial do servidor, separa os jobs pelo '^XZ' e registra quando cada um chegou.
+
+    Returns:
+        tuple: (bytes recebidos, jobs cujo conteúdo não foi reconhecido)
+    """
+    pending = bytearray()
+    received_bytes = 0
+    corrupted = 0
+    while len(receive_times) + corrupted < expected_jobs and time.perf_counter() < deadline:
+        ready, _, _ = select.select([master_fd], [], [], 0.2)
+        if not ready:
+            continue
+        data = os.read(master_fd, 1024 * 1024)
+        now = time.perf_counter()
+        received_bytes += len(data)
+        pending += data
+        search_from = max(0, len(pending) - len(data) - len(JOB_END))
+        end = pending.find(JOB_END, search_from)
+        while end >= 0:
+            job = bytes(pending[:end + len(JOB_END)])
+            del pending[:end + len(JOB_END)]
+            match = JOB_ID_PATTERN.search(job)
+            if match:
+                receive_times[(int(match.group(1)), int(match.group(2)))] = now
+            else:
+                corrupted += 1
+            end = pending.find(JOB_END)
+    return received_bytes, corrupted
+
+def _run_case(case, work_dir, results_queue):
+    """Executa um caso do benchmark (em um processo próprio) e publica o resultado na fila."""
+    os.chdir(work_dir)
+    import server
+
+    workload = WORKLOADS[case["workload"]]
+    log_level = case["log_level"]
+    port = _free_tcp_port()
+    server_master, server_path = open_pty_pair()
+    server_config = {
+        'listen_ip': '127.0.0.1', 'listen_port': port, 'max_clients': case["clients"] + 1,
+        'serial_port': server_path, 'baud_rate': 115200, 'buffer_size': 1024, 'log_level': log_level,
+        'rsa_key_size': 2048, 'server_engine': case["engine"], 'spool_dir': os.path.join(work_dir, "spool"),
+    }
+    server_config.update(case["server_options"])
+
+    # Os clientes são criados antes de o servidor iniciar suas threads, para que
+    # o fork não aconteça com threads em andamento; eles reconectam sozinhos.
+    context = multiprocessing.get_context("fork")
+    stop_event = context.Event()
+    clients = []
+    for client_index in range(case["clients"]):
+        client_master, client_path = open_pty_pair()
+        client_config = {
+            'server_ip': '127.0.0.1', 'server_port': port, 'retry_interval': 0.5,
+            'serial_port': client_path, 'baud_rate': 115200, 'buffer_size': 1024, 'log_level': log_level,
+            'rsa_key_size': 2048, 'session_encryption': case["mode"] == "session",
+            'spool_dir': os.path.join(work_dir, f"client-{client_index}", "spool"),
+        }
+        client_config.update(case["client_options"])
+        client_dir = os.path.join(work_dir, f"client-{client_index}")
+        os.makedirs(client_dir, exist_ok=True)
+        process = context.Process(target=_client_process, args=(client_config, client_dir, stop_event))
+        process.start()
+        jobs = [((client_index, job_index), make_zpl_job(client_index, job_index, workload["job_size"], workload["content"]))
+                for job_index in range(workload["jobs"])]
+        clients.append({"process": process, "master": client_master, "jobs": jobs})
+
+    if not server.run_server(server_config):
+        stop_event.set()
+        results_queue.put({"error": "falha ao iniciar o servidor"})
+        return
+
+    connect_deadline = time.time() + 30
+    while time.time() < connect_deadline:
+        ready = [info for info in list(server.server_state["clients"].values()) if info.get("public_key")]
+        if len(ready) >= case["clients"]:
+            break
+        time.sleep(0.05)
+    time.sleep(case["warmup"])
+
+    total_jobs = sum(len(info["jobs"]) for info in clients)
+    total_bytes = sum(len(job) for info in clients for _, job in info["jobs"])
+    send_times = {}
+    receive_times = {}
+    times_before = os.times()
+    start = time.perf_counter()
+    feeders = [threading.Thread(target=_feed_client, args=(info["master"], info["jobs"], send_times, case["rate"]), daemon=True)
+               for info in clients]
+    for feeder in feeders:
+        feeder.start()
+    received_bytes, corrupted = _collect_output(server_master, total_jobs, receive_times, start + case["timeout"])
+    elapsed = time.perf_counter() - start
+
+    stop_event.set()
+    for info in clients:
+        info["process"].join(timeout=15)
+        if info["process"].is_alive():
+            info["process"].terminate()
+    server.stop_server()
+    times_after = os.times()
+
+    cpu_seconds = ((times_after.user - times_before.user) + (times_after.system - times_before.system)
+                   + (times_after.children_user - times_before.children_user)
+                   + (times_after.children_system - times_before.children_system))
+    latencies = [receive_times[job_id] - send_times[job_id] for job_id in receive_times if job_id in send_times]
+    megabytes = total_bytes / (1024 * 1024)
+    results_queue.put({
+        "jobs": total_jobs,
+        "jobs_delivered": len(receive_times),
+        "jobs_corrupted": corrupted,
+        "bytes": total_bytes,
+        "bytes_received": received_bytes,
+        "seconds": elapsed,
+        "throughput_bytes_s": received_bytes / elapsed if elapsed else 0.0,
+        "latency_p50_ms": _percentile(latencies, 0.50) * 1000 if latencies else None,
+        "latency_p99_ms": _percentile(latencies, 0.99) * 1000 if latencies else None,
+        "cpu_seconds": cpu_seconds,
+        "cpu_s_per_mb": cpu_seconds / megabytes if megabytes else None,
+    })
+
+def run_benchmark(workload, clients=1, mode="session", engine="threads", rate=0.0, timeout=120.0,
+                  warmup=0.5, log_level="WARNING", client_options=None, server_options=None):
+    """
+    Executa um caso do benchmark em um processo isolado.
+
+    Args:
+        workload (str): Nome da carga (ver WORKLOADS).
+        clients (int): Quantidade de clientes simultâneos, cada um em seu processo.
+        mode (str): 'session' (AES-GCM) ou 'legacy' (RSA por chunk).
+        engine (str): Motor do servidor ('threads' ou 'asyncio').
+        rate (float): Jobs por segundo por cliente; 0 escreve o mais rápido possível.
+        timeout (float): Tempo máximo de espera pela entrega de todos os jobs.
+        client_options / server_options (dict): Opções extras de configuração.
+
+    Returns:
+        dict: Métricas do caso (vazão, latências p50/p99, CPU por MB...), ou {"error": ...}.
+    """
+    case = {
+        "workload": workload, "clients": clients, "mode": mode, "engine": engine, "rate": rate,
+        "timeout": timeout, "warmup": warmup, "log_level": log_level,
+        "client_options": client_options or {}, "server_options": server_options or {},
+    }
+    work_dir = tempfile.mkdtemp(prefix="npr-bench-")
+    context = multiprocessing.get_context("fork")
+    results_queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, work_dir, results_queue))
+    process.start()
+    try:
+        result = results_queue.get(timeout=timeout + 60)
+    except Exception:
+        result = {"error": "caso não terminou a tempo"}
+    process.join(timeout=10)
+    if process.is_alive():
+        process.terminate()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    result.update({key: case[key] for key in ("workload", "clients", "mode", "engine", "rate")})
+    return result
+
+def _format_result(result):
+    if "error" in result:
+        return f"{result['workload']:<9} {result['mode']:<8} {result['engine']:<8} {result['clients']:>3}  ERRO: {result['error']}"
+    p50 = f"{result['latency_p50_ms']:.1f}" if result["latency_p50_ms"] is not None else "-"
+    p99 = f"{result['latency_p99_ms']:.1f}" if result["latency_p99_ms"] is not None else "-"
+    return (f"{result['workload']:<9} {result['mode']:<8} {result['engine']:<8} {result['clients']:>3} "
+            f"{result['jobs_delivered']:>6}/{result['jobs']:<6} {result['throughput_bytes_s'] / (1024 * 1024):>8.2f} "
+            f"{p50:>9} {p99:>9} {result['cpu_s_per_mb'] or 0:>9.3f}"
+            + (f"  ({result['jobs_corrupted']} jobs corrompidos)" if result["jobs_corrupted"] else ""))
+
+def main(argv=None):
+    if not sys.platform.startswith("linux"):
+        print("O benchmark usa pseudo-terminais (pty) e só está disponível no Linux.")
+        return 1
+
+    parser = argparse.ArgumentParser(description="Benchmark de ponta a ponta do Network Print Redirector (Linux).")
+    parser.add_argument('--workload', nargs='+', choices=sorted(WORKLOADS), default=sorted(WORKLOADS), help='Cargas a executar.')
+    parser.add_argument('--clients', nargs='+', type=int, default=[1], help='Quantidades de clientes simultâneos.')
+    parser.add_argument('--mode', nargs='+', choices=['session', 'legacy'], default=['session'], help='Modos de criptografia.')
+    parser.add_argument('--engine', nargs='+', choices=['threads', 'asyncio'], default=['threads'], help='Motores do servidor.')
+    parser.add_argument('--rate', type=float, default=0.0, help='Jobs por segundo por cliente (0 = sem limite).')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Tempo máximo por caso, em segundos.')
+    parser.add_argument('--client-option', action='append', default=[], metavar='CHAVE=JSON', help='Opção extra do cliente (ex: ack_window=16).')
+    parser.add_argument('--server-option', action='append', default=[], metavar='CHAVE=JSON', help='Opção extra do servidor.')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    parser.add_argument('--json', metavar='ARQUIVO', help='Salva os resultados em JSON.')
+    args = parser.parse_args(argv)
+
+    def parse_options(options):
+        parsed = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            try:
+                parsed[key] = json.loads(value)
+            except ValueError:
+                parsed[key] = value
+        return parsed
+
+    client_options = parse_options(args.client_option)
+    server_options = parse_options(args.server_option)
+
+    print(f"{'carga':<9} {'modo':<8} {'motor':<8} {'cli':>3} {'jobs':>13} {'MB/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'CPU s/MB':>9}")
+    results = []
+    for workload in args.workload:
+        for mode in args.mode:
+            for engine in args.engine:
+                for clients in args.clients:
+                    result = run_benchmark(workload, clients=clients, mode=mode, engine=engine, rate=args.rate,
+                                           timeout=args.timeout, log_level=args.log_level,
+                                           client_options=client_options, server_options=server_options)
+                    results.append(result)
+                    print(_format_result(result), flush=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Resultados salvos em {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
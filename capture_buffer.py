@@ -0,0 +1,169 @@
+import collections
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CAPTURE_BUFFER_SIZE = 1024 * 1024
+OVERFLOW_POLICIES = ('block', 'drop_oldest')
+# Intervalo em que um produtor bloqueado verifica o pedido de encerramento.
+BLOCKED_POLL_INTERVAL = 0.5
+
+
+def create_capture_buffer(capacity=DEFAULT_CAPTURE_BUFFER_SIZE, overflow_policy='block'):
+    """
+    Cria o buffer circular entre as threads de leitura serial e a thread principal.
+
+    Os dados lidos de todas as portas são copiados uma única vez para um
+    bytearray de tamanho fixo; quem consome recebe memoryviews desse bytearray,
+    sem cópias. Cada leitura ocupa uma região contígua (quando não cabe no fim,
+    recomeça do início), com seu canal e instante de captura.
+
+    Args:
+        capacity (int): Tamanho do buffer em bytes; a memória usada não passa disso.
+        overflow_policy (str): Com o buffer cheio, 'block' faz quem escreve
+            esperar por espaço (os dados ficam na porta serial, segurados pelo
+            controle de fluxo) e 'drop_oldest' descarta as leituras mais antigas.
+    """
+    if overflow_policy not in OVERFLOW_POLICIES:
+        log.warning(f"Política de estouro de buffer desconhecida '{overflow_policy}'. Usando 'block'.")
+        overflow_policy = 'block'
+    lock = threading.Lock()
+    return {
+        "buffer": bytearray(capacity),
+        "capacity": capacity,
+        "overflow_policy": overflow_policy,
+        "lock": lock,
+        "changed": threading.Condition(lock),
+        # (canal, início, tamanho, instante da captura), da mais antiga para a mais nova.
+        "records": collections.deque(),
+        "write_pos": 0,
+        "used": 0,
+        # Leituras entregues por get_chunks e ainda não liberadas: não podem ser
+        # sobrescritas nem descartadas.
+        "reading": 0,
+        "woken": False,
+        "dropped_bytes": 0,
+    }
+
+def _reserve(capture_buffer, size):
+    """Retorna o início de uma região livre e contígua de size bytes, ou None se não há espaço."""
+    records = capture_buffer["records"]
+    if not records:
+        capture_buffer["write_pos"] = 0
+        return 0
+    write_pos = capture_buffer["write_pos"]
+    read_pos = records[0][1]
+    if write_pos > read_pos:
+        if write_pos + size <= capture_buffer["capacity"]:
+            return write_pos
+        if size < read_pos:
+            return 0
+        return None
+    if write_pos + size < read_pos:
+        return write_pos
+    return None
+
+def _drop_oldest(capture_buffer):
+    """
+    Descarta a leitura mais antiga que não está sendo consumida, se isso abre
+    espaço no ponto de escrita. Retorna False se não há uma leitura assim.
+    """
+    records = capture_buffer["records"]
+    reading = capture_buffer["reading"]
+    if len(records) <= reading:
+        return False
+    if reading:
+        # As leituras em consumo ficam. A seguinte só libera espaço contíguo ao
+        # ponto de escrita se for também a última; senão o espaço fica preso
+        # entre leituras e é preciso esperar release_chunks.
+        if len(records) > reading + 1:
+            return False
+        record = records.pop()
+    else:
+        record = records.popleft()
+    capture_buffer["dropped_bytes"] += record[2]
+    _recompute_used(capture_buffer)
+    return True
+
+def _recompute_used(capture_buffer):
+    records = capture_buffer["records"]
+    capture_buffer["used"] = sum(record[2] for record in records)
+    if records:
+        last = records[-1]
+        capture_buffer["write_pos"] = last[1] + last[2]
+
+def put_chunk(capture_buffer, channel_id, data, captured_at, stop_event=None):
+    """
+    Copia uma leitura da serial para o buffer.
+
+    Com a política 'block', espera por espaço enquanto stop_event não é
+    sinalizado. Leituras maiores que um quarto do buffer são divididas.
+
+    Returns:
+        int: Bytes descartados para abrir espaço (política 'drop_oldest'), ou
+             -1 se o encerramento foi pedido antes de haver espaço.
+    """
+    max_piece = max(1, capture_buffer["capacity"] // 4)
+    dropped = 0
+    data = memoryview(data)
+    for offset in range(0, len(data), max_piece):
+        piece = data[offset:offset + max_piece]
+        with capture_buffer["changed"]:
+            start = _reserve(capture_buffer, len(piece))
+            while start is None:
+                if capture_buffer["overflow_policy"] == 'drop_oldest':
+                    before = capture_buffer["dropped_bytes"]
+                    if _drop_oldest(capture_buffer):
+                        dropped += capture_buffer["dropped_bytes"] - before
+                        start = _reserve(capture_buffer, len(piece))
+                        continue
+                if stop_event is not None and stop_event.is_set():
+                    return -1
+                capture_buffer["changed"].wait(BLOCKED_POLL_INTERVAL)
+                start = _reserve(capture_buffer, len(piece))
+            capture_buffer["buffer"][start:start + len(piece)] = piece
+            capture_buffer["records"].append((channel_id, start, len(piece), captured_at))
+            capture_buffer["write_pos"] = start + len(piece)
+            capture_buffer["used"] += len(piece)
+            capture_buffer["changed"].notify_all()
+    return dropped
+
+def get_chunks(capture_buffer, timeout=None):
+    """
+    Retorna as leituras disponíveis, esperando até timeout segundos se não há nenhuma.
+
+    Returns:
+        list: (canal, memoryview, instante da captura) na ordem de chegada.
+              As memoryviews só são válidas até release_chunks; a lista vem
+              vazia se o tempo acabou ou wakeup foi chamada.
+    """
+    with capture_buffer["changed"]:
+        if not capture_buffer["records"] and not capture_buffer["woken"] and timeout:
+            capture_buffer["changed"].wait(timeout)
+        capture_buffer["woken"] = False
+        records = list(capture_buffer["records"])
+        capture_buffer["reading"] = len(records)
+    view = memoryview(capture_buffer["buffer"])
+    return [(channel_id, view[start:start + size], captured_at)
+            for channel_id, start, size, captured_at in records]
+
+def release_chunks(capture_buffer):
+    """Libera o espaço das leituras entregues pela última chamada a get_chunks."""
+    with capture_buffer["changed"]:
+        records = capture_buffer["records"]
+        for _ in range(capture_buffer["reading"]):
+            capture_buffer["used"] -= records.popleft()[2]
+        capture_buffer["reading"] = 0
+        capture_buffer["changed"].notify_all()
+
+def wakeup(capture_buffer):
+    """Faz a espera em get_chunks retornar imediatamente (por exemplo, ao conectar ao servidor)."""
+    with capture_buffer["changed"]:
+        capture_buffer["woken"] = True
+        capture_buffer["changed"].notify_all()
+
+def buffered_bytes(capture_buffer):
+    """Bytes capturados aguardando a thread principal."""
+    return capture_buffer["used"]
@@ -1,59 +1,389 @@
+import base64
 import time
 import threading
 import logging
 import socket
+import select
 import os
 import struct
+import collections
 
+import capture_buffer
 import config_manager
 import crypto_utils
+import job_segmenter
+import logging_utils
+import metrics
 import network_utils
+import protocol
 import serial_utils
+import spool
+import tracing
 
 log = logging.getLogger(__name__)
 
+metrics.describe("npr_client_connection_attempts_total", "counter", "Tentativas de conexão com o servidor.")
+metrics.describe("npr_client_connections_total", "counter", "Conexões estabelecidas com o servidor (a primeira e as reconexões).")
+metrics.describe("npr_client_handshake_seconds", "histogram", "Duração da troca de chaves e abertura de sessão, por tipo.")
+metrics.describe("npr_client_rtt_seconds", "gauge", "Último RTT medido pelo keep-alive.")
+metrics.describe("npr_client_bytes_captured_total", "counter", "Bytes lidos das portas seriais locais, por porta.")
+metrics.describe("npr_client_jobs_sent_total", "counter", "Jobs enviados ao servidor, por porta.")
+metrics.describe("npr_client_bytes_sent_total", "counter", "Bytes cifrados enviados ao servidor.")
+metrics.describe("npr_client_crypto_cpu_seconds_total", "counter", "Tempo de CPU gasto com criptografia (e compressão), por operação.")
+metrics.describe("npr_client_pending_jobs", "gauge", "Jobs aguardando envio.")
+metrics.describe("npr_client_inflight_jobs", "gauge", "Jobs enviados aguardando confirmação.")
+metrics.describe("npr_client_jobs_dropped_total", "counter", "Jobs descartados pelo cliente.")
+metrics.describe("npr_client_capture_buffer_bytes", "gauge", "Bytes lidos das portas seriais aguardando a thread principal.")
+metrics.describe("npr_client_pending_job_bytes", "gauge", "Bytes de jobs pendentes mantidos em memória (os demais ficam só no spool).")
+metrics.describe("npr_client_bytes_dropped_total", "counter", "Bytes capturados descartados por falta de espaço nos buffers, por porta.")
+
 
 client_state = {
-    "serial_port": None,
+    "channels": [],
     "server_connection": None,
     "stop_event": threading.Event(),
     "config": {},
     "client_private_key": None,
     "client_public_key": None,
+    "client_public_key_bytes": None,
+    "client_key_fingerprint": None,
+    "keys_ready": threading.Event(),
+    "reconnect_event": threading.Event(),
+    "startup_timer": None,
     "server_public_key": None,
+    "server_key_fingerprint": None,
+    "fingerprint_unsupported": False,
+    # True se a última troca de chaves usou impressões digitais e o servidor as
+    # entendeu (servidores legados encerram a conexão): ele suporta sessões.
+    "fingerprint_hello_accepted": False,
+    "session_ticket": None,
+    "server_pong": False,
+    "tcp_keepalive": False,
+    "ping_sent_at": None,
+    "rtt": None,
+    "session": None,
+    "session_acks": False,
+    "server_acked_seq": None,
+    # Incrementado a cada conexão fechada; a thread principal o compara com o
+    # valor visto para saber que os jobs sem confirmação devem ser reenviados,
+    # mesmo que a thread de conexão já tenha reconectado.
+    "connection_generation": 0,
+    # Protege connection_generation e a entrega de server_acked_seq entre a
+    # thread de conexão e a principal.
+    "connection_lock": threading.Lock(),
+    "server_channels": {0},
+    "frame_decoder": None,
+    "frame_sender": None,
+    "compressor": None,
+    "legacy_server": False,
+    # Sem saber se o servidor é legado (key_fingerprints desativado), o modo
+    # legado é usado até session_retry_at, após session_failures negociações
+    # sem resposta.
+    "session_failures": 0,
+    "session_retry_at": 0.0,
+    "capture_buffer": None,
     "main_thread": None,
+    "connector_thread": None,
     "log_file_path": None
 }
 
 
-def ensure_serial_open():
-    """Tenta abrir/reabrir a porta serial se necessário."""
-    if client_state["serial_port"] and client_state["serial_port"].is_open:
+def create_channel(channel_id, serial_port, baud_rate, queue_name=None, job_formats=job_segmenter.DEFAULT_JOB_FORMATS):
+    """
+    Cria o estado de um canal: uma porta serial local capturada pelo cliente.
+
+    Cada canal tem seu spool, seu fluxo de jobs (com sequências próprias), sua
+    fila no servidor e os formatos usados para delimitar seus jobs (ver
+    job_segmenter); todos compartilham a mesma conexão.
+    """
+    return {
+        "id": channel_id,
+        "port": serial_port,
+        "baud_rate": baud_rate,
+        "queue": queue_name,
+        "job_formats": job_formats,
+        "serial": None,
+        "spool": None,
+        "stream_id": None,
+        "next_seq": 1,
+        "segmenter": None,
+        "reader_thread": None,
+    }
+
+def load_channels(config):
+    """
+    Monta os canais a partir da configuração: a porta principal (canal 0) e as
+    portas adicionais da opção avançada "serial_ports".
+    """
+    job_formats = config.get('job_formats', job_segmenter.DEFAULT_JOB_FORMATS)
+    channels = [create_channel(0, config['serial_port'], config['baud_rate'], config.get('queue'), job_formats)]
+    known_ports = {config['serial_port']}
+    for extra_port in config.get('serial_ports') or []:
+        if not isinstance(extra_port, dict) or not extra_port.get('serial_port'):
+            log.error(f"Porta adicional inválida na configuração ({extra_port}). Ignorando.")
+            continue
+        if extra_port['serial_port'] in known_ports:
+            log.error(f"Porta {extra_port['serial_port']} configurada mais de uma vez. Ignorando.")
+            continue
+        if len(channels) > protocol.MAX_CHANNEL_ID:
+            log.error(f"Máximo de {protocol.MAX_CHANNEL_ID} portas adicionais atingido. Ignorando {extra_port['serial_port']}.")
+            continue
+        known_ports.add(extra_port['serial_port'])
+        channels.append(create_channel(len(channels), extra_port['serial_port'],
+                                       extra_port.get('baud_rate', config['baud_rate']), extra_port.get('queue'),
+                                       extra_port.get('job_formats', job_formats)))
+    return channels
+
+def ensure_serial_open(channel):
+    """Tenta abrir/reabrir a porta serial do canal se necessário."""
+    if channel["serial"] and channel["serial"].is_open:
         return True
 
     config = client_state["config"]
-    log.info(f"Tentando abrir porta serial {config['serial_port']}...")
-    client_state["serial_port"] = serial_utils.open_serial_port(
-        config['serial_port'],
-        config['baud_rate'],
-        timeout=0.1,
+    log.info(f"Tentando abrir porta serial {channel['port']}...")
+    channel["serial"] = serial_utils.open_serial_port(
+        channel['port'],
+        channel['baud_rate'],
+        timeout=config.get('serial_read_timeout', 0.5),
     )
-    if client_state["serial_port"]:
-        log.info(f"Porta serial {config['serial_port']} aberta.")
+    if channel["serial"]:
+        log.info(f"Porta serial {channel['port']} aberta.")
         return True
     else:
-        log.error(f"Falha ao abrir porta serial {config['serial_port']}. Tentará novamente mais tarde.")
+        log.error(f"Falha ao abrir porta serial {channel['port']}. Tentará novamente mais tarde.")
+        return False
+
+def build_session_hello_payload():
+    """Monta o hello (opções propostas) enviado ao abrir ou retomar uma sessão."""
+    config = client_state["config"]
+    main_channel = client_state["channels"][0]
+    hello = {"version": protocol.PROTOCOL_VERSION, "stream": main_channel["stream_id"]}
+    if config.get('compression', True):
+        hello["compression"] = [protocol.COMPRESSION_ZLIB]
+    if config.get('session_resumption', True):
+        hello["tickets"] = True
+    if main_channel["queue"]:
+        hello["queue"] = main_channel["queue"]
+    if len(client_state["channels"]) > 1:
+        hello["channels"] = {
+            str(channel["id"]): {"stream": channel["stream_id"], "queue": channel["queue"]}
+            for channel in client_state["channels"][1:]
+        }
+    return hello
+
+def apply_welcome(session, welcome):
+    """Aplica as opções aceitas pelo servidor na confirmação da sessão e guarda o ticket emitido."""
+    config = client_state["config"]
+    client_state["session_acks"] = bool(welcome.get("acks"))
+    client_state["server_channels"] = {0}
+    if client_state["session_acks"]:
+        acked_seqs = {0: welcome.get("acked_seq", 0)}
+        channels = welcome.get("channels")
+        for channel_key, channel_welcome in (channels.items() if isinstance(channels, dict) else ()):
+            if str(channel_key).isdigit() and isinstance(channel_welcome, dict):
+                client_state["server_channels"].add(int(channel_key))
+                acked_seqs[int(channel_key)] = channel_welcome.get("acked_seq", 0)
+        with client_state["connection_lock"]:
+            client_state["server_acked_seq"] = acked_seqs
+    if len(client_state["server_channels"]) < len(client_state["channels"]):
+        log.warning("Servidor não aceitou todas as portas adicionais. Os jobs delas ficarão no spool até uma conexão que as aceite.")
+    client_state["compressor"] = None
+    if welcome.get("compression") == protocol.COMPRESSION_ZLIB:
+        client_state["compressor"] = protocol.create_compressor(config.get('compression_level', protocol.DEFAULT_COMPRESSION_LEVEL))
+    client_state["server_pong"] = bool(welcome.get("pong"))
+    client_state["session_ticket"] = None
+    if welcome.get("ticket"):
+        try:
+            ticket = base64.b64decode(welcome["ticket"])
+            client_state["session_ticket"] = (ticket, crypto_utils.derive_resumption_secret(session))
+        except (TypeError, ValueError) as e:
+            log.warning(f"Ticket de sessão inválido recebido do servidor: {e}")
+    log.info(f"Sessão AES-GCM estabelecida (protocolo v{welcome.get('version')}, "
+             f"confirmações: {'sim' if client_state['session_acks'] else 'não'}, "
+             f"compressão: {'sim' if client_state['compressor'] else 'não'}).")
+    return session
+
+def negotiate_session(conn, server_pub_key):
+    """
+    Negocia uma chave de sessão AES-GCM usando a chave pública RSA do servidor.
+
+    Returns:
+        dict: Estado da sessão em caso de sucesso.
+        None: Se o servidor não respondeu a tempo (provável servidor legado).
+        False: Em caso de erro na negociação.
+    """
+    session_key = crypto_utils.generate_session_key()
+    session = crypto_utils.create_session(session_key, 'client')
+    encrypted_key = crypto_utils.encrypt_message(server_pub_key, session_key)
+    encrypted_hello = crypto_utils.session_encrypt(session, protocol.encode_control(build_session_hello_payload()))
+    if not encrypted_key or not encrypted_hello:
+        log.error("Falha ao preparar a mensagem de abertura de sessão.")
+        return False
+
+    if not network_utils.send_data(conn, protocol.build_session_hello(encrypted_key, encrypted_hello)):
+        log.error("Falha ao enviar a mensagem de abertura de sessão.")
+        return False
+
+    encrypted_welcome = network_utils.receive_data(conn, timeout=protocol.SESSION_NEGOTIATION_TIMEOUT)
+    if encrypted_welcome is None:
+        log.error("Servidor desconectou durante a negociação de sessão.")
+        return False
+    elif encrypted_welcome == b'':
+        return None
+
+    welcome_bytes = crypto_utils.session_decrypt(session, encrypted_welcome)
+    welcome = protocol.decode_control(welcome_bytes) if welcome_bytes else None
+    if not welcome:
+        log.error("Resposta inválida do servidor na negociação de sessão.")
+        return False
+    return apply_welcome(session, welcome)
+
+def resume_session(conn):
+    """
+    Retoma a sessão anterior apresentando o ticket emitido pelo servidor.
+
+    Dispensa a troca de chaves e o RSA: a confirmação chega em uma única ida e
+    volta, já com a última sequência entregue do fluxo.
+
+    Returns:
+        dict: Estado da sessão em caso de sucesso.
+        None: Se o servidor recusou o ticket (a troca de chaves segue na mesma conexão).
+        False: Em caso de erro (a conexão deve ser descartada).
+    """
+    ticket, secret = client_state["session_ticket"]
+    client_state["session_ticket"] = None
+    client_random = os.urandom(protocol.RESUME_RANDOM_SIZE)
+    session = crypto_utils.create_session(
+        crypto_utils.derive_key(secret, client_random, crypto_utils.RESUMED_SESSION_INFO), 'client')
+    encrypted_hello = crypto_utils.session_encrypt(session, protocol.encode_control(build_session_hello_payload()))
+    if not encrypted_hello:
+        log.error("Falha ao preparar a mensagem de retomada de sessão.")
+        return False
+
+    log.info("Retomando sessão a partir do ticket...")
+    if not network_utils.send_data(conn, protocol.build_resume_hello(ticket, client_random, encrypted_hello)):
+        log.error("Falha ao enviar a mensagem de retomada de sessão.")
         return False
 
+    encrypted_welcome = network_utils.receive_data(conn, timeout=protocol.SESSION_NEGOTIATION_TIMEOUT)
+    if encrypted_welcome is None or encrypted_welcome == b'':
+        log.warning("Servidor não respondeu à retomada de sessão.")
+        return False
+    if encrypted_welcome == protocol.TICKET_REJECTED_MAGIC:
+        log.info("Servidor recusou o ticket de sessão. Refazendo a troca de chaves.")
+        return None
+
+    welcome_bytes = crypto_utils.session_decrypt(session, encrypted_welcome)
+    welcome = protocol.decode_control(welcome_bytes) if welcome_bytes else None
+    if not welcome:
+        log.error("Resposta inválida do servidor na retomada de sessão.")
+        return False
+    return apply_welcome(session, welcome)
+
+def exchange_public_keys(conn):
+    """
+    Troca chaves públicas com o servidor recém-conectado.
+
+    Quando possível, apresenta apenas as impressões digitais das chaves; o PEM
+    completo só é enviado se o servidor não tiver a chave do cliente em cache.
+    Servidores sem suporte encerram a conexão ao receber as impressões
+    digitais, e as próximas conexões voltam a enviar o PEM, até que uma
+    sessão seja estabelecida (ver ensure_server_connection).
+
+    Returns:
+        Chave pública do servidor, ou None em caso de falha.
+    """
+    config = client_state["config"]
+    client_pub_key_bytes = client_state["client_public_key_bytes"]
+    use_fingerprints = config.get('key_fingerprints', True) and not client_state["fingerprint_unsupported"]
+    client_state["fingerprint_hello_accepted"] = False
+
+    if use_fingerprints:
+        first_message = protocol.build_fingerprint_hello(
+            client_state["client_key_fingerprint"], client_state["server_key_fingerprint"])
+    else:
+        first_message = client_pub_key_bytes
+    if not network_utils.send_data(conn, first_message):
+        log.error("Falha ao enviar chave pública do cliente para o servidor. Desconectando.")
+        return None
+
+    log.info("Chave pública do cliente enviada. Aguardando chave pública do servidor...")
+
+    if use_fingerprints and network_utils.peer_closed(conn, timeout=10.0):
+        # Só um encerramento normal, logo após o hello, indica um servidor sem
+        # suporte; erros de rede não mudam o formato das próximas conexões.
+        log.warning("Servidor encerrou a conexão na troca por impressão digital. Enviando a chave completa nas próximas conexões.")
+        client_state["fingerprint_unsupported"] = True
+        return None
+    server_pub_key_bytes = network_utils.receive_data(conn, timeout=10.0)
+    if use_fingerprints and server_pub_key_bytes == protocol.KEY_REQUEST_MAGIC:
+        log.info("Servidor solicitou a chave pública completa do cliente.")
+        if not network_utils.send_data(conn, client_pub_key_bytes):
+            log.error("Falha ao enviar chave pública do cliente para o servidor. Desconectando.")
+            return None
+        server_pub_key_bytes = network_utils.receive_data(conn, timeout=10.0)
+
+    if server_pub_key_bytes is None:
+        log.error("Servidor desconectou ou erro ao receber chave pública do servidor.")
+        return None
+    elif server_pub_key_bytes == b'':
+        log.error("Timeout ao esperar chave pública do servidor.")
+        return None
+
+    server_fingerprint = protocol.parse_fingerprint_reply(server_pub_key_bytes)
+    if server_fingerprint:
+        server_pub_key = crypto_utils.get_cached_public_key(server_fingerprint)
+        if not server_pub_key:
+            log.error("Servidor confirmou uma chave pública que não está no cache. Desconectando.")
+            client_state["server_key_fingerprint"] = None
+            return None
+    else:
+        server_pub_key, server_fingerprint = crypto_utils.load_public_key_cached(server_pub_key_bytes)
+        if not server_pub_key:
+            log.error("Falha ao carregar/validar chave pública recebida do servidor. Desconectando.")
+            return None
+
+    client_state["server_key_fingerprint"] = server_fingerprint
+    client_state["fingerprint_hello_accepted"] = use_fingerprints
+    return server_pub_key
+
+
+LEGACY_RETRY_INTERVAL = 60.0
+LEGACY_RETRY_MAX_INTERVAL = 3600.0
+
+
+def handle_session_timeout():
+    """
+    Decide o modo das próximas conexões quando o servidor não respondeu à negociação de sessão.
+
+    Um servidor que entendeu o hello por impressão digital suporta sessões: o
+    silêncio é tratado como falha passageira (sobrecarga, reinício) e a
+    próxima conexão tenta a sessão de novo. Um servidor que encerrou a conexão
+    ao receber as impressões digitais fala o protocolo legado, que passa a ser
+    usado. Sem essa informação (key_fingerprints desativado), o modo legado é
+    usado por LEGACY_RETRY_INTERVAL segundos, dobrando a cada nova falha.
+    """
+    client_state["session_failures"] += 1
+    if client_state["fingerprint_hello_accepted"]:
+        log.warning("Servidor não respondeu à negociação de sessão. Tentando novamente na próxima conexão.")
+    elif client_state["fingerprint_unsupported"]:
+        log.warning("Servidor não respondeu à negociação de sessão. Usando modo legado (RSA por chunk) nas próximas conexões.")
+        client_state["legacy_server"] = True
+    else:
+        retry_in = min(LEGACY_RETRY_MAX_INTERVAL, LEGACY_RETRY_INTERVAL * 2 ** min(client_state["session_failures"] - 1, 16))
+        client_state["session_retry_at"] = time.time() + retry_in
+        log.warning(f"Servidor não respondeu à negociação de sessão. Usando modo legado (RSA por chunk); "
+                    f"a sessão será tentada de novo em uma reconexão após {retry_in:.0f}s.")
+
 def ensure_server_connection():
-    """Tenta conectar/reconectar ao servidor se necessário e realiza troca de chaves."""
+    """
+    Conecta ao servidor (se ainda não há conexão) e realiza a troca de chaves.
+
+    Chamada pela server_connection_thread; a conexão é verificada pela thread
+    principal (keep-alive e falhas de envio), que a fecha ao detectar uma queda.
+    """
     if client_state["server_connection"]:
-        try:
-            pass
-            return True
-        except (OSError, ConnectionResetError) as e:
-            log.warning(f"Erro ao verificar conexão existente: {e}. Tentando reconectar.")
-            close_server_connection()
+        return True
 
     config = client_state["config"]
     log.info("Tentando conectar ao servidor...")
@@ -64,50 +394,136 @@ def ensure_server_connection():
         max_retries=1
     )
 
+    metrics.inc("npr_client_connection_attempts_total")
     if conn:
-        log.info("Conexão com servidor estabelecida. Iniciando troca de chaves...")
-        client_pub_key_bytes = crypto_utils.get_public_key_bytes(client_state["client_public_key"])
-        if not client_pub_key_bytes or not network_utils.send_data(conn, client_pub_key_bytes):
-            log.error("Falha ao enviar chave pública do cliente para o servidor. Desconectando.")
-            try:
-                conn.close()
-            except Exception: pass
-            return False
+        handshake_started = time.perf_counter()
+        handshake_kind = "resumed"
+        session = None
+        server_pub_key = None
+        if client_state["session_ticket"] and config.get('session_resumption', True):
+            session = resume_session(conn)
+            if session is False:
+                try:
+                    conn.close()
+                except Exception: pass
+                return False
+            if session:
+                server_pub_key = crypto_utils.get_cached_public_key(client_state["server_key_fingerprint"])
+                if not server_pub_key:
+                    log.error("Chave pública do servidor não está mais no cache. Refazendo a conexão.")
+                    try:
+                        conn.close()
+                    except Exception: pass
+                    return False
 
-        log.info("Chave pública do cliente enviada. Aguardando chave pública do servidor...")
+        if not session:
+            handshake_kind = "session"
+            log.info("Conexão com servidor estabelecida. Iniciando troca de chaves...")
+            server_pub_key = exchange_public_keys(conn)
+            if not server_pub_key:
+                try:
+                    conn.close()
+                except Exception: pass
+                return False
 
-        server_pub_key_bytes = network_utils.receive_data(conn, timeout=10.0)
-        if server_pub_key_bytes is None:
-            log.error("Servidor desconectou ou erro ao receber chave pública do servidor.")
-            try:
-                conn.close()
-            except Exception: pass
-            return False
-        elif server_pub_key_bytes == b'':
-            log.error("Timeout ao esperar chave pública do servidor.")
-            try:
-                conn.close()
-            except Exception: pass
-            return False
+            log.info("Chave pública do servidor recebida e carregada com sucesso.")
 
-        server_pub_key = crypto_utils.load_public_key_from_data(server_pub_key_bytes)
-        if not server_pub_key:
-            log.error("Falha ao carregar/validar chave pública recebida do servidor. Desconectando.")
-            try:
-                conn.close()
-            except Exception: pass
-            return False
+            if (config.get('session_encryption', True) and not client_state["legacy_server"]
+                    and time.time() >= client_state["session_retry_at"]):
+                session = negotiate_session(conn, server_pub_key)
+                if not session:
+                    if session is None:
+                        handle_session_timeout()
+                    try:
+                        conn.close()
+                    except Exception: pass
+                    return False
+            else:
+                handshake_kind = "legacy"
+                log.info("Usando modo legado (RSA por chunk) com o servidor.")
 
-        log.info("Chave pública do servidor recebida e carregada com sucesso.")
+        if session:
+            # O servidor pode ter sido atualizado desde a recusa das impressões digitais.
+            client_state["fingerprint_unsupported"] = False
+            client_state["session_failures"] = 0
+            client_state["session_retry_at"] = 0.0
+        keep_alive_interval = config.get('keep_alive_interval', protocol.DEFAULT_KEEP_ALIVE_INTERVAL)
+        client_state["tcp_keepalive"] = network_utils.enable_keepalive(conn, idle=keep_alive_interval, interval=keep_alive_interval)
         client_state["server_public_key"] = server_pub_key
+        client_state["session"] = session
+        client_state["frame_decoder"] = network_utils.create_frame_decoder()
+        client_state["frame_sender"] = network_utils.create_frame_sender(
+            conn, config.get('send_batch_bytes', network_utils.DEFAULT_SEND_BATCH_BYTES))
         client_state["server_connection"] = conn
+        metrics.inc("npr_client_connections_total")
+        metrics.observe("npr_client_handshake_seconds", time.perf_counter() - handshake_started, kind=handshake_kind)
+        if client_state["startup_timer"]:
+            log.info(f"Primeira conexão com o servidor {logging_utils.startup_elapsed(client_state['startup_timer']) * 1000:.0f}ms após o início do cliente.")
+            client_state["startup_timer"] = None
         return True
     else:
         log.warning("Falha ao conectar ao servidor nesta tentativa.")
         client_state["server_connection"] = None
         client_state["server_public_key"] = None
+        client_state["session"] = None
         return False
 
+def encrypt_for_server(message_bytes):
+    """Criptografa uma mensagem para o servidor usando a sessão AES-GCM ou, no modo legado, RSA."""
+    if client_state["session"]:
+        return crypto_utils.session_encrypt(client_state["session"], message_bytes)
+    return crypto_utils.encrypt_message(client_state["server_public_key"], message_bytes)
+
+def encrypt_job(job, seq=None, channel_id=0):
+    """
+    Divide um job em mensagens criptografadas para o servidor.
+
+    No modo de sessão cada mensagem é um registro de dados e a última é marcada
+    com fim de job; se a sessão tem confirmações, cada registro leva a sequência
+    do job (0 se ele não tem uma), precedida do canal quando não é o principal,
+    e com compressão negociada o conteúdo vai comprimido no fluxo da conexão.
+    No modo legado são chunks RSA, como antes.
+
+    Returns:
+        list: As mensagens criptografadas, na ordem de envio.
+        None: Se a criptografia falhou.
+    """
+    config = client_state["config"]
+    session = client_state["session"]
+    if session:
+        max_chunk_size = config.get('session_chunk_size', protocol.DEFAULT_SESSION_CHUNK_SIZE)
+    else:
+        max_chunk_size = protocol.LEGACY_CHUNK_SIZE
+
+    started = metrics.timed()
+    job_view = memoryview(job)
+    messages = []
+    offset = 0
+    while offset < len(job):
+        chunk = job_view[offset:offset + max_chunk_size]
+        offset += len(chunk)
+        if session:
+            flags = protocol.RECORD_FLAG_JOB_END if offset >= len(job) else 0
+            if client_state["compressor"]:
+                chunk = protocol.compress_payload(client_state["compressor"], chunk)
+                flags |= protocol.RECORD_FLAG_COMPRESSED
+            if client_state["session_acks"]:
+                chunk = protocol.pack_sequenced(seq or 0, chunk)
+            if channel_id:
+                chunk = protocol.pack_channel(channel_id, chunk)
+                flags |= protocol.RECORD_FLAG_CHANNEL
+            message = protocol.pack_record(protocol.RECORD_DATA, flags, chunk)
+        else:
+            message = bytes(chunk)
+
+        encrypted_message = encrypt_for_server(message)
+        if not encrypted_message:
+            return None
+        messages.append(encrypted_message)
+    metrics.add_cpu_time("npr_client_crypto_cpu_seconds_total", started,
+                         operation="session_encrypt" if session else "rsa_encrypt")
+    return messages
+
 def close_server_connection():
     """Fecha a conexão com o servidor."""
     conn = client_state.get("server_connection")
@@ -121,53 +537,360 @@ def close_server_connection():
         except OSError as e:
             log.warning(f"Erro ao fechar conexão com servidor: {e}")
         finally:
+            with client_state["connection_lock"]:
+                client_state["connection_generation"] += 1
             client_state["server_connection"] = None
             client_state["server_public_key"] = None
+            client_state["session"] = None
+            client_state["session_acks"] = False
+            client_state["server_pong"] = False
+            client_state["server_channels"] = {0}
+            client_state["ping_sent_at"] = None
+            client_state["frame_sender"] = None
+            client_state["compressor"] = None
+            client_state["reconnect_event"].set()
+
+def handle_server_record(message, acked_seqs):
+    """
+    Processa um registro recebido do servidor (confirmação ou resposta de keep-alive).
+
+    Returns:
+        bool: False se o servidor enviou dados inválidos.
+    """
+    plaintext = crypto_utils.session_decrypt(client_state["session"], message)
+    record = protocol.unpack_record(plaintext) if plaintext is not None else None
+    if record is None:
+        log.error("Mensagem inválida recebida do servidor.")
+        return False
+    record_type, flags, payload = record
+    if record_type == protocol.RECORD_ACK:
+        channel_id = 0
+        if flags & protocol.RECORD_FLAG_CHANNEL:
+            channel_part = protocol.unpack_channel(payload)
+            if channel_part is None:
+                return False
+            channel_id, payload = channel_part
+            if channel_id >= len(client_state["channels"]):
+                log.error(f"Confirmação do servidor para um canal desconhecido ({channel_id}).")
+                return False
+        sequenced = protocol.unpack_sequenced(payload)
+        if sequenced is None:
+            return False
+        acked_seqs[channel_id] = max(acked_seqs.get(channel_id, 0), sequenced[0])
+    elif record_type == protocol.RECORD_PONG and len(payload) == struct.calcsize(protocol.PING_TIMESTAMP_FORMAT):
+        sent_at = struct.unpack(protocol.PING_TIMESTAMP_FORMAT, payload)[0]
+        client_state["rtt"] = time.monotonic() - sent_at
+        client_state["ping_sent_at"] = None
+        metrics.set_gauge("npr_client_rtt_seconds", client_state["rtt"])
+        log.debug("Keep-alive respondido pelo servidor. RTT: %.1f ms.", client_state['rtt'] * 1000)
+    else:
+        log.debug("Registro do servidor ignorado (tipo %d).", record_type)
+    return True
 
+def receive_acks(conn, timeout):
+    """
+    Lê as confirmações (e respostas de keep-alive) que o servidor enviou,
+    aguardando até timeout pela primeira.
 
+    Só lê o que já chegou: um registro incompleto fica no decodificador de
+    frames da conexão até a próxima chamada.
+
+    Returns:
+        dict: A maior sequência confirmada recebida de cada canal (vazio se nenhuma).
+        None: Se a conexão foi perdida ou o servidor enviou dados inválidos.
+    """
+    acked_seqs = {}
+    ready_to_read, _, _ = select.select([conn], [], [], timeout)
+    while ready_to_read:
+        messages = network_utils.receive_frames(conn, client_state["frame_decoder"])
+        if messages is None:
+            log.warning("Servidor desconectou enquanto aguardava confirmações.")
+            return None
+        for message in messages:
+            if not handle_server_record(message, acked_seqs):
+                return None
+        ready_to_read, _, _ = select.select([conn], [], [], 0)
+    return acked_seqs
+
+
+
+def serial_reader_thread(channel):
+    """Thread que captura os dados da serial local de um canal assim que chegam e os coloca na fila de envio."""
+    log.info(f"Thread de leitura serial de {channel['port']} iniciada.")
+    config = client_state["config"]
+    serial_check_interval = 1.0
+    capture = client_state["capture_buffer"]
+    read_summary = logging_utils.create_summary(
+        log, "Porta serial %(port)s: %(count)d leituras (%(bytes)d bytes) nos últimos %(seconds).0fs.",
+        config.get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL), port=channel['port'])
+    drop_summary = logging_utils.create_summary(
+        log, "Porta serial %(port)s: buffer de captura cheio, %(bytes)d bytes mais antigos descartados nos últimos %(seconds).0fs.",
+        config.get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL), logging.WARNING, port=channel['port'])
+
+    while not client_state["stop_event"].is_set():
+        if not ensure_serial_open(channel):
+            client_state["stop_event"].wait(serial_check_interval)
+            continue
+
+        serial_data = serial_utils.read_available(
+            channel["serial"],
+            config.get('buffer_size', 1024)
+        )
+
+        if serial_data is None:
+            log.error(f"Erro grave lendo da porta serial {channel['port']}. Fechando porta.")
+            serial_utils.close_serial_port(channel["serial"])
+            channel["serial"] = None
+            client_state["stop_event"].wait(serial_check_interval)
+        elif serial_data:
+            log.debug("Lidos %d bytes da porta serial %s.", len(serial_data), channel['port'])
+            logging_utils.count_event(read_summary, len(serial_data))
+            metrics.inc("npr_client_bytes_captured_total", len(serial_data), port=channel['port'])
+            dropped = capture_buffer.put_chunk(capture, channel["id"], serial_data, time.time(), client_state["stop_event"])
+            if dropped > 0:
+                logging_utils.count_event(drop_summary, dropped)
+                metrics.inc("npr_client_bytes_dropped_total", dropped, port=channel['port'])
+
+    logging_utils.flush_summary(read_summary)
+    logging_utils.flush_summary(drop_summary)
+    serial_utils.close_serial_port(channel["serial"])
+    channel["serial"] = None
+    log.info(f"Thread de leitura serial de {channel['port']} finalizada.")
+
+ACK_POLL_INTERVAL = 0.05
+DEFAULT_BUFFER_HIGH_WATER = 16 * 1024 * 1024
+# Com a captura pausada (política 'block'), intervalo em que a thread principal
+# verifica se a memória dos jobs pendentes voltou ao limite.
+BLOCKED_INTAKE_POLL_INTERVAL = 0.1
+
+
+def store_job(channel, job, started_at=None):
+    """
+    Grava um job capturado no spool do canal (se ativo) e retorna a entrada da fila de envio.
+
+    O número de sequência do job é o do registro no spool; sem spool, vem de um
+    contador em memória. Um job que não pôde ser gravado fica sem sequência.
+    started_at é o instante em que chegou o primeiro byte do job, usado no
+    rastreamento das etapas (ver tracing).
+    """
+    job_spool = channel["spool"]
+    if job_spool:
+        seq = spool.spool_append(job_spool, job)
+    else:
+        seq = channel["next_seq"]
+        channel["next_seq"] += 1
+    trace = tracing.start_trace("client", started_at, port=channel["port"], seq=seq, bytes=len(job))
+    tracing.stamp(trace, "capture")
+    return {"seq": seq, "data": job, "channel": channel["id"], "trace": trace}
+
+def finish_job_trace(job, stage):
+    """Encerra o rastro de um job, atribuindo à etapa final o tempo desde a anterior."""
+    tracing.stamp(job["trace"], stage)
+    tracing.finish_trace(job["trace"])
+    job["trace"] = None
+
+def acknowledge_jobs(job_queue, channel_id, acked_seq):
+    """
+    Remove de job_queue os jobs do canal confirmados pelo servidor e os confirma no spool.
+
+    Returns:
+        list: Os jobs removidos.
+    """
+    remaining = []
+    confirmed = []
+    for job in job_queue:
+        if job["channel"] != channel_id or not job["seq"] or job["seq"] > acked_seq:
+            remaining.append(job)
+        else:
+            confirmed.append(job)
+    if confirmed:
+        job_queue.clear()
+        job_queue.extend(remaining)
+    channel = client_state["channels"][channel_id]
+    if channel["spool"] and acked_seq:
+        spool.spool_ack(channel["spool"], acked_seq)
+    return confirmed
+
+def job_memory(job):
+    """Bytes do job mantidos em memória (zero se ele está só no spool)."""
+    return len(job["data"]) if job["data"] is not None else 0
+
+def load_job_data(job):
+    """Retorna o conteúdo do job: o da memória ou, se ele ficou só no spool, relido do disco. None se não pôde ser lido."""
+    if job["data"] is not None:
+        return job["data"]
+    job_spool = client_state["channels"][job["channel"]]["spool"]
+    entry = spool.spool_find(job_spool, job["seq"]) if job_spool else None
+    if entry is None:
+        log.error(f"Job {job['seq']} não está mais no spool.")
+        return None
+    return spool.spool_read(job_spool, entry)
+
+def release_spooled_data(job):
+    """Tira da memória o conteúdo de um job gravado no spool (relido no envio). Retorna os bytes liberados."""
+    if job["data"] is None or not job["seq"] or not client_state["channels"][job["channel"]]["spool"]:
+        return 0
+    released = len(job["data"])
+    job["data"] = None
+    return released
+
+def reduce_pending_memory(job_queues, pending_bytes, high_water, overflow_policy, drop_summary):
+    """
+    Traz os bytes de jobs pendentes em memória de volta a high_water.
+
+    Primeiro, jobs gravados no spool deixam a memória, dos mais novos para os
+    mais antigos, e são relidos do disco no envio. Se isso não basta (portas
+    sem spool), com a política 'drop_oldest' os jobs mais antigos são
+    descartados (e contados em drop_summary); com 'block' ficam como estão e a
+    captura espera.
+
+    Args:
+        job_queues (list): As filas de jobs pendentes (deques), da que tem os
+            jobs mais antigos para a que tem os mais novos.
+
+    Returns:
+        int: Os bytes de jobs pendentes que continuam em memória.
+    """
+    channels = client_state["channels"]
+    for job_queue in reversed(job_queues):
+        for job in reversed(job_queue):
+            if pending_bytes <= high_water:
+                return pending_bytes
+            pending_bytes -= release_spooled_data(job)
+
+    if pending_bytes > high_water and overflow_policy == 'drop_oldest':
+        for job_queue in job_queues:
+            kept = collections.deque()
+            for job in job_queue:
+                if pending_bytes > high_water and job["data"] is not None:
+                    pending_bytes -= len(job["data"])
+                    logging_utils.count_event(drop_summary, len(job["data"]))
+                    metrics.inc("npr_client_jobs_dropped_total")
+                    metrics.inc("npr_client_bytes_dropped_total", len(job["data"]), port=channels[job["channel"]]["port"])
+                else:
+                    kept.append(job)
+            job_queue.clear()
+            job_queue.extend(kept)
+    return pending_bytes
 
 def listen_serial_and_send_thread():
-    """Thread principal que lê da serial local e envia dados criptografados para o servidor."""
+    """Thread principal que envia ao servidor, criptografados, os dados capturados da serial local."""
     log.info("Thread principal do cliente iniciada.")
     config = client_state["config"]
-    serial_check_interval = 1.0
-    connection_check_interval = config.get('retry_interval', 5.0)
-    keep_alive_interval = 5.0
+    keep_alive_interval = config.get('keep_alive_interval', protocol.DEFAULT_KEEP_ALIVE_INTERVAL)
     last_activity_time = time.time()
-    last_serial_check = 0
-    last_connection_check = 0
-    data_buffer = b""
+    was_connected = False
+    seen_generation = client_state["connection_generation"]
+    capture = client_state["capture_buffer"]
+    channels = client_state["channels"]
+    buffer_high_water = config.get('buffer_high_water', DEFAULT_BUFFER_HIGH_WATER)
+    overflow_policy = config.get('buffer_overflow_policy', 'block')
+    # Bytes dos jobs de pending_jobs e held_jobs mantidos em memória (ver reduce_pending_memory).
+    pending_bytes = 0
+    intake_blocked = False
+    intake_pause_logged = False
+    ack_window = max(1, config.get('ack_window', protocol.DEFAULT_ACK_WINDOW))
+    send_flush_interval = config.get('send_flush_interval', 0.0)
+    pending_jobs = collections.deque()
+    # Jobs enviados que aguardam confirmação do servidor (ou, sem confirmações,
+    # o envio do lote em que foram enfileirados), em ordem de sequência.
+    inflight_jobs = collections.deque()
+    # Jobs de portas adicionais que o servidor atual não aceitou; voltam para a
+    # fila na próxima conexão. Os gravados no spool ficam só no disco.
+    held_jobs = collections.deque()
+    # Jobs cujas mensagens foram enfileiradas mas ainda não saíram pelo socket.
+    unflushed_jobs = []
+    send_summary = logging_utils.create_summary(
+        log, "%(count)d jobs (%(bytes)d bytes) enviados ao servidor nos últimos %(seconds).0fs.",
+        config.get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL))
+    drop_summary = logging_utils.create_summary(
+        log, "%(count)d jobs pendentes (%(bytes)d bytes) descartados nos últimos %(seconds).0fs por exceder buffer_high_water.",
+        config.get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL), logging.WARNING)
+    for channel in channels:
+        if channel["spool"]:
+            for entry in spool.spool_pending(channel["spool"]):
+                if pending_bytes + entry["length"] > buffer_high_water:
+                    # O restante é lido do spool na hora do envio.
+                    pending_jobs.append({"seq": entry["seq"], "data": None, "channel": channel["id"], "trace": None})
+                    continue
+                data = spool.spool_read(channel["spool"], entry)
+                if data:
+                    pending_jobs.append({"seq": entry["seq"], "data": data, "channel": channel["id"], "trace": None})
+                    pending_bytes += len(data)
+        # Cada porta tem seu segmentador, para que jobs de portas diferentes não se misturem.
+        channel["segmenter"] = job_segmenter.create_segmenter(
+            formats=channel["job_formats"],
+            idle_gap=config.get('job_idle_gap', job_segmenter.DEFAULT_IDLE_GAP),
+            max_job_size=config.get('max_job_size', job_segmenter.DEFAULT_MAX_JOB_SIZE)
+        )
+    if pending_jobs:
+        log.info(f"{len(pending_jobs)} jobs pendentes do spool serão reenviados ao servidor.")
 
     while not client_state["stop_event"].is_set():
         now = time.time()
-        serial_ok = False
         connection_ok = False
 
-        if now - last_serial_check > serial_check_interval:
-            serial_ok = ensure_serial_open()
-            last_serial_check = now
-        else:
-            serial_ok = client_state["serial_port"] and client_state["serial_port"].is_open
+        with client_state["connection_lock"]:
+            generation = client_state["connection_generation"]
+            acked_seqs = client_state["server_acked_seq"]
+            client_state["server_acked_seq"] = None
+        if generation != seen_generation:
+            # Conexão perdida (mesmo que já refeita): jobs não confirmados (ou
+            # ainda no lote) voltam para o início da fila, antes dos novos.
+            seen_generation = generation
+            if inflight_jobs:
+                log.info(f"{len(inflight_jobs)} jobs sem confirmação serão retransmitidos.")
+            pending_jobs.extendleft(reversed(inflight_jobs))
+            pending_bytes += sum(job_memory(job) for job in inflight_jobs)
+            inflight_jobs.clear()
+            pending_jobs.extendleft(reversed(held_jobs))
+            held_jobs.clear()
+            unflushed_jobs.clear()
 
-        if now - last_connection_check > connection_check_interval:
-             connection_ok = ensure_server_connection()
-             if connection_ok:
-                 last_activity_time = now
-             last_connection_check = now
-        else:
-             connection_ok = client_state["server_connection"] is not None
+        # A conexão é feita pela server_connection_thread; aqui ela só é usada.
+        connection_ok = client_state["server_connection"] is not None
+        if connection_ok and not was_connected:
+            last_activity_time = now
+        was_connected = connection_ok
+
+        if acked_seqs is not None:
+            before = len(pending_jobs)
+            for channel_id, acked_seq in acked_seqs.items():
+                if channel_id < len(channels):
+                    for acked_job in acknowledge_jobs(pending_jobs, channel_id, acked_seq):
+                        pending_bytes -= job_memory(acked_job)
+            if before != len(pending_jobs):
+                log.info(f"{before - len(pending_jobs)} jobs já haviam sido entregues pelo servidor.")
 
-        if connection_ok and (now - last_activity_time > keep_alive_interval):
-            log.debug(f"Sem atividade por >{keep_alive_interval}s. Enviando keep-alive ping...")
+        if connection_ok and client_state["ping_sent_at"] is not None and now - client_state["ping_sent_at"] > keep_alive_interval:
+            log.warning(f"Servidor não respondeu ao keep-alive em {keep_alive_interval}s. Fechando conexão e acionando reconexão.")
+            close_server_connection()
+            connection_ok = False
+        elif connection_ok and (now - last_activity_time > keep_alive_interval):
             ping_success = False
             try:
-                ping_message = b'\x00\x00\x00\x00'
-                if client_state["server_public_key"]:
-                    encrypted_ping = crypto_utils.encrypt_message(client_state["server_public_key"], ping_message)
+                if not client_state["session"] and client_state["tcp_keepalive"]:
+                    # No modo legado cada ping custaria uma operação RSA em cada
+                    # lado; a conexão é vigiada pelo TCP keepalive.
+                    last_activity_time = now
+                    ping_success = True
+                elif client_state["server_public_key"]:
+                    log.debug(f"Sem atividade por >{keep_alive_interval}s. Enviando keep-alive ping...")
+                    if client_state["session"]:
+                        ping_payload = b''
+                        if client_state["server_pong"]:
+                            ping_payload = struct.pack(protocol.PING_TIMESTAMP_FORMAT, time.monotonic())
+                        ping_message = protocol.pack_record(protocol.RECORD_PING, 0, ping_payload)
+                    else:
+                        ping_message = protocol.LEGACY_PING
+                    encrypted_ping = encrypt_for_server(ping_message)
                     if encrypted_ping:
-                        if network_utils.send_data(client_state["server_connection"], encrypted_ping):
+                        frame_sender = client_state["frame_sender"]
+                        if network_utils.queue_frame(frame_sender, encrypted_ping) and network_utils.flush_frames(frame_sender):
                             log.debug("Keep-alive ping enviado com sucesso.")
                             last_activity_time = now
+                            if client_state["session"] and client_state["server_pong"]:
+                                client_state["ping_sent_at"] = now
                             ping_success = True
                         else:
                             log.warning("Keep-alive ping send falhou (send_data retornou False). Conexão perdida.")
@@ -184,104 +907,262 @@ def listen_serial_and_send_thread():
                 log.warning("Keep-alive check falhou. Fechando conexão e acionando reconexão.")
                 close_server_connection()
                 connection_ok = False
-                last_connection_check = 0
 
-        if serial_ok and connection_ok:
-            try:
-                serial_data = serial_utils.read_from_serial(
-                    client_state["serial_port"],
-                    config.get('buffer_size', 1024)
-                )
-
-                if serial_data is None:
-                    log.error("Erro grave lendo da porta serial. Fechando porta.")
-                    serial_utils.close_serial_port(client_state["serial_port"])
-                    client_state["serial_port"] = None
-                    serial_ok = False
-                    last_serial_check = 0
-                    continue
-                elif serial_data == b'':
-                    pass
+        try:
+            now = time.time()
+            for channel in channels:
+                started_at = job_segmenter.job_started_at(channel["segmenter"])
+                job = job_segmenter.flush_idle(channel["segmenter"], now)
+                if job:
+                    pending_jobs.append(store_job(channel, job, started_at))
+                    pending_bytes += len(job)
+
+            acks_enabled = connection_ok and client_state["session_acks"]
+            window_open = not acks_enabled or len(inflight_jobs) < ack_window
+            if pending_jobs and connection_ok and window_open:
+                wait_time = 0.0
+            elif connection_ok:
+                wait_time = max(0.0, keep_alive_interval - (now - last_activity_time))
+            else:
+                # Sem conexão, a thread de conexão acorda esta (ver
+                # capture_buffer.wakeup) assim que se conectar.
+                wait_time = 1.0
+            for channel in channels:
+                idle_flush_time = job_segmenter.time_until_idle_flush(channel["segmenter"], now)
+                if idle_flush_time is not None:
+                    wait_time = min(wait_time, idle_flush_time)
+            frame_sender = client_state["frame_sender"]
+            if frame_sender and frame_sender["buffers"]:
+                wait_time = min(wait_time, max(0.0, send_flush_interval - (now - frame_sender["first_queued_at"])))
+
+            metrics.set_gauge("npr_client_pending_jobs", len(pending_jobs) + len(held_jobs))
+            metrics.set_gauge("npr_client_pending_job_bytes", pending_bytes)
+            metrics.set_gauge("npr_client_capture_buffer_bytes", capture_buffer.buffered_bytes(capture))
+            metrics.set_gauge("npr_client_inflight_jobs", len(inflight_jobs))
+            if wait_time > 0:
+                for channel in channels:
+                    if channel["spool"]:
+                        spool.spool_sync(channel["spool"], force=True)
+            awaiting_pong = connection_ok and client_state["ping_sent_at"] is not None
+            if (acks_enabled and inflight_jobs) or awaiting_pong:
+                # Com jobs aguardando confirmação (ou um keep-alive aguardando
+                # resposta), a espera é feita no socket; a fila de captura é
+                # verificada a cada ACK_POLL_INTERVAL.
+                acked_seqs = receive_acks(client_state["server_connection"], min(wait_time, ACK_POLL_INTERVAL))
+                if acked_seqs is None:
+                    close_server_connection()
+                    connection_ok = False
                 else:
-                    log.info(f"Lidos {len(serial_data)} bytes da porta serial {config['serial_port']}.")
-                    data_buffer += serial_data
+                    for channel_id, acked_seq in acked_seqs.items():
+                        for acked_job in acknowledge_jobs(inflight_jobs, channel_id, acked_seq):
+                            finish_job_trace(acked_job, "ack")
+                wait_time = 0.0
+            if intake_blocked:
+                # Política 'block': enquanto os jobs pendentes ocupam mais que
+                # buffer_high_water, nada é retirado do buffer de captura; ao
+                # encher, as leituras da serial param.
+                client_state["stop_event"].wait(min(wait_time, BLOCKED_INTAKE_POLL_INTERVAL))
+            else:
+                for channel_id, data, captured_at in capture_buffer.get_chunks(capture, min(wait_time, 1.0)):
+                    channel = channels[channel_id]
+                    started_at = job_segmenter.job_started_at(channel["segmenter"]) or captured_at
+                    for job in job_segmenter.feed(channel["segmenter"], data, captured_at):
+                        pending_jobs.append(store_job(channel, job, started_at))
+                        pending_bytes += len(job)
+                        started_at = captured_at
+                capture_buffer.release_chunks(capture)
+            if pending_bytes > buffer_high_water:
+                pending_bytes = reduce_pending_memory((held_jobs, pending_jobs), pending_bytes, buffer_high_water, overflow_policy, drop_summary)
+            intake_blocked = pending_bytes > buffer_high_water
+            # Com conexão, pausas curtas enquanto os jobs são enviados são o
+            # funcionamento normal; só a pausa sem servidor (ou com jobs que o
+            # servidor não aceita ocupando a memória) é registrada.
+            if (intake_blocked and not intake_pause_logged
+                    and (not connection_ok or any(job["data"] is not None for job in held_jobs))):
+                log.warning(f"Jobs pendentes sem spool ocupam mais de {buffer_high_water} bytes. Captura da serial pausada até o envio ao servidor.")
+                intake_pause_logged = True
+            elif not intake_blocked and intake_pause_logged:
+                log.info("Captura da serial retomada.")
+                intake_pause_logged = False
 
-                if data_buffer and client_state["server_connection"] and client_state["server_public_key"]:
-                    log.debug(f"Tentando enviar {len(data_buffer)} bytes do buffer para o servidor...")
-                    max_chunk_size = 190
-                    bytes_to_send = data_buffer
-                    data_buffer = b""
-                    send_loop_ok = True
+            send_ok = True
+            while connection_ok and pending_jobs and client_state["server_connection"] and client_state["server_public_key"]:
+                acks_enabled = client_state["session_acks"]
+                if acks_enabled and len(inflight_jobs) >= ack_window:
+                    break
+                if client_state["connection_generation"] != seen_generation:
+                    # A conexão caiu e foi refeita durante esta volta: os jobs
+                    # sem confirmação precisam ser reenviados antes dos demais.
+                    break
+                pending_job = pending_jobs[0]
+                if pending_job["channel"] not in client_state["server_channels"]:
+                    held_jobs.append(pending_jobs.popleft())
+                    pending_bytes -= release_spooled_data(pending_job)
+                    continue
+                job = load_job_data(pending_job)
+                if job is None:
+                    log.error("Falha ao ler job do spool. Descartando job.")
+                    metrics.inc("npr_client_jobs_dropped_total")
+                    pending_jobs.popleft()
+                    continue
+                job_spool = channels[pending_job["channel"]]["spool"]
+                log.debug("Enfileirando job de %d bytes para envio ao servidor...", len(job))
+                tracing.stamp(pending_job["trace"], "queue")
+                messages = encrypt_job(job, pending_job["seq"], pending_job["channel"])
+                tracing.stamp(pending_job["trace"], "encrypt")
 
-                    try:
-                        while bytes_to_send:
-                            chunk = bytes_to_send[:max_chunk_size]
-                            bytes_to_send = bytes_to_send[max_chunk_size:]
-
-                            encrypted_chunk = crypto_utils.encrypt_message(
-                                client_state["server_public_key"],
-                                chunk
-                            )
-
-                            if encrypted_chunk:
-                                if not network_utils.send_data(client_state["server_connection"], encrypted_chunk):
-                                    log.warning("Falha ao enviar chunk para o servidor (erro de rede). Desconectando.")
-                                    close_server_connection()
-                                    connection_ok = False
-                                    data_buffer = chunk + bytes_to_send
-                                    last_connection_check = 0
-                                    send_loop_ok = False
-                                    break
-                                else:
-                                     log.debug("Chunk enviado com sucesso.")
-                                     last_activity_time = now
-                            else:
-                                log.error("Falha ao criptografar chunk. Descartando dados restantes no buffer.")
-                                data_buffer = b""
-                                bytes_to_send = b""
-                                send_loop_ok = False
-                                break
-
-                        if send_loop_ok and not data_buffer and not bytes_to_send:
-                             log.info("Buffer completo enviado com sucesso para o servidor.")
-
-                    except Exception as crypto_send_err:
-                         log.error(f"Erro durante chunking/criptografia/envio: {crypto_send_err}", exc_info=True)
-                         close_server_connection()
-                         connection_ok = False
-                         data_buffer = chunk + bytes_to_send if 'chunk' in locals() else bytes_to_send
-                         last_connection_check = 0
-
-            except serial_utils.serial.SerialException as ser_err:
-                 log.error(f"Erro na porta serial: {ser_err}", exc_info=True)
-                 serial_utils.close_serial_port(client_state["serial_port"])
-                 client_state["serial_port"] = None
-                 serial_ok = False
-                 last_serial_check = 0
-                 data_buffer = b""
-            except Exception as e:
-                 log.error(f"Erro inesperado no loop de leitura/envio: {e}", exc_info=True)
-                 close_server_connection()
-                 serial_utils.close_serial_port(client_state["serial_port"])
-                 client_state["serial_port"] = None
-                 serial_ok = False
-                 connection_ok = False
-                 last_serial_check = 0
-                 last_connection_check = 0
-                 data_buffer = b""
-                 time.sleep(config.get('retry_interval', 5.0))
-
-        time.sleep(0.05)
+                if messages is None:
+                    log.error("Falha ao criptografar job. Descartando job.")
+                    metrics.inc("npr_client_jobs_dropped_total")
+                    pending_jobs.popleft()
+                    pending_bytes -= job_memory(pending_job)
+                    if job_spool and pending_job["seq"] and not any(
+                            sent_job["channel"] == pending_job["channel"] for sent_job in inflight_jobs):
+                        spool.spool_ack(job_spool, pending_job["seq"])
+                    if client_state["compressor"]:
+                        # O fluxo comprimido já avançou com o job descartado.
+                        send_ok = False
+                        break
+                    continue
+
+                pending_jobs.popleft()
+                pending_bytes -= job_memory(pending_job)
+                if pending_job["seq"] or not acks_enabled:
+                    inflight_jobs.append(pending_job)
+                frame_sender = client_state["frame_sender"]
+                for message in messages:
+                    if not network_utils.queue_frame(frame_sender, message):
+                        send_ok = False
+                        break
+                if not send_ok:
+                    break
+                unflushed_jobs.append(pending_job)
+                metrics.inc("npr_client_jobs_sent_total", port=channels[pending_job["channel"]]["port"])
+                metrics.inc("npr_client_bytes_sent_total", sum(len(message) for message in messages))
+                logging_utils.count_event(send_summary, len(job))
+                last_activity_time = time.time()
+
+            frame_sender = client_state["frame_sender"]
+            if send_ok and connection_ok and frame_sender and frame_sender["buffers"]:
+                window_full = client_state["session_acks"] and len(inflight_jobs) >= ack_window
+                if (send_flush_interval <= 0 or window_full
+                        or time.time() - frame_sender["first_queued_at"] >= send_flush_interval):
+                    send_ok = network_utils.flush_frames(frame_sender)
+
+            if send_ok and connection_ok and unflushed_jobs and frame_sender and not frame_sender["buffers"]:
+                for sent_job in unflushed_jobs:
+                    if client_state["session_acks"] and sent_job["seq"]:
+                        tracing.stamp(sent_job["trace"], "send")
+                    else:
+                        finish_job_trace(sent_job, "send")
+                unflushed_jobs.clear()
+
+            if not send_ok:
+                log.warning("Falha ao enviar jobs para o servidor (erro de rede). Desconectando.")
+                close_server_connection()
+                connection_ok = False
+            elif (connection_ok and inflight_jobs and not client_state["session_acks"]
+                    and frame_sender and not frame_sender["buffers"]):
+                # Sem confirmações do servidor, um job é dado como entregue assim
+                # que o lote em que foi enfileirado é enviado.
+                for channel in channels:
+                    sent_seqs = [sent_job["seq"] for sent_job in inflight_jobs
+                                 if sent_job["seq"] and sent_job["channel"] == channel["id"]]
+                    if channel["spool"] and sent_seqs:
+                        spool.spool_ack(channel["spool"], max(sent_seqs))
+                log.debug("%d jobs enviados com sucesso para o servidor.", len(inflight_jobs))
+                inflight_jobs.clear()
+
+        except Exception as e:
+             log.error(f"Erro inesperado no loop de envio: {e}", exc_info=True)
+             close_server_connection()
+             connection_ok = False
+             client_state["stop_event"].wait(config.get('retry_interval', 5.0))
 
     log.info("Thread principal do cliente encerrando...")
+    logging_utils.flush_summary(send_summary)
+    logging_utils.flush_summary(drop_summary)
     close_server_connection()
-    serial_utils.close_serial_port(client_state.get("serial_port"))
+    for channel in channels:
+        job = job_segmenter.flush(channel["segmenter"])
+        if job:
+            store_job(channel, job)
+        if channel["spool"]:
+            spool.close_spool(channel["spool"])
     log.info("Thread principal do cliente finalizada.")
 
 
 
+def server_connection_thread():
+    """
+    Mantém a conexão com o servidor: conecta, troca as chaves e, quando a
+    conexão cai, reconecta com espera exponencial e jitter (ver
+    network_utils.backoff_delay), sem bloquear a captura e o spool da thread
+    principal.
+    """
+    log.info("Thread de conexão com o servidor iniciada.")
+    config = client_state["config"]
+    stop_event = client_state["stop_event"]
+    reconnect_event = client_state["reconnect_event"]
+    retry_interval = config.get('retry_interval', 5.0)
+    max_interval = config.get('reconnect_max_interval', network_utils.DEFAULT_RECONNECT_MAX_INTERVAL)
+    failures = 0
+    delay = 0.0
+    while not client_state["keys_ready"].is_set():
+        if stop_event.wait(0.1):
+            return
+
+    while not stop_event.is_set():
+        reconnect_event.wait()
+        reconnect_event.clear()
+        if stop_event.is_set() or client_state["server_connection"] is not None:
+            continue
+        if delay > 0:
+            log.info(f"Próxima tentativa de conexão com o servidor em {delay:.1f}s.")
+            if stop_event.wait(delay):
+                break
+
+        if ensure_server_connection():
+            failures = 0
+            # A primeira nova tentativa após uma queda também é sorteada: se o
+            # servidor reiniciou, todos os clientes caíram ao mesmo tempo.
+            delay = network_utils.backoff_delay(0, retry_interval, max_interval)
+            capture_buffer.wakeup(client_state["capture_buffer"])
+            if stop_event.is_set():
+                close_server_connection()
+        else:
+            failures += 1
+            delay = network_utils.backoff_delay(failures, retry_interval, max_interval)
+            reconnect_event.set()
+    log.info("Thread de conexão com o servidor finalizada.")
+
+def prepare_client_keys_thread(key_size):
+    """Carrega o par de chaves do cliente ou, se não existe, gera e salva um novo; sem ele o cliente é encerrado."""
+    started = time.perf_counter()
+    priv_key = crypto_utils.load_private_key('client')
+    pub_key = crypto_utils.load_public_key_from_file('client')
+    if not priv_key or not pub_key:
+        log.warning("Chaves RSA do cliente não encontradas ou inválidas. Gerando novo par...")
+        priv_key, pub_key = crypto_utils.generate_keys('client', key_size=key_size)
+        if not priv_key or not pub_key:
+            log.critical("Falha ao gerar/carregar chaves RSA do cliente. Encerrando.")
+            client_state["stop_event"].set()
+            return
+    client_state["client_private_key"] = priv_key
+    client_state["client_public_key"] = pub_key
+    client_state["client_public_key_bytes"] = crypto_utils.get_public_key_bytes(pub_key)
+    if not client_state["client_public_key_bytes"]:
+        log.critical("Falha ao serializar a chave pública do cliente. Encerrando.")
+        client_state["stop_event"].set()
+        return
+    client_state["client_key_fingerprint"] = crypto_utils.cache_public_key(pub_key)
+    log.info(f"Chaves RSA do cliente carregadas/geradas em {(time.perf_counter() - started) * 1000:.0f}ms.")
+    log.info(f"Impressão digital da chave do cliente (usada nas rotas do servidor): {client_state['client_key_fingerprint'].hex()}")
+    client_state["keys_ready"].set()
+
 def run_client(start_config=None):
     """Função principal para configurar e iniciar o cliente."""
+    startup_timer = client_state["startup_timer"] = logging_utils.create_startup_timer('client')
     if start_config:
         client_state["config"] = start_config
     config = client_state["config"]
@@ -289,59 +1170,107 @@ def run_client(start_config=None):
     log_level_str = config.get("log_level", "INFO").upper()
     log_level = getattr(logging, log_level_str, logging.INFO)
 
-    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    logging.basicConfig(level=log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    logging.basicConfig(level=log_level, format=logging_utils.LOG_FORMAT, datefmt=logging_utils.LOG_DATE_FORMAT)
+    logging_utils.setup_logging(log_level)
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
     log_file = os.path.join(script_dir, "client_activity.log")
+    trace_dump_file = os.path.join(script_dir, "client_job_stages.json")
     client_state["log_file_path"] = log_file
-    file_handler = logging.FileHandler(log_file, mode='a')
-    file_handler.setFormatter(log_formatter)
-    file_handler.setLevel(log_level)
-
-    log.addHandler(file_handler)
-    logging.getLogger('crypto_utils').addHandler(file_handler)
-    logging.getLogger('network_utils').addHandler(file_handler)
-    logging.getLogger('serial_utils').addHandler(file_handler)
-    logging.getLogger('config_manager').addHandler(file_handler)
+    logging_utils.add_log_file(log_file, log_level,
+                               max_bytes=config.get('log_max_bytes', logging_utils.DEFAULT_LOG_MAX_BYTES),
+                               backup_count=config.get('log_backup_count', logging_utils.DEFAULT_LOG_BACKUP_COUNT),
+                               when=config.get('log_rotate_when'))
 
-    logging.getLogger().setLevel(log_level)
     log.info(f"Nível de log configurado para: {log_level_str}")
     log.info("Logs também estão sendo salvos em: client_activity.log")
     log.info("--- Iniciando Cliente Network Print Redirector v2.0.2 ---")
+    logging_utils.mark_startup(startup_timer, "log")
 
-    priv_key = crypto_utils.load_private_key('client')
-    pub_key = crypto_utils.load_public_key_from_file('client')
-    if not priv_key or not pub_key:
-        log.warning("Chaves RSA do cliente não encontradas ou inválidas. Gerando novo par...")
-        key_size = config.get("rsa_key_size", 2048)
-        priv_key, pub_key = crypto_utils.generate_keys('client', key_size=key_size)
-        if not priv_key or not pub_key:
-            log.critical("Falha ao gerar/carregar chaves RSA do cliente. Encerrando.")
-            return False
-    client_state["client_private_key"] = priv_key
-    client_state["client_public_key"] = pub_key
-    log.info("Chaves RSA do cliente carregadas/geradas.")
+    # Carregar (~0,1s) ou gerar (de 0,1s a alguns segundos) o par de chaves não
+    # atrasa a captura: as portas já são lidas enquanto isso, e só a conexão
+    # com o servidor espera pelas chaves.
+    client_state["keys_ready"].clear()
+    key_thread = threading.Thread(target=prepare_client_keys_thread, args=(config.get("rsa_key_size", 2048),),
+                                  name="ClientKeyLoader", daemon=True)
 
     client_state["server_public_key"] = None
-    client_state["serial_port"] = None
+    client_state["server_key_fingerprint"] = None
+    client_state["fingerprint_unsupported"] = False
+    client_state["session_ticket"] = None
+    client_state["session"] = None
+    client_state["legacy_server"] = False
+    client_state["session_failures"] = 0
+    client_state["session_retry_at"] = 0.0
+    client_state["server_channels"] = {0}
+
+    client_state["channels"] = load_channels(config)
+    spool_base_dir = config.get('spool_dir') or os.path.join(config_manager.get_base_dir(), "spool")
+    for channel in client_state["channels"]:
+        if config.get('spool_enabled', True):
+            spool_name = "client" if channel["id"] == 0 else f"client-{channel['port']}"
+            channel["spool"] = spool.open_spool(spool.spool_directory(spool_base_dir, spool_name))
+            if not channel["spool"]:
+                log.warning(f"Spool da porta {channel['port']} indisponível. Jobs pendentes ficarão apenas em memória.")
+        # O fluxo de jobs é identificado pelo spool, cujas sequências persistem entre
+        # execuções; sem spool, cada execução é um fluxo novo.
+        channel["stream_id"] = channel["spool"]["id"] if channel["spool"] else os.urandom(16).hex()
+    if len(client_state["channels"]) > 1:
+        log.info(f"Capturando {len(client_state['channels'])} portas seriais: {', '.join(channel['port'] for channel in client_state['channels'])}.")
+
+    logging_utils.mark_startup(startup_timer, "spool")
+
+    if config.get('metrics_port'):
+        metrics.start_metrics_server(config['metrics_port'], config.get('metrics_listen_ip', metrics.DEFAULT_METRICS_LISTEN_IP))
+    tracing.configure(config, trace_dump_file)
 
     client_state["stop_event"].clear()
+    client_state["capture_buffer"] = capture_buffer.create_capture_buffer(
+        config.get('capture_buffer_size', capture_buffer.DEFAULT_CAPTURE_BUFFER_SIZE),
+        config.get('buffer_overflow_policy', 'block'))
+    for channel in client_state["channels"]:
+        channel["reader_thread"] = threading.Thread(target=serial_reader_thread, args=(channel,),
+                                                    name=f"ClientSerialReader-{channel['port']}")
     main_thread = threading.Thread(target=listen_serial_and_send_thread, name="ClientMainThread")
     client_state["main_thread"] = main_thread
+    client_state["reconnect_event"].set()
+    connector_thread = threading.Thread(target=server_connection_thread, name="ClientConnector")
+    client_state["connector_thread"] = connector_thread
 
-    log.info("Iniciando thread principal do cliente...")
+    log.info("Iniciando threads de leitura serial e principal do cliente...")
+    for channel in client_state["channels"]:
+        channel["reader_thread"].start()
     main_thread.start()
+    connector_thread.start()
+    key_thread.start()
+    logging_utils.mark_startup(startup_timer, "threads")
+    logging_utils.log_startup(startup_timer, log)
 
     return True
 
 def stop_client():
     log.info("Solicitando encerramento do cliente...")
     client_state["stop_event"].set()
+    client_state["reconnect_event"].set()
     main_thread = client_state.get("main_thread")
     if main_thread and main_thread.is_alive():
          log.info("Aguardando a thread principal do cliente finalizar...")
          main_thread.join(timeout=5.0)
          if main_thread.is_alive():
               log.warning("Thread principal do cliente não finalizou a tempo.")
+    connector_thread = client_state.get("connector_thread")
+    if connector_thread and connector_thread.is_alive():
+         log.info("Aguardando a thread de conexão com o servidor finalizar...")
+         connector_thread.join(timeout=5.0)
+         if connector_thread.is_alive():
+              log.warning("Thread de conexão com o servidor não finalizou a tempo.")
+    for channel in client_state["channels"]:
+        reader_thread = channel["reader_thread"]
+        if reader_thread and reader_thread.is_alive():
+             log.info(f"Aguardando a thread de leitura serial de {channel['port']} finalizar...")
+             reader_thread.join(timeout=2.0)
+             if reader_thread.is_alive():
+                  log.warning(f"Thread de leitura serial de {channel['port']} não finalizou a tempo.")
+    tracing.shutdown()
+    metrics.stop_metrics_server()
     log.info("Cliente encerrado.")
\ No newline at end of file
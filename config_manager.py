@@ -138,6 +138,12 @@ def configure_interactively(mode, current_config=None):
             new_config_data[key] = settings['default']
             updated = True
 
+    # As opções avançadas (editadas à mão no .json, ver README) não são
+    # perguntadas aqui e precisam ser mantidas ao salvar.
+    for key, value in config.items():
+        if key not in defaults:
+            new_config_data[key] = value
+
     if updated:
         if save_config(mode, new_config_data):
             print("Configuração salva com sucesso.")
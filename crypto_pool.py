@@ -0,0 +1,132 @@
+import concurrent.futures
+import logging
+import multiprocessing
+
+from cryptography.hazmat.primitives import serialization
+
+import crypto_utils
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CRYPTO_BATCH_SIZE = 32
+
+# Pool de processos que descriptografa os blocos RSA do modo legado. Com o
+# pool desativado (crypto_workers = 0), o servidor descriptografa na própria
+# thread do cliente, como antes.
+pool_state = {
+    "executor": None,
+    "workers": 0,
+    "batch_size": DEFAULT_CRYPTO_BATCH_SIZE,
+}
+
+# Estado de cada processo do pool.
+worker_state = {
+    "private_key": None,
+}
+
+
+def _init_worker(private_key_pem):
+    """Carrega, uma única vez por processo, a chave privada do servidor."""
+    worker_state["private_key"] = serialization.load_pem_private_key(private_key_pem, password=None)
+
+def _decrypt_blocks(blocks):
+    """Executado nos processos do pool: descriptografa os blocos, na ordem recebida."""
+    private_key = worker_state["private_key"]
+    return [crypto_utils.decrypt_message(private_key, block) for block in blocks]
+
+
+def start_pool(private_key, workers, batch_size=DEFAULT_CRYPTO_BATCH_SIZE):
+    """
+    Inicia o pool de descriptografia com workers processos.
+
+    A chave privada é passada a cada processo na inicialização (em PEM, pelo
+    canal do multiprocessing, sem passar pelo disco). Os processos são criados
+    com 'spawn' em qualquer plataforma: o servidor já tem threads em execução
+    quando o primeiro bloco chega, e fork com threads não é seguro.
+
+    Returns:
+        bool: True se o pool foi iniciado.
+    """
+    if workers <= 0:
+        return False
+    try:
+        private_key_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(private_key_pem,)
+        )
+    except Exception as e:
+        log.error(f"Não foi possível iniciar o pool de descriptografia: {e}. Descriptografando nas threads dos clientes.")
+        return False
+    pool_state["executor"] = executor
+    pool_state["workers"] = workers
+    pool_state["batch_size"] = max(1, batch_size)
+    log.info(f"Modo legado: descriptografia RSA em {workers} processos (lotes de até {pool_state['batch_size']} blocos).")
+    return True
+
+def pool_enabled():
+    return pool_state["executor"] is not None
+
+def submit_blocks(blocks):
+    """
+    Envia blocos RSA ao pool, divididos em lotes de até batch_size blocos.
+
+    Os lotes de uma mesma conexão são distribuídos entre os processos e os de
+    conexões diferentes se intercalam na fila do pool, de modo que todos os
+    núcleos trabalham mesmo com um único cliente.
+
+    Returns:
+        list: Futures dos lotes, na ordem dos blocos; cada um resulta na lista
+              de textos claros do lote (None nos blocos que falharam). None se
+              o pool não está ativo ou não aceita mais tarefas.
+    """
+    executor = pool_state["executor"]
+    if executor is None:
+        return None
+    batch_size = pool_state["batch_size"]
+    try:
+        return [executor.submit(_decrypt_blocks, blocks[start:start + batch_size])
+                for start in range(0, len(blocks), batch_size)]
+    except RuntimeError as e:
+        # Pool encerrado ou quebrado (um processo morreu).
+        log.error(f"Pool de descriptografia indisponível: {e}")
+        return None
+
+def collect_results(futures):
+    """
+    Junta os resultados dos lotes de submit_blocks, na ordem em que foram enviados.
+
+    Returns:
+        list: Um texto claro (ou None) por bloco, ou None se um lote falhou.
+    """
+    results = []
+    try:
+        for future in futures:
+            results.extend(future.result())
+    except Exception as e:
+        log.error(f"Falha no pool de descriptografia: {e}")
+        return None
+    return results
+
+def decrypt_blocks(blocks):
+    """Descriptografa blocos RSA no pool, aguardando o resultado. Retorna None se o pool não pôde atendê-los."""
+    futures = submit_blocks(blocks)
+    if futures is None:
+        return None
+    return collect_results(futures)
+
+def stop_pool():
+    """Encerra os processos do pool, aguardando os lotes em andamento."""
+    executor = pool_state["executor"]
+    if executor is None:
+        return
+    pool_state["executor"] = None
+    executor.shutdown(wait=True)
+    log.info("Pool de descriptografia encerrado.")
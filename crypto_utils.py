@@ -1,14 +1,48 @@
+import collections
+import hashlib
 import logging
 import os
+import struct
+import threading
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
-from cryptography.exceptions import InvalidSignature, AlreadyFinalized
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.exceptions import InvalidSignature, InvalidTag, AlreadyFinalized
 
 log = logging.getLogger(__name__)
 
 PRIVATE_KEY_FILE_TPL = "{mode}_private_key.pem"
 PUBLIC_KEY_FILE_TPL = "{mode}_public_key.pem"
 
+SESSION_KEY_SIZE = 32
+SESSION_NONCE_COUNTER_FORMAT = '!Q'
+SESSION_NONCE_PREFIXES = {
+    'client': b"NPRC",
+    'server': b"NPRS",
+}
+SESSION_NONCE_SIZE = len(SESSION_NONCE_PREFIXES['client']) + struct.calcsize(SESSION_NONCE_COUNTER_FORMAT)
+
+# Retomada de sessão: o segredo de retomada é derivado da chave de uma sessão
+# estabelecida, e cada sessão retomada usa uma chave nova derivada desse
+# segredo e de um valor aleatório escolhido pelo cliente.
+RESUMPTION_SECRET_INFO = b"npr resumption secret"
+RESUMED_SESSION_INFO = b"npr resumed session"
+TICKET_NONCE_SIZE = 12
+TICKET_AAD = b"npr session ticket"
+
+# Cache LRU de chaves públicas já carregadas. Cada chave fica registrada pela
+# impressão digital (SHA-256 do DER) e pelo SHA-256 do PEM recebido, para que
+# reconexões não precisem decodificar o PEM novamente.
+KEY_FINGERPRINT_SIZE = hashlib.sha256().digest_size
+PUBLIC_KEY_CACHE_SIZE = 512
+
+public_key_cache = {
+    "entries": collections.OrderedDict(),
+    "max_entries": PUBLIC_KEY_CACHE_SIZE,
+    "lock": threading.Lock(),
+}
+
 def get_private_key_path(mode):
     """Retorna o caminho esperado para o arquivo de chave privada."""
     return PRIVATE_KEY_FILE_TPL.format(mode=mode)
@@ -120,7 +154,7 @@ def load_public_key_from_data(key_data_bytes):
     if not key_data_bytes:
         log.error("Tentativa de carregar chave pública a partir de dados vazios.")
         return None
-    log.debug(f"Tentando carregar chave pública a partir de {len(key_data_bytes)} bytes de dados.")
+    log.debug("Tentando carregar chave pública a partir de %d bytes de dados.", len(key_data_bytes))
     try:
         public_key = serialization.load_pem_public_key(key_data_bytes)
         log.info("Chave pública carregada com sucesso a partir dos dados.")
@@ -131,6 +165,72 @@ def load_public_key_from_data(key_data_bytes):
         log.error(f"Erro inesperado ao carregar chave pública dos dados: {e}")
     return None
 
+def public_key_fingerprint(public_key):
+    """Calcula a impressão digital da chave pública (SHA-256 do DER SubjectPublicKeyInfo)."""
+    der_public = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der_public).digest()
+
+def _cache_get(digest):
+    with public_key_cache["lock"]:
+        entry = public_key_cache["entries"].get(digest)
+        if entry is not None:
+            public_key_cache["entries"].move_to_end(digest)
+        return entry
+
+def _cache_put(digest, entry):
+    with public_key_cache["lock"]:
+        entries = public_key_cache["entries"]
+        entries[digest] = entry
+        entries.move_to_end(digest)
+        while len(entries) > public_key_cache["max_entries"]:
+            entries.popitem(last=False)
+
+def cache_public_key(public_key, key_data_bytes=None):
+    """
+    Registra uma chave pública no cache.
+
+    Args:
+        public_key: Chave já carregada.
+        key_data_bytes (bytes, optional): PEM de origem, registrado também para
+                                          evitar nova decodificação.
+
+    Returns:
+        bytes: Impressão digital da chave.
+    """
+    fingerprint = public_key_fingerprint(public_key)
+    _cache_put(fingerprint, (public_key, fingerprint))
+    if key_data_bytes:
+        _cache_put(hashlib.sha256(key_data_bytes).digest(), (public_key, fingerprint))
+    return fingerprint
+
+def get_cached_public_key(fingerprint):
+    """Retorna a chave pública com a impressão digital informada, ou None se não estiver no cache."""
+    entry = _cache_get(bytes(fingerprint))
+    return entry[0] if entry else None
+
+def load_public_key_cached(key_data_bytes):
+    """
+    Como load_public_key_from_data, mas reaproveita chaves já carregadas.
+
+    Returns:
+        tuple: (chave pública, impressão digital), ou (None, None) se o PEM for inválido.
+    """
+    if not key_data_bytes:
+        log.error("Tentativa de carregar chave pública a partir de dados vazios.")
+        return None, None
+    key_data_bytes = bytes(key_data_bytes)
+    entry = _cache_get(hashlib.sha256(key_data_bytes).digest())
+    if entry:
+        log.debug("Chave pública encontrada no cache.")
+        return entry
+    public_key = load_public_key_from_data(key_data_bytes)
+    if not public_key:
+        return None, None
+    return public_key, cache_public_key(public_key, key_data_bytes)
+
 def get_public_key_bytes(public_key):
     """Serializa a chave pública para bytes no formato PEM."""
     if not public_key:
@@ -171,7 +271,7 @@ def encrypt_message(public_key, message_bytes):
             message_bytes,
             padding_algo
         )
-        log.debug(f"Mensagem de {len(message_bytes)} bytes criptografada para {len(encrypted_message)} bytes.")
+        log.debug("Mensagem de %d bytes criptografada para %d bytes.", len(message_bytes), len(encrypted_message))
         return encrypted_message
     except ValueError as e:
         log.error(f"Erro ao criptografar: Mensagem muito longa para a chave/padding? {e}")
@@ -205,7 +305,7 @@ def decrypt_message(private_key, encrypted_message_bytes):
             encrypted_message_bytes,
             padding_algo
         )
-        log.debug(f"Mensagem criptografada de {len(encrypted_message_bytes)} bytes descriptografada para {len(decrypted_message)} bytes.")
+        log.debug("Mensagem criptografada de %d bytes descriptografada para %d bytes.", len(encrypted_message_bytes), len(decrypted_message))
         return decrypted_message
     except ValueError as e:
         log.error(f"Erro ao descriptografar: Dados corrompidos, padding/chave incorreta? {e}")
@@ -214,6 +314,140 @@ def decrypt_message(private_key, encrypted_message_bytes):
 
     return None
 
+def generate_session_key():
+    """Gera uma chave simétrica aleatória (AES-256) para uma sessão."""
+    return AESGCM.generate_key(bit_length=SESSION_KEY_SIZE * 8)
+
+def create_session(session_key, role):
+    """
+    Cria o estado de uma sessão AES-GCM a partir de uma chave já negociada.
+
+    O nonce de cada mensagem é formado pelo prefixo do remetente (4 bytes) e um
+    contador de 64 bits, o que garante nonces únicos por direção sem depender
+    de aleatoriedade e permite rejeitar mensagens repetidas.
+
+    Args:
+        session_key (bytes): Chave simétrica de SESSION_KEY_SIZE bytes.
+        role (str): 'client' ou 'server', o lado que usará esta sessão.
+
+    Returns:
+        dict: Estado da sessão, ou None se a chave ou o papel forem inválidos.
+    """
+    if not session_key or len(session_key) != SESSION_KEY_SIZE:
+        log.error("Chave de sessão inválida.")
+        return None
+    if role not in SESSION_NONCE_PREFIXES:
+        log.error(f"Papel de sessão inválido: {role}")
+        return None
+
+    peer_role = 'server' if role == 'client' else 'client'
+    return {
+        "aead": AESGCM(session_key),
+        "key": session_key,
+        "send_prefix": SESSION_NONCE_PREFIXES[role],
+        "recv_prefix": SESSION_NONCE_PREFIXES[peer_role],
+        "send_counter": 0,
+        "recv_counter": 0,
+    }
+
+def session_encrypt(session, message_bytes):
+    """
+    Criptografa e autentica uma mensagem com a chave simétrica da sessão.
+
+    Args:
+        session (dict): Estado criado por create_session.
+        message_bytes (bytes): A mensagem a ser criptografada (pode ser vazia).
+
+    Returns:
+        bytes: Nonce seguido do texto cifrado e da tag, ou None em caso de erro.
+    """
+    if not session:
+        log.error("Sessão inválida para criptografia.")
+        return None
+
+    try:
+        nonce = session["send_prefix"] + struct.pack(SESSION_NONCE_COUNTER_FORMAT, session["send_counter"])
+        session["send_counter"] += 1
+        return nonce + session["aead"].encrypt(nonce, message_bytes, None)
+    except Exception as e:
+        log.error(f"Erro inesperado durante a criptografia de sessão: {e}")
+
+    return None
+
+def session_decrypt(session, encrypted_message_bytes):
+    """
+    Verifica e descriptografa uma mensagem recebida na sessão.
+
+    Mensagens com prefixo de nonce inesperado ou contador repetido/antigo são
+    rejeitadas.
+
+    Args:
+        session (dict): Estado criado por create_session.
+        encrypted_message_bytes (bytes): Nonce + texto cifrado + tag.
+
+    Returns:
+        bytes: Mensagem original, ou None em caso de erro ou falha de autenticação.
+    """
+    if not session or not encrypted_message_bytes or len(encrypted_message_bytes) < SESSION_NONCE_SIZE:
+        log.error("Sessão ou mensagem criptografada inválida para descriptografia.")
+        return None
+
+    nonce = bytes(encrypted_message_bytes[:SESSION_NONCE_SIZE])
+    prefix_size = len(session["recv_prefix"])
+    if nonce[:prefix_size] != session["recv_prefix"]:
+        log.error("Nonce de sessão com prefixo inesperado. Mensagem rejeitada.")
+        return None
+    counter = struct.unpack(SESSION_NONCE_COUNTER_FORMAT, nonce[prefix_size:])[0]
+    if counter < session["recv_counter"]:
+        log.error(f"Contador de nonce repetido ou antigo ({counter}). Mensagem rejeitada.")
+        return None
+
+    try:
+        message = session["aead"].decrypt(nonce, memoryview(encrypted_message_bytes)[SESSION_NONCE_SIZE:], None)
+        session["recv_counter"] = counter + 1
+        return message
+    except InvalidTag:
+        log.error("Falha de autenticação ao descriptografar mensagem de sessão.")
+    except Exception as e:
+        log.error(f"Erro inesperado durante a descriptografia de sessão: {e}")
+
+    return None
+
+def derive_key(secret, salt, info):
+    """Deriva uma chave de SESSION_KEY_SIZE bytes com HKDF-SHA256."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=SESSION_KEY_SIZE,
+        salt=salt or None,
+        info=info,
+    ).derive(secret)
+
+def derive_resumption_secret(session):
+    """Deriva, da chave de uma sessão estabelecida, o segredo usado para retomá-la."""
+    return derive_key(session["key"], None, RESUMPTION_SECRET_INFO)
+
+def seal_ticket(ticket_key, payload_bytes):
+    """Cifra o conteúdo de um ticket de sessão com a chave de tickets do servidor."""
+    nonce = os.urandom(TICKET_NONCE_SIZE)
+    return nonce + AESGCM(ticket_key).encrypt(nonce, payload_bytes, TICKET_AAD)
+
+def open_ticket(ticket_key, ticket):
+    """
+    Verifica e abre um ticket de sessão.
+
+    Returns:
+        bytes: Conteúdo do ticket, ou None se ele não foi emitido com esta chave.
+    """
+    if not ticket or len(ticket) <= TICKET_NONCE_SIZE:
+        return None
+    try:
+        return AESGCM(ticket_key).decrypt(bytes(ticket[:TICKET_NONCE_SIZE]), bytes(ticket[TICKET_NONCE_SIZE:]), TICKET_AAD)
+    except InvalidTag:
+        log.warning("Ticket de sessão inválido ou emitido por outra instância do servidor.")
+    except Exception as e:
+        log.error(f"Erro inesperado ao abrir ticket de sessão: {e}")
+    return None
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Testando funcionalidades de criptografia...")
@@ -0,0 +1,192 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# Por padrão só os comandos explícitos de fim de job (^XZ do ZPL, UEL após
+# EOJ/reset do PJL). Os cortes ESC/POS são pares de bytes que também aparecem
+# dentro de imagens e gráficos binários e dividiriam o job; 'escpos' deve ser
+# ativado por porta, onde se sabe que a impressora recebe ESC/POS.
+DEFAULT_JOB_FORMATS = ('zpl', 'pjl')
+DEFAULT_IDLE_GAP = 0.2
+DEFAULT_MAX_JOB_SIZE = 1024 * 1024
+
+ZPL_JOB_END = b"^XZ"
+ESCPOS_GS_CUT = b"\x1dV"
+ESCPOS_ESC_CUTS = (b"\x1bi", b"\x1bm")
+PJL_UEL = b"\x1b%-12345X"
+PCL_RESET = b"\x1bE"
+PJL_EOJ = b"@PJL EOJ"
+
+# Quantos bytes do final do buffer precisam ser reexaminados a cada chegada de
+# dados, para que um marcador dividido entre duas leituras seja encontrado.
+MAX_MARKER_SIZE = 16
+
+
+def find_zpl_job_end(buffer, start):
+    """Retorna o índice logo após o primeiro '^XZ' a partir de start, ou -1."""
+    upper_pos = buffer.find(ZPL_JOB_END, start)
+    lower_pos = buffer.find(ZPL_JOB_END.lower(), start)
+    positions = [pos for pos in (upper_pos, lower_pos) if pos >= 0]
+    if not positions:
+        return -1
+    return min(positions) + len(ZPL_JOB_END)
+
+def find_escpos_job_end(buffer, start):
+    """
+    Retorna o índice logo após o primeiro comando de corte ESC/POS, ou -1.
+
+    Reconhece 'GS V m' (m = 0, 1, 48 ou 49), 'GS V m n' (m = 65 ou 66) e os
+    comandos de corte 'ESC i' / 'ESC m'.
+    """
+    best = -1
+    pos = buffer.find(ESCPOS_GS_CUT, start)
+    while pos >= 0:
+        mode_pos = pos + len(ESCPOS_GS_CUT)
+        if mode_pos >= len(buffer):
+            break
+        mode = buffer[mode_pos]
+        if mode in (0, 1, 48, 49):
+            best = mode_pos + 1
+            break
+        if mode in (65, 66):
+            if mode_pos + 1 < len(buffer):
+                best = mode_pos + 2
+            break
+        pos = buffer.find(ESCPOS_GS_CUT, pos + 1)
+
+    for marker in ESCPOS_ESC_CUTS:
+        pos = buffer.find(marker, start)
+        if pos >= 0 and (best < 0 or pos + len(marker) < best):
+            best = pos + len(marker)
+    return best
+
+def find_pjl_job_end(buffer, start):
+    """
+    Retorna o índice logo após o UEL que encerra um job PJL/PCL, ou -1.
+
+    Um UEL encerra o job quando é precedido por um reset PCL ('ESC E') ou por
+    um comando '@PJL EOJ'; UELs no início de um job são ignorados.
+    """
+    pos = buffer.find(PJL_UEL, start)
+    while pos >= 0:
+        if pos > 0:
+            preceding = bytes(buffer[max(0, pos - 256):pos])
+            last_line = preceding.rstrip(b"\r\n").rsplit(b"\n", 1)[-1].lstrip()
+            if preceding.endswith(PCL_RESET) or last_line.upper().startswith(PJL_EOJ):
+                return pos + len(PJL_UEL)
+        pos = buffer.find(PJL_UEL, pos + 1)
+    return -1
+
+JOB_END_DETECTORS = {
+    'zpl': find_zpl_job_end,
+    'escpos': find_escpos_job_end,
+    'pjl': find_pjl_job_end,
+}
+
+def register_detector(name, detector):
+    """
+    Registra um detector de fim de job adicional.
+
+    Args:
+        name (str): Nome usado na opção de configuração 'job_formats'.
+        detector (callable): Função (buffer, start) que retorna o índice logo
+            após o fim do primeiro job encontrado a partir de start, ou -1.
+    """
+    JOB_END_DETECTORS[name] = detector
+
+def create_segmenter(formats=DEFAULT_JOB_FORMATS, idle_gap=DEFAULT_IDLE_GAP, max_job_size=DEFAULT_MAX_JOB_SIZE):
+    """
+    Cria o estado de um segmentador de jobs de impressão.
+
+    Args:
+        formats (iterable): Nomes dos detectores a usar (ver JOB_END_DETECTORS).
+        idle_gap (float): Segundos sem dados após os quais o conteúdo pendente
+            é considerado um job completo (para fluxos sem marcadores).
+        max_job_size (int): Tamanho a partir do qual o conteúdo pendente é
+            emitido mesmo sem fim de job reconhecido.
+    """
+    detectors = []
+    for name in formats:
+        detector = JOB_END_DETECTORS.get(name)
+        if detector:
+            detectors.append(detector)
+        else:
+            log.warning(f"Formato de job desconhecido ignorado: {name}")
+    return {
+        "buffer": bytearray(),
+        "scan_from": 0,
+        "detectors": detectors,
+        "idle_gap": idle_gap,
+        "max_job_size": max_job_size,
+        "last_data_time": None,
+        "job_started_at": None,
+    }
+
+def feed(segmenter, data, now):
+    """
+    Acrescenta dados capturados ao segmentador.
+
+    Returns:
+        list: Jobs completos (bytes) encontrados, na ordem de chegada.
+    """
+    buffer = segmenter["buffer"]
+    if not buffer:
+        segmenter["job_started_at"] = now
+    buffer += data
+    segmenter["last_data_time"] = now
+    jobs = []
+
+    while buffer:
+        job_end = -1
+        for detector in segmenter["detectors"]:
+            end = detector(buffer, segmenter["scan_from"])
+            if end > 0 and (job_end < 0 or end < job_end):
+                job_end = end
+        if job_end < 0:
+            if len(buffer) >= segmenter["max_job_size"]:
+                log.debug(f"Job excedeu {segmenter['max_job_size']} bytes sem fim reconhecido. Emitindo parcial.")
+                job_end = len(buffer)
+            else:
+                segmenter["scan_from"] = max(0, len(buffer) - MAX_MARKER_SIZE)
+                break
+        jobs.append(bytes(buffer[:job_end]))
+        del buffer[:job_end]
+        segmenter["scan_from"] = 0
+        segmenter["job_started_at"] = now
+
+    return jobs
+
+def flush_idle(segmenter, now):
+    """
+    Emite o conteúdo pendente como job se não chegaram dados por idle_gap segundos.
+
+    Returns:
+        bytes: O job emitido, ou None se não há nada a emitir ainda.
+    """
+    if not segmenter["buffer"] or segmenter["last_data_time"] is None:
+        return None
+    if now - segmenter["last_data_time"] < segmenter["idle_gap"]:
+        return None
+    return flush(segmenter)
+
+def flush(segmenter):
+    """Emite imediatamente todo o conteúdo pendente como job (ou None se vazio)."""
+    if not segmenter["buffer"]:
+        return None
+    job = bytes(segmenter["buffer"])
+    segmenter["buffer"].clear()
+    segmenter["scan_from"] = 0
+    return job
+
+def job_started_at(segmenter):
+    """Instante em que chegou o primeiro byte do conteúdo pendente, ou None se não há pendências."""
+    if not segmenter["buffer"]:
+        return None
+    return segmenter["job_started_at"]
+
+def time_until_idle_flush(segmenter, now):
+    """Segundos até o conteúdo pendente ser emitido por inatividade, ou None se não há pendências."""
+    if not segmenter["buffer"] or segmenter["last_data_time"] is None:
+        return None
+    return max(0.0, segmenter["idle_gap"] - (now - segmenter["last_data_time"]))
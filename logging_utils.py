@@ -0,0 +1,243 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_SUMMARY_INTERVAL = 60.0
+DEFAULT_LOG_MAX_BYTES = 1 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 5
+TAIL_BLOCK_SIZE = 8192
+
+# Os handlers do logger raiz (arquivo, console) ficam atrás de uma fila: quem
+# registra só enfileira o registro, e a escrita é feita pela thread do
+# QueueListener, fora do caminho dos dados.
+logging_state = {
+    "queue": queue.SimpleQueue(),
+    "queue_handler": None,
+    "listener": None,
+}
+
+
+def _pipeline_handlers():
+    """Handlers que escrevem os registros: os do listener ativo ou, antes dele, os do logger raiz."""
+    listener = logging_state["listener"]
+    if listener:
+        return list(listener.handlers)
+    return list(logging.getLogger().handlers)
+
+def _start_listener(handlers):
+    """(Re)inicia o listener com handlers e deixa o logger raiz apenas com o QueueHandler."""
+    listener = logging_state["listener"]
+    if listener:
+        listener.stop()
+
+    queue_handler = logging_state["queue_handler"]
+    if queue_handler is None:
+        queue_handler = logging_state["queue_handler"] = logging.handlers.QueueHandler(logging_state["queue"])
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if handler is not queue_handler:
+            root.removeHandler(handler)
+    if queue_handler not in root.handlers:
+        root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(logging_state["queue"], *handlers, respect_handler_level=True)
+    logging_state["listener"] = listener
+    listener.start()
+
+def setup_logging(level):
+    """
+    Passa a escrever os registros do processo em uma thread própria.
+
+    Os handlers já presentes no logger raiz (console, arquivo de main.py) são
+    movidos para um QueueListener. Pode ser chamada mais de uma vez; apenas
+    atualiza o nível nas chamadas seguintes.
+    """
+    handlers = _pipeline_handlers()
+    logging.getLogger().setLevel(level)
+    for handler in handlers:
+        handler.setLevel(level)
+    if logging_state["listener"] is None:
+        _start_listener(handlers)
+        atexit.register(stop_logging)
+
+def _rotation_matches(handler, max_bytes, backup_count, when):
+    if when:
+        return (isinstance(handler, logging.handlers.TimedRotatingFileHandler)
+                and handler.when == when.upper() and handler.backupCount == backup_count)
+    return (isinstance(handler, logging.handlers.RotatingFileHandler)
+            and handler.maxBytes == max_bytes and handler.backupCount == backup_count)
+
+def add_log_file(log_file, level, max_bytes=DEFAULT_LOG_MAX_BYTES, backup_count=DEFAULT_LOG_BACKUP_COUNT, when=None):
+    """
+    Acrescenta o arquivo log_file, com rotação, ao log do processo.
+
+    Por padrão o arquivo é rotacionado ao atingir max_bytes; com when (por
+    exemplo 'midnight' ou 'H', ver TimedRotatingFileHandler) a rotação é por
+    tempo. Em ambos os casos são mantidos backup_count arquivos antigos. Se o
+    arquivo já é escrito com a mesma rotação, apenas ajusta o nível; com outra
+    rotação, o handler anterior é substituído.
+
+    Returns:
+        logging.Handler: O handler do arquivo.
+    """
+    log_path = os.path.abspath(log_file)
+    handlers = _pipeline_handlers()
+    existing = None
+    for handler in handlers:
+        if isinstance(handler, logging.FileHandler) and os.path.abspath(handler.baseFilename) == log_path:
+            existing = handler
+            break
+    if existing and _rotation_matches(existing, max_bytes, backup_count, when):
+        existing.setLevel(level)
+        return existing
+
+    if when:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=when, backupCount=backup_count, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    file_handler.setLevel(level)
+    handlers = [handler for handler in handlers if handler is not existing] + [file_handler]
+    if logging_state["listener"]:
+        _start_listener(handlers)
+    else:
+        root = logging.getLogger()
+        if existing:
+            root.removeHandler(existing)
+        root.addHandler(file_handler)
+    if existing:
+        existing.close()
+    return file_handler
+
+def tail_lines(path, num_lines, block_size=TAIL_BLOCK_SIZE):
+    """
+    Retorna as últimas num_lines linhas de um arquivo de texto.
+
+    O arquivo é lido de trás para frente, em blocos, só até reunir as linhas
+    pedidas: o custo não depende do tamanho do arquivo.
+
+    Raises:
+        OSError: Se o arquivo não pode ser lido.
+    """
+    if num_lines <= 0:
+        return []
+    blocks = []
+    newlines = 0
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        # Uma linha a mais de quebras garante que a primeira linha pedida está completa.
+        while position > 0 and newlines <= num_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+    lines = b''.join(reversed(blocks)).splitlines()
+    return [line.decode('utf-8', errors='replace') for line in lines[-num_lines:]]
+
+def stop_logging():
+    """Escreve os registros pendentes e devolve os handlers ao logger raiz (log síncrono)."""
+    listener = logging_state["listener"]
+    if listener is None:
+        return
+    logging_state["listener"] = None
+    listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(logging_state["queue_handler"])
+    for handler in listener.handlers:
+        root.addHandler(handler)
+
+
+def create_summary(logger, message, interval=DEFAULT_SUMMARY_INTERVAL, level=logging.INFO, **fields):
+    """
+    Cria um resumo periódico para um evento frequente do caminho dos dados.
+
+    Em vez de uma linha por evento, count_event acumula ocorrências e bytes e,
+    a cada interval segundos, registra message formatada com os campos
+    %(count)d, %(bytes)d e %(seconds).0f, além dos campos fixos em fields
+    (porta, cliente...). Um resumo pode ser atualizado de mais de uma thread
+    (no motor asyncio, o do cliente também é atualizado pelo executor).
+    """
+    return {
+        "lock": threading.Lock(),
+        "logger": logger,
+        "message": message,
+        "interval": interval,
+        "level": level,
+        "fields": fields,
+        "count": 0,
+        "bytes": 0,
+        "started_at": time.monotonic(),
+    }
+
+def count_event(summary, nbytes=0):
+    """Acumula um evento no resumo, registrando-o se o intervalo já passou."""
+    now = time.monotonic()
+    with summary["lock"]:
+        if not summary["count"]:
+            # O intervalo começa no primeiro evento, não no fim do anterior ocioso.
+            summary["started_at"] = now
+        summary["count"] += 1
+        summary["bytes"] += nbytes
+        if now - summary["started_at"] >= summary["interval"]:
+            _log_summary(summary, now)
+
+def _log_summary(summary, now):
+    if summary["count"]:
+        summary["logger"].log(summary["level"], summary["message"], dict(
+            summary["fields"],
+            count=summary["count"],
+            bytes=summary["bytes"],
+            seconds=now - summary["started_at"],
+        ))
+    summary["count"] = 0
+    summary["bytes"] = 0
+    summary["started_at"] = now
+
+def flush_summary(summary, now=None):
+    """Registra o que foi acumulado no resumo (se houver algo) e recomeça a contagem."""
+    now = now or time.monotonic()
+    with summary["lock"]:
+        _log_summary(summary, now)
+
+
+def create_startup_timer(name, started_at=None):
+    """
+    Cria um relatório de tempos de inicialização para name ('client', 'server'...).
+
+    mark_startup registra a duração de cada etapa desde a marca anterior, e
+    log_startup escreve as etapas e o total em uma única linha do log.
+
+    Args:
+        started_at (float, optional): Instante (time.perf_counter()) em que a
+            inicialização começou; por padrão, agora.
+    """
+    started_at = started_at or time.perf_counter()
+    return {"name": name, "started_at": started_at, "mark": started_at, "stages": []}
+
+def mark_startup(timer, stage):
+    """Registra no relatório a etapa stage, concluída agora."""
+    now = time.perf_counter()
+    timer["stages"].append((stage, now - timer["mark"]))
+    timer["mark"] = now
+
+def startup_elapsed(timer):
+    """Segundos desde o início da inicialização."""
+    return time.perf_counter() - timer["started_at"]
+
+def log_startup(timer, logger=log):
+    """Registra o relatório: o tempo total e o de cada etapa, em milissegundos."""
+    stages = ", ".join(f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in timer["stages"])
+    logger.info(f"Inicialização ({timer['name']}) em {(timer['mark'] - timer['started_at']) * 1000:.0f}ms: {stages}")
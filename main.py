@@ -1,17 +1,29 @@
+import time
+STARTUP_STARTED_AT = time.perf_counter()
+
 import sys
 import argparse
 import logging
 import threading
-import time
 import os
-import logging.handlers
 
-try:
-    from PIL import Image, ImageDraw
-    import pystray
-    HAS_TRAY_LIBS = True
-except ImportError:
-    HAS_TRAY_LIBS = False
+import logging_utils
+
+# pystray/Pillow (bandeja) e os módulos de cada modo são importados só quando
+# usados, em __main__: o modo terminal não paga pela interface gráfica, e o
+# cliente não carrega o servidor.
+HAS_TRAY_LIBS = False
+
+
+# Os processos do pool de descriptografia do servidor (crypto_pool) são criados
+# com 'spawn'. No executável do PyInstaller eles são o próprio executável, e
+# freeze_support os desvia para o multiprocessing antes da leitura dos
+# argumentos; fora dele, importam este arquivo como __mp_main__ e não devem
+# abrir o arquivo de log de novo.
+if getattr(sys, 'frozen', False):
+    import multiprocessing
+    multiprocessing.freeze_support()
+IS_WORKER_PROCESS = __name__ == "__mp_main__"
 
 
 APP_NAME = "Network Print Redirector"
@@ -19,8 +31,8 @@ APP_VERSION = "1.0"
 
 
 logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+                    format=logging_utils.LOG_FORMAT,
+                    datefmt=logging_utils.LOG_DATE_FORMAT)
 log = logging.getLogger(__name__)
 
 
@@ -34,46 +46,38 @@ args = parser.parse_args()
 
 
 log_file_path = None
-try:
-    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-        base_dir = os.path.dirname(sys.executable)
-    else:
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-
-    log_filename = f"{args.mode}_activity.log"
-    log_file_path = os.path.join(base_dir, log_filename)
-
-    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_file_path, maxBytes=1*1024*1024, backupCount=5, encoding='utf-8'
-    )
-    file_handler.setFormatter(log_formatter)
-
-    initial_log_level = getattr(logging, (args.log_level or "INFO").upper(), logging.INFO)
-    file_handler.setLevel(initial_log_level)
+if not IS_WORKER_PROCESS:
+    try:
+        if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
+            base_dir = os.path.dirname(sys.executable)
+        else:
+            base_dir = os.path.dirname(os.path.abspath(__file__))
 
+        log_filename = f"{args.mode}_activity.log"
+        log_file_path = os.path.join(base_dir, log_filename)
 
-    logging.getLogger().addHandler(file_handler)
-    logging.getLogger().setLevel(initial_log_level)
+        initial_log_level = getattr(logging, (args.log_level or "INFO").upper(), logging.INFO)
+        logging_utils.add_log_file(log_file_path, initial_log_level)
+        logging_utils.setup_logging(initial_log_level)
 
-    log.info(f"--- Iniciando {APP_NAME} v{APP_VERSION} ({args.mode}) ---")
-    log.info(f"Logging em arquivo configurado para: {log_file_path}")
+        log.info(f"--- Iniciando {APP_NAME} v{APP_VERSION} ({args.mode}) ---")
+        log.info(f"Logging em arquivo configurado para: {log_file_path}")
 
-except Exception as log_setup_err:
-    log.exception("Erro crítico ao configurar logging em arquivo!")
+    except Exception as log_setup_err:
+        log.exception("Erro crítico ao configurar logging em arquivo!")
 
-    if getattr(sys, 'frozen', False) and sys.stdin is None:
-         try:
-             import ctypes
-             ctypes.windll.user32.MessageBoxW(0, f"Erro ao configurar logging em arquivo:\n{log_setup_err}", "Logging Error", 0x10)
-         except: pass
+        if getattr(sys, 'frozen', False) and sys.stdin is None:
+             try:
+                 import ctypes
+                 ctypes.windll.user32.MessageBoxW(0, f"Erro ao configurar logging em arquivo:\n{log_setup_err}", "Logging Error", 0x10)
+             except: pass
 
 
 
 import config_manager
-import client
-import server
+
+startup_timer = logging_utils.create_startup_timer(args.mode, STARTUP_STARTED_AT)
+logging_utils.mark_startup(startup_timer, "log")
 
 
 
@@ -176,9 +180,7 @@ def start_core_logic(mode, config):
 
         log_level_str = config.get("log_level", "INFO").upper()
         log_level = getattr(logging, log_level_str, logging.INFO)
-        logging.getLogger().setLevel(log_level)
-        for handler in logging.getLogger().handlers:
-            handler.setLevel(log_level)
+        logging_utils.setup_logging(log_level)
         log.info(f"Nível de log final definido para {log_level_str} ({log_level})")
 
 
@@ -239,6 +241,13 @@ if __name__ == "__main__":
 
     if args.log_level:
         log.info(f"Nível de log solicitado via argumento: {args.log_level}.")
+    logging_utils.mark_startup(startup_timer, "configuração")
+
+    if args.mode == 'client':
+        import client
+    else:
+        import server
+    logging_utils.mark_startup(startup_timer, "importação")
 
 
     run_bg = config.get('run_in_background', False)
@@ -252,6 +261,12 @@ if __name__ == "__main__":
     if run_bg:
 
         log.info("Modo 'run_in_background' ativo. Iniciando com ícone na bandeja.")
+        try:
+            from PIL import Image, ImageDraw
+            import pystray
+            HAS_TRAY_LIBS = True
+        except ImportError:
+            HAS_TRAY_LIBS = False
         if not HAS_TRAY_LIBS:
             err_msg = "Bibliotecas 'pystray' e 'Pillow' não encontradas. Não é possível rodar em background."
             log.critical(err_msg + " Instale com: pip install pystray Pillow")
@@ -306,6 +321,8 @@ if __name__ == "__main__":
         core_logic_thread.daemon = False
         core_logic_thread.start()
         log.info(f"Thread '{core_logic_thread.name}' iniciada. Iniciando loop da bandeja.")
+        logging_utils.mark_startup(startup_timer, "bandeja")
+        logging_utils.log_startup(startup_timer, log)
 
         try:
              tray_icon.run()
@@ -332,6 +349,9 @@ if __name__ == "__main__":
                      main_logic_instance_thread = server.server_state.get("listener_thread")
                      success = True
 
+            logging_utils.mark_startup(startup_timer, args.mode)
+            logging_utils.log_startup(startup_timer, log)
+
             if success and main_logic_instance_thread:
                  log.info(f"Lógica principal do {args.mode} iniciada. Pressione Ctrl+C para sair.")
                  while main_logic_instance_thread.is_alive():
@@ -0,0 +1,193 @@
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_METRICS_LISTEN_IP = '127.0.0.1'
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Registro único do processo. Enquanto o endpoint não é iniciado, as funções de
+# registro retornam imediatamente, sem custo perceptível no caminho dos jobs.
+registry = {
+    "enabled": False,
+    "lock": threading.Lock(),
+    "descriptions": {},
+    "counters": {},
+    "gauges": {},
+    "histograms": {},
+    "collectors": [],
+    "http_server": None,
+    "thread": None,
+}
+
+
+def describe(name, metric_type, help_text, buckets=None):
+    """Registra o tipo ('counter', 'gauge' ou 'histogram') e a descrição de uma métrica."""
+    registry["descriptions"][name] = (metric_type, help_text, tuple(buckets or DEFAULT_BUCKETS))
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    """Soma value ao contador name com os rótulos informados."""
+    if not registry["enabled"]:
+        return
+    key = (name, _label_key(labels))
+    with registry["lock"]:
+        registry["counters"][key] = registry["counters"].get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    """Define o valor atual do medidor name."""
+    if not registry["enabled"]:
+        return
+    with registry["lock"]:
+        registry["gauges"][(name, _label_key(labels))] = value
+
+def observe(name, value, **labels):
+    """Registra uma amostra no histograma name."""
+    if not registry["enabled"]:
+        return
+    buckets = registry["descriptions"].get(name, (None, None, DEFAULT_BUCKETS))[2]
+    key = (name, _label_key(labels))
+    with registry["lock"]:
+        histogram = registry["histograms"].get(key)
+        if histogram is None:
+            histogram = registry["histograms"][key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        index = bisect.bisect_left(histogram["buckets"], value)
+        if index < len(histogram["counts"]):
+            histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+def register_collector(collector):
+    """
+    Registra uma função chamada a cada coleta, para atualizar medidores cujo
+    valor só é lido sob demanda (profundidade de filas, clientes conectados...).
+    """
+    registry["collectors"].append(collector)
+
+def timed():
+    """Retorna o tempo de CPU da thread atual, para medir o custo de operações (ver add_cpu_time)."""
+    return time.thread_time() if registry["enabled"] else 0.0
+
+def add_cpu_time(name, started, **labels):
+    """Soma ao contador name o tempo de CPU da thread desde started (valor de timed())."""
+    if registry["enabled"]:
+        inc(name, time.thread_time() - started, **labels)
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    """Monta o texto das métricas no formato de exposição do Prometheus."""
+    for collector in list(registry["collectors"]):
+        try:
+            collector()
+        except Exception as e:
+            log.warning(f"Erro ao coletar métricas: {e}")
+
+    with registry["lock"]:
+        series = {}
+        for (name, label_key), value in registry["counters"].items():
+            series.setdefault(name, []).append((label_key, value))
+        for (name, label_key), value in registry["gauges"].items():
+            series.setdefault(name, []).append((label_key, value))
+        for (name, label_key), histogram in registry["histograms"].items():
+            series.setdefault(name, []).append((label_key, dict(histogram, counts=list(histogram["counts"]))))
+
+    lines = []
+    for name in sorted(series):
+        metric_type, help_text, _ = registry["descriptions"].get(name, ("untyped", "", None))
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for label_key, value in sorted(series[name], key=lambda item: item[0]):
+            if isinstance(value, dict):
+                cumulative = 0
+                for bound, count in zip(value["buckets"], value["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(label_key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(label_key, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{_format_labels(label_key)} {_format_value(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(label_key)} {value['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(label_key)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _create_request_handler():
+    """
+    Cria a classe que responde GET /metrics com o texto das métricas.
+
+    http.server só é importado aqui, quando o endpoint é ativado, para não
+    pesar na inicialização de quem não usa métricas.
+    """
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(f"Métricas: {self.address_string()} {format % args}")
+
+    return http.server.ThreadingHTTPServer, MetricsRequestHandler
+
+
+def start_metrics_server(port, host=DEFAULT_METRICS_LISTEN_IP):
+    """
+    Ativa a coleta de métricas e inicia o endpoint HTTP em uma thread própria.
+
+    Returns:
+        bool: True se o endpoint foi iniciado.
+    """
+    server_class, handler_class = _create_request_handler()
+    try:
+        http_server = server_class((host, port), handler_class)
+    except OSError as e:
+        log.error(f"Não foi possível iniciar o endpoint de métricas em {host}:{port}: {e}")
+        return False
+    http_server.daemon_threads = True
+    registry["enabled"] = True
+    registry["http_server"] = http_server
+    thread = threading.Thread(target=http_server.serve_forever, name="MetricsHTTPServer", daemon=True)
+    registry["thread"] = thread
+    thread.start()
+    log.info(f"Métricas disponíveis em http://{host}:{http_server.server_address[1]}/metrics")
+    return True
+
+def stop_metrics_server():
+    """Encerra o endpoint HTTP e desativa a coleta."""
+    registry["enabled"] = False
+    http_server = registry["http_server"]
+    if http_server:
+        http_server.shutdown()
+        http_server.server_close()
+        registry["http_server"] = None
+    thread = registry["thread"]
+    if thread and thread.is_alive():
+        thread.join(timeout=2.0)
+    registry["thread"] = None
+    registry["collectors"] = []
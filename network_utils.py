@@ -2,6 +2,7 @@ import socket
 import time
 import select
 import logging
+import random
 import struct
 
 log = logging.getLogger(__name__)
@@ -9,6 +10,20 @@ log = logging.getLogger(__name__)
 
 MSG_LEN_HEADER_FORMAT = '!I'
 MSG_LEN_HEADER_SIZE = struct.calcsize(MSG_LEN_HEADER_FORMAT)
+DEFAULT_RECEIVE_BUFFER_SIZE = 64 * 1024
+# Maior frame aceito pelo decodificador; um cabeçalho acima disso indica fluxo
+# corrompido ou hostil, e a conexão é encerrada em vez de alocar o buffer.
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+DEFAULT_SEND_BATCH_BYTES = 64 * 1024
+# Limite de buffers por chamada a sendmsg (IOV_MAX do sistema).
+MAX_SEND_BUFFERS = 1024
+# TCP keepalive: segundos sem tráfego até a primeira sonda, intervalo entre
+# sondas e quantas sondas sem resposta derrubam a conexão.
+DEFAULT_KEEPALIVE_IDLE = 30.0
+DEFAULT_KEEPALIVE_INTERVAL = 10.0
+DEFAULT_KEEPALIVE_COUNT = 3
+# Teto da espera entre tentativas de conexão, que dobra a cada falha.
+DEFAULT_RECONNECT_MAX_INTERVAL = 60.0
 
 def start_server_socket(host, port):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -25,6 +40,47 @@ def start_server_socket(host, port):
         log.error(f"Erro inesperado ao iniciar o servidor em {host}:{port}: {e}")
         return None
 
+def enable_keepalive(sock, idle=DEFAULT_KEEPALIVE_IDLE, interval=DEFAULT_KEEPALIVE_INTERVAL, count=DEFAULT_KEEPALIVE_COUNT):
+    """
+    Ativa o TCP keepalive no socket, para que o sistema detecte conexões mortas
+    sem tráfego da aplicação.
+
+    Returns:
+        bool: True se o keepalive foi ativado com os tempos pedidos.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(interval)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max(1, int(count)))
+        elif hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle * 1000), int(interval * 1000)))
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, max(1, int(idle)))
+        else:
+            log.debug("Sistema sem ajuste dos tempos de TCP keepalive. Usando os padrões do sistema.")
+            return False
+        return True
+    except (OSError, AttributeError, ValueError) as e:
+        log.warning(f"Não foi possível ativar TCP keepalive: {e}")
+        return False
+
+def backoff_delay(attempt, base_interval, max_interval=DEFAULT_RECONNECT_MAX_INTERVAL):
+    """
+    Espera antes de uma nova tentativa de conexão: exponencial com jitter total.
+
+    O teto dobra a cada falha (base_interval, 2 * base_interval, ... até
+    max_interval), e a espera é sorteada entre zero e o teto. Assim, quando um
+    servidor volta, os clientes que caíram juntos reconectam espalhados em vez
+    de todos ao mesmo tempo.
+
+    Args:
+        attempt (int): Falhas consecutivas até agora (0 para a primeira nova tentativa).
+    """
+    ceiling = min(max_interval, base_interval * (2 ** min(attempt, 32)))
+    return random.uniform(0, ceiling)
+
 def connect_to_server(server_ip, server_port, retry_interval=5.0, max_retries=3):
     attempts = 0
     max_retries = max_retries if max_retries is not None and max_retries > 0 else float('inf')
@@ -49,8 +105,9 @@ def connect_to_server(server_ip, server_port, retry_interval=5.0, max_retries=3)
             attempts += 1
 
         if attempts < max_retries:
-            log.info(f"Próxima tentativa de conexão em {retry_interval} segundos...")
-            time.sleep(retry_interval)
+            delay = backoff_delay(attempts - 1, retry_interval)
+            log.info(f"Próxima tentativa de conexão em {delay:.1f} segundos...")
+            time.sleep(delay)
 
     log.error("Máximo de tentativas de conexão atingido. Desistindo.")
     return None
@@ -63,8 +120,8 @@ def send_data(sock, data_bytes):
 
     try:
         message_len_header = struct.pack(MSG_LEN_HEADER_FORMAT, len(data_bytes))
-        sock.sendall(message_len_header + data_bytes)
-        log.debug(f"Enviados {len(message_len_header)} bytes de cabeçalho e {len(data_bytes)} bytes de dados.")
+        _send_buffers(sock, [message_len_header, data_bytes])
+        log.debug("Enviados %d bytes de cabeçalho e %d bytes de dados.", len(message_len_header), len(data_bytes))
         return True
     except socket.error as e:
         log.error(f"Erro de socket ao enviar dados: {e}")
@@ -73,36 +130,291 @@ def send_data(sock, data_bytes):
         log.error(f"Erro inesperado ao enviar dados: {e}")
         return False
 
+def _send_waiting(sock, data):
+    """
+    Envia todos os bytes, aguardando o socket ficar disponível para escrita caso
+    ele esteja em modo não bloqueante.
+    """
+    view = memoryview(data)
+    while view:
+        try:
+            sent = sock.send(view)
+        except BlockingIOError:
+            select.select([], [sock], [], None)
+            continue
+        view = view[sent:]
+
+def _send_buffers(sock, buffers):
+    """
+    Envia uma sequência de buffers sem concatená-los, com sendmsg (scatter/gather).
+
+    Envios parciais são retomados a partir do ponto em que pararam. Em sistemas
+    sem sendmsg (Windows) os buffers são unidos e enviados de uma vez.
+    """
+    if not hasattr(sock, "sendmsg"):
+        _send_waiting(sock, b"".join(buffers))
+        return
+
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    index = 0
+    while index < len(views):
+        try:
+            sent = sock.sendmsg(views[index:index + MAX_SEND_BUFFERS])
+        except BlockingIOError:
+            select.select([], [sock], [], None)
+            continue
+        while sent:
+            view = views[index]
+            if sent >= len(view):
+                sent -= len(view)
+                index += 1
+            else:
+                views[index] = view[sent:]
+                sent = 0
+
+def create_frame_sender(sock, max_batch_bytes=DEFAULT_SEND_BATCH_BYTES):
+    """
+    Cria um acumulador de mensagens para envio em lote em um socket.
+
+    Mensagens enfileiradas com queue_frame são enviadas juntas por flush_frames
+    em uma única chamada a sendmsg, o que reduz chamadas de sistema e segmentos
+    TCP quando há muitas mensagens pequenas.
+
+    Args:
+        sock (socket.socket): Socket de destino.
+        max_batch_bytes (int): Volume acumulado que força o envio imediato do lote.
+    """
+    return {
+        "sock": sock,
+        "buffers": [],
+        "queued_bytes": 0,
+        "max_batch_bytes": max_batch_bytes,
+        "first_queued_at": None,
+    }
+
+def queue_frame(sender, data_bytes):
+    """
+    Enfileira uma mensagem (com seu cabeçalho de tamanho) no lote do socket.
+
+    Returns:
+        bool: False se um envio forçado pelo tamanho do lote falhou.
+    """
+    if not sender["buffers"]:
+        sender["first_queued_at"] = time.time()
+    sender["buffers"].append(struct.pack(MSG_LEN_HEADER_FORMAT, len(data_bytes)))
+    sender["buffers"].append(data_bytes)
+    sender["queued_bytes"] += MSG_LEN_HEADER_SIZE + len(data_bytes)
+    if sender["queued_bytes"] >= sender["max_batch_bytes"]:
+        return flush_frames(sender)
+    return True
+
+def flush_frames(sender):
+    """
+    Envia todas as mensagens enfileiradas.
+
+    Returns:
+        bool: True em caso de sucesso (ou lote vazio), False em caso de erro de socket.
+    """
+    if not sender["buffers"]:
+        return True
+    buffers = sender["buffers"]
+    queued_bytes = sender["queued_bytes"]
+    sender["buffers"] = []
+    sender["queued_bytes"] = 0
+    sender["first_queued_at"] = None
+    try:
+        _send_buffers(sender["sock"], buffers)
+        log.debug("Enviadas %d mensagens em lote (%d bytes).", len(buffers) // 2, queued_bytes)
+        return True
+    except socket.error as e:
+        log.error(f"Erro de socket ao enviar lote de mensagens: {e}")
+        return False
+    except Exception as e:
+        log.error(f"Erro inesperado ao enviar lote de mensagens: {e}")
+        return False
+
+def create_frame_decoder(read_size=DEFAULT_RECEIVE_BUFFER_SIZE, max_frame_size=MAX_FRAME_SIZE):
+    """
+    Cria o decodificador incremental de frames (cabeçalho de tamanho + corpo) de uma conexão.
+
+    O progresso do cabeçalho e do corpo do frame em andamento fica guardado
+    entre as leituras: um frame que chega aos pedaços nunca bloqueia quem lê
+    nem é perdido. O mesmo estado serve ao motor de threads (receive_frames,
+    após select) e ao asyncio (feed_frames com os bytes do StreamReader).
+    """
+    return {
+        "header": bytearray(MSG_LEN_HEADER_SIZE),
+        "header_received": 0,
+        "body": None,
+        "body_received": 0,
+        "max_frame_size": max_frame_size,
+        "read_buffer": bytearray(read_size),
+    }
+
+def _start_frame_body(decoder):
+    message_len = struct.unpack(MSG_LEN_HEADER_FORMAT, decoder["header"])[0]
+    if message_len > decoder["max_frame_size"]:
+        raise ValueError(f"Frame de {message_len} bytes excede o limite de {decoder['max_frame_size']} bytes.")
+    decoder["header_received"] = 0
+    decoder["body"] = bytearray(message_len)
+    decoder["body_received"] = 0
+
+def feed_frames(decoder, data):
+    """
+    Consome bytes recebidos da conexão, em qualquer fragmentação.
+
+    Returns:
+        list: As mensagens (bytearray) completadas por estes bytes, em ordem.
+              Frames vazios são descartados.
+
+    Raises:
+        ValueError: Se um cabeçalho anuncia um frame maior que o limite.
+    """
+    messages = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        if decoder["body"] is None:
+            received = decoder["header_received"]
+            count = min(MSG_LEN_HEADER_SIZE - received, len(view) - offset)
+            decoder["header"][received:received + count] = view[offset:offset + count]
+            decoder["header_received"] += count
+            offset += count
+            if decoder["header_received"] < MSG_LEN_HEADER_SIZE:
+                break
+            _start_frame_body(decoder)
+
+        body = decoder["body"]
+        received = decoder["body_received"]
+        count = min(len(body) - received, len(view) - offset)
+        body[received:received + count] = view[offset:offset + count]
+        decoder["body_received"] += count
+        offset += count
+        if decoder["body_received"] == len(body):
+            decoder["body"] = None
+            if body:
+                messages.append(body)
+    return messages
+
+def frame_in_progress(decoder):
+    """True se o decodificador tem um frame parcialmente recebido."""
+    return decoder["body"] is not None or decoder["header_received"] > 0
+
+def receive_frames(sock, decoder):
+    """
+    Lê o que já chegou no socket, com uma única chamada a recv, e decodifica os frames.
+
+    Deve ser chamada com o socket pronto para leitura (select) ou não
+    bloqueante: nunca espera pelo restante de um frame, que fica no
+    decodificador até a próxima chamada. O corpo de um frame grande é lido
+    direto no buffer da mensagem, sem cópia intermediária.
+
+    Returns:
+        list: Mensagens completas (pode ser vazia).
+        None: Se a conexão foi fechada pelo outro lado, ocorreu um erro ou
+              o fluxo é inválido.
+    """
+    body = decoder["body"]
+    try:
+        if body is not None and len(body) - decoder["body_received"] >= len(decoder["read_buffer"]):
+            count = sock.recv_into(memoryview(body)[decoder["body_received"]:])
+            if count:
+                decoder["body_received"] += count
+                if decoder["body_received"] < len(body):
+                    return []
+                decoder["body"] = None
+                return [body]
+        else:
+            count = sock.recv_into(decoder["read_buffer"])
+    except (BlockingIOError, InterruptedError):
+        return []
+    except socket.error as e:
+        log.error(f"Erro de socket ao receber dados: {e}")
+        return None
+
+    if not count:
+        if frame_in_progress(decoder):
+            log.warning("Conexão fechada pelo outro lado no meio de uma mensagem.")
+        return None
+    try:
+        return feed_frames(decoder, memoryview(decoder["read_buffer"])[:count])
+    except ValueError as e:
+        log.error(f"Fluxo de mensagens inválido: {e}")
+        return None
+
+def _recv_into_waiting(sock, view, timeout, ready=False):
+    """
+    Preenche `view` inteira com recv_into, aguardando até `timeout` segundos
+    por cada parte que ainda não chegou. O socket continua em modo bloqueante;
+    a espera é feita com select antes de cada leitura.
+
+    Returns:
+        bool: True se preencheu, False se a conexão foi fechada pelo outro lado.
+    """
+    received = 0
+    while received < len(view):
+        if not ready:
+            ready_to_read, _, _ = select.select([sock], [], [], timeout)
+            if not ready_to_read:
+                raise socket.timeout("Timeout aguardando o restante da mensagem.")
+        ready = False
+        count = sock.recv_into(view[received:])
+        if not count:
+            return False
+        received += count
+    return True
+
+def peer_closed(sock, timeout):
+    """
+    Aguarda até timeout segundos e verifica, sem consumir dados, se o outro
+    lado encerrou a conexão normalmente (sem enviar nada).
+
+    Returns:
+        bool: True só em um encerramento normal (EOF). False se chegaram
+              dados, se o tempo acabou ou se houve um erro de rede.
+    """
+    try:
+        ready_to_read, _, _ = select.select([sock], [], [], timeout)
+        if not ready_to_read:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except OSError:
+        return False
+
 def receive_data(sock, timeout=1.0):
-    sock.setblocking(0)
+    """
+    Recebe uma mensagem completa (cabeçalho de tamanho + corpo), aguardando por ela.
+
+    O corpo é lido com recv_into diretamente em um buffer do tamanho anunciado.
+    Usada nas trocas de pergunta e resposta da abertura da conexão; para ler
+    continuamente sem bloquear, use create_frame_decoder e receive_frames.
+
+    Returns:
+        A mensagem recebida; b'' se nada chegou em `timeout` segundos;
+        None se a conexão foi fechada ou ocorreu um erro.
+    """
     ready_to_read, _, _ = select.select([sock], [], [], timeout)
 
     if not ready_to_read:
         return b''
 
-    header_data = b''
-    bytes_to_read = MSG_LEN_HEADER_SIZE
+    header_data = bytearray(MSG_LEN_HEADER_SIZE)
     try:
-        while len(header_data) < bytes_to_read:
-            chunk = sock.recv(bytes_to_read - len(header_data))
-            if not chunk:
-                log.warning("Conexão fechada pelo outro lado enquanto lia o cabeçalho.")
-                return None
-            header_data += chunk
+        if not _recv_into_waiting(sock, memoryview(header_data), timeout, ready=True):
+            log.warning("Conexão fechada pelo outro lado enquanto lia o cabeçalho.")
+            return None
         message_len = struct.unpack(MSG_LEN_HEADER_FORMAT, header_data)[0]
-        log.debug(f"Cabeçalho recebido indica mensagem de {message_len} bytes.")
-
-        message_data = b''
-        bytes_to_read = message_len
-        while len(message_data) < bytes_to_read:
-            chunk_size = min(bytes_to_read - len(message_data), 4096)
-            chunk = sock.recv(chunk_size)
-            if not chunk:
-                log.warning("Conexão fechada pelo outro lado enquanto lia o corpo da mensagem.")
-                return None
-            message_data += chunk
-
-        log.debug(f"Recebidos {len(message_data)} bytes de dados.")
+        log.debug("Cabeçalho recebido indica mensagem de %d bytes.", message_len)
+        if message_len > MAX_FRAME_SIZE:
+            log.error(f"Mensagem de {message_len} bytes excede o limite de {MAX_FRAME_SIZE} bytes.")
+            return None
+
+        message_data = bytearray(message_len)
+        if not _recv_into_waiting(sock, memoryview(message_data), timeout):
+            log.warning("Conexão fechada pelo outro lado enquanto lia o corpo da mensagem.")
+            return None
+
+        log.debug("Recebidos %d bytes de dados.", message_len)
         return message_data
 
     except socket.error as e:
@@ -114,8 +426,6 @@ def receive_data(sock, timeout=1.0):
     except Exception as e:
         log.error(f"Erro inesperado ao receber dados: {e}")
         return None
-    finally:
-         pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,281 @@
+import json
+import logging
+import struct
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+PROTOCOL_VERSION = 2
+
+SESSION_HELLO_MAGIC = b"NPR2"
+
+# Troca de chaves por impressão digital: o cliente apresenta as impressões
+# digitais (SHA-256) da sua chave e da chave do servidor que já conhece. Se o
+# servidor não tiver a chave do cliente em cache, pede o PEM completo; se a
+# chave do servidor conhecida pelo cliente for a atual, responde só com a
+# impressão digital em vez do PEM.
+KEY_FINGERPRINT_MAGIC = b"NPRF"
+KEY_REQUEST_MAGIC = b"NPRK"
+KEY_FINGERPRINT_SIZE = 32
+
+# Retomada de sessão: no lugar da troca de chaves, o cliente apresenta o ticket
+# recebido na sessão anterior, um valor aleatório e o hello cifrado com a chave
+# derivada de ambos. Se o servidor recusar o ticket, responde com
+# TICKET_REJECTED_MAGIC e a troca de chaves segue normalmente na mesma conexão.
+SESSION_RESUME_MAGIC = b"NPRT"
+TICKET_REJECTED_MAGIC = b"NPRX"
+TICKET_LENGTH_FORMAT = '!H'
+TICKET_LENGTH_SIZE = struct.calcsize(TICKET_LENGTH_FORMAT)
+RESUME_RANDOM_SIZE = 16
+DEFAULT_SESSION_TICKET_LIFETIME = 24 * 3600
+
+LEGACY_CHUNK_SIZE = 190
+DEFAULT_SESSION_CHUNK_SIZE = 32 * 1024
+SESSION_NEGOTIATION_TIMEOUT = 5.0
+
+# Registros transportados dentro das mensagens cifradas do modo de sessão.
+RECORD_HEADER_FORMAT = '!BB'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+RECORD_DATA = 1
+RECORD_PING = 2
+RECORD_ACK = 3
+RECORD_PONG = 4
+RECORD_FLAG_JOB_END = 0x01
+RECORD_FLAG_COMPRESSED = 0x02
+RECORD_FLAG_CHANNEL = 0x04
+
+# Número de sequência do job, presente no início de cada registro de dados (e
+# no registro de confirmação) quando a sessão negocia confirmações. Zero indica
+# um job sem sequência, que é escrito mas nunca confirmado.
+RECORD_SEQ_FORMAT = '!Q'
+RECORD_SEQ_SIZE = struct.calcsize(RECORD_SEQ_FORMAT)
+
+DEFAULT_ACK_WINDOW = 64
+
+# Canal (porta serial do cliente) de um registro de dados ou de confirmação,
+# presente antes da sequência quando o registro tem RECORD_FLAG_CHANNEL. Sem a
+# flag, o registro é do canal 0 (a porta principal). Os demais canais são
+# declarados no hello, cada um com seu próprio fluxo e fila.
+CHANNEL_FORMAT = '!B'
+CHANNEL_SIZE = struct.calcsize(CHANNEL_FORMAT)
+MAX_CHANNEL_ID = 255
+
+# Keep-alive do modo de sessão: o ping leva o instante do envio (relógio
+# monotônico do cliente), que o servidor devolve em um pong para a medição do
+# RTT. Pings vazios (clientes anteriores) não recebem resposta.
+PING_TIMESTAMP_FORMAT = '!d'
+DEFAULT_KEEP_ALIVE_INTERVAL = 5.0
+# Payload do ping do modo legado (RSA por chunk), que nunca é escrito na serial.
+LEGACY_PING = b'\x00\x00\x00\x00'
+MAX_STREAM_ID_LENGTH = 64
+
+# Compressão dos registros de dados, negociada no hello da sessão. O fluxo
+# deflate é único por conexão (o contexto aprende com os jobs anteriores) e é
+# iniciado com um dicionário de comandos comuns de ZPL, PCL/PJL e ESC/POS.
+COMPRESSION_ZLIB = "zlib-npr1"
+DEFAULT_COMPRESSION_LEVEL = 6
+COMPRESSION_WBITS = -15
+COMPRESSION_DICTIONARY = (
+    b"\x1b@\x1ba\x00\x1ba\x01\x1bE\x01\x1bE\x00\x1b!\x00\x1b!\x30\x1dV\x00\x1dVA\x00\x1dk\x04\x1dh\x50\x1dw\x02"
+    b"\x1b%-12345X@PJL JOB NAME=\"\"\r\n@PJL SET COPIES=1\r\n@PJL ENTER LANGUAGE=PCL\r\n\x1bE\x1b&l0O\x1b&l26A"
+    b"\x1b(s0p10h12v0s0b3T\x1b*p0x0Y\x1b*t300R\x1b*r1A\x1b*b0M\x1b*rB\x1bE\x1b%-12345X@PJL EOJ\r\n"
+    b"^XA^MMT^PW812^LL1218^LS0^LH0,0^CI28^PON^PMN^MNY^MTD^JMA^PR4,4^MD0^JUS^LRN^FWN^CF0,30"
+    b"^BY3,3,100^BCN,100,Y,N,N^BQN,2,6^BXN,6,200^B3N,N,100,Y,N^FR^GB812,0,3^GFA,"
+    b"^FO50,50^GB700,3,3^FS^FO50,100^A0N,30,30^FD^FS^FO50,150^A0N,40,40^FD^FS"
+    b"^FT50,200^A0N,28,28^FH\\^FD^FS^FO400,50^BCN,80,Y,N,N^FD^FS^PQ1,0,1,Y^XZ"
+)
+
+MAX_SERVER_JOB_SIZE = 16 * 1024 * 1024
+
+
+def build_session_hello(encrypted_session_key, encrypted_hello):
+    """
+    Monta a mensagem de abertura de sessão enviada pelo cliente após a troca de chaves.
+
+    Formato: SESSION_HELLO_MAGIC + chave de sessão cifrada com RSA (tamanho da
+    chave do servidor) + mensagem de hello cifrada com a chave de sessão.
+    """
+    return SESSION_HELLO_MAGIC + encrypted_session_key + encrypted_hello
+
+def parse_session_hello(message, rsa_block_size):
+    """
+    Separa uma mensagem de abertura de sessão em suas partes.
+
+    Pacotes do modo legado (RSA por chunk) têm exatamente rsa_block_size bytes,
+    então qualquer mensagem desse tamanho nunca é confundida com um hello.
+
+    Returns:
+        tuple: (chave de sessão cifrada, hello cifrado), ou None se a mensagem
+               não for um hello de sessão.
+    """
+    header_size = len(SESSION_HELLO_MAGIC)
+    if len(message) <= header_size + rsa_block_size:
+        return None
+    if bytes(message[:header_size]) != SESSION_HELLO_MAGIC:
+        return None
+    encrypted_session_key = bytes(message[header_size:header_size + rsa_block_size])
+    encrypted_hello = message[header_size + rsa_block_size:]
+    return encrypted_session_key, encrypted_hello
+
+def build_fingerprint_hello(client_fingerprint, server_fingerprint=None):
+    """Monta a abertura da troca de chaves por impressão digital."""
+    return KEY_FINGERPRINT_MAGIC + client_fingerprint + (server_fingerprint or bytes(KEY_FINGERPRINT_SIZE))
+
+def parse_fingerprint_hello(message):
+    """
+    Separa a abertura da troca de chaves por impressão digital.
+
+    Returns:
+        tuple: (impressão digital do cliente, impressão digital do servidor ou
+               None), ou None se a mensagem for um PEM comum.
+    """
+    header_size = len(KEY_FINGERPRINT_MAGIC)
+    if len(message) != header_size + 2 * KEY_FINGERPRINT_SIZE:
+        return None
+    if bytes(message[:header_size]) != KEY_FINGERPRINT_MAGIC:
+        return None
+    client_fingerprint = bytes(message[header_size:header_size + KEY_FINGERPRINT_SIZE])
+    server_fingerprint = bytes(message[header_size + KEY_FINGERPRINT_SIZE:])
+    if server_fingerprint == bytes(KEY_FINGERPRINT_SIZE):
+        server_fingerprint = None
+    return client_fingerprint, server_fingerprint
+
+def build_fingerprint_reply(server_fingerprint):
+    """Monta a resposta que confirma a chave do servidor já conhecida pelo cliente."""
+    return KEY_FINGERPRINT_MAGIC + server_fingerprint
+
+def parse_fingerprint_reply(message):
+    """Retorna a impressão digital confirmada pelo servidor, ou None se a resposta for um PEM."""
+    header_size = len(KEY_FINGERPRINT_MAGIC)
+    if len(message) != header_size + KEY_FINGERPRINT_SIZE:
+        return None
+    if bytes(message[:header_size]) != KEY_FINGERPRINT_MAGIC:
+        return None
+    return bytes(message[header_size:])
+
+def build_resume_hello(ticket, client_random, encrypted_hello):
+    """Monta a mensagem de retomada de sessão."""
+    return (SESSION_RESUME_MAGIC + struct.pack(TICKET_LENGTH_FORMAT, len(ticket))
+            + ticket + client_random + encrypted_hello)
+
+def parse_resume_hello(message):
+    """
+    Separa uma mensagem de retomada de sessão em suas partes.
+
+    Returns:
+        tuple: (ticket, valor aleatório do cliente, hello cifrado), ou None se a
+               mensagem não for uma retomada.
+    """
+    header_size = len(SESSION_RESUME_MAGIC) + TICKET_LENGTH_SIZE
+    if len(message) <= header_size or bytes(message[:len(SESSION_RESUME_MAGIC)]) != SESSION_RESUME_MAGIC:
+        return None
+    ticket_size = struct.unpack_from(TICKET_LENGTH_FORMAT, message, len(SESSION_RESUME_MAGIC))[0]
+    random_start = header_size + ticket_size
+    hello_start = random_start + RESUME_RANDOM_SIZE
+    if len(message) <= hello_start:
+        return None
+    return (bytes(message[header_size:random_start]),
+            bytes(message[random_start:hello_start]),
+            message[hello_start:])
+
+def pack_record(record_type, flags, payload=b''):
+    """Monta um registro (tipo, flags, conteúdo) para ser cifrado com a sessão."""
+    return struct.pack(RECORD_HEADER_FORMAT, record_type, flags) + payload
+
+def unpack_record(plaintext):
+    """
+    Separa um registro descriptografado em suas partes.
+
+    Returns:
+        tuple: (tipo, flags, conteúdo como memoryview), ou None se o registro for inválido.
+    """
+    if len(plaintext) < RECORD_HEADER_SIZE:
+        log.error(f"Registro muito curto ({len(plaintext)} bytes).")
+        return None
+    record_type, flags = struct.unpack_from(RECORD_HEADER_FORMAT, plaintext)
+    return record_type, flags, memoryview(plaintext)[RECORD_HEADER_SIZE:]
+
+def pack_sequenced(seq, payload=b''):
+    """Prefixa o conteúdo de um registro com o número de sequência do job."""
+    return struct.pack(RECORD_SEQ_FORMAT, seq) + payload
+
+def unpack_sequenced(payload):
+    """
+    Separa o número de sequência do conteúdo de um registro.
+
+    Returns:
+        tuple: (sequência, restante como memoryview), ou None se o registro for curto demais.
+    """
+    if len(payload) < RECORD_SEQ_SIZE:
+        log.error(f"Registro sem número de sequência ({len(payload)} bytes).")
+        return None
+    seq = struct.unpack_from(RECORD_SEQ_FORMAT, payload)[0]
+    return seq, memoryview(payload)[RECORD_SEQ_SIZE:]
+
+def pack_channel(channel, payload=b''):
+    """Prefixa o conteúdo de um registro com o canal."""
+    return struct.pack(CHANNEL_FORMAT, channel) + payload
+
+def unpack_channel(payload):
+    """
+    Separa o canal do conteúdo de um registro.
+
+    Returns:
+        tuple: (canal, restante como memoryview), ou None se o registro for curto demais.
+    """
+    if len(payload) < CHANNEL_SIZE:
+        log.error("Registro sem o canal esperado.")
+        return None
+    return struct.unpack_from(CHANNEL_FORMAT, payload)[0], memoryview(payload)[CHANNEL_SIZE:]
+
+def create_compressor(level=DEFAULT_COMPRESSION_LEVEL):
+    """Cria o compressor deflate de uma conexão, iniciado com o dicionário de comandos."""
+    return zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS, zdict=COMPRESSION_DICTIONARY)
+
+def create_decompressor():
+    """Cria o descompressor correspondente a create_compressor."""
+    return zlib.decompressobj(COMPRESSION_WBITS, zdict=COMPRESSION_DICTIONARY)
+
+def compress_payload(compressor, data):
+    """
+    Comprime o conteúdo de um registro no fluxo da conexão.
+
+    O flush síncrono garante que o receptor consiga descomprimir o registro
+    inteiro assim que ele chega, sem esperar pelos seguintes.
+    """
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def decompress_payload(decompressor, data, max_size):
+    """
+    Descomprime o conteúdo de um registro no fluxo da conexão.
+
+    Returns:
+        bytes: Os dados originais, ou None se o fluxo é inválido ou o registro
+               descomprimido excede max_size bytes.
+    """
+    try:
+        plaintext = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        log.error(f"Erro ao descomprimir registro: {e}")
+        return None
+    if decompressor.unconsumed_tail:
+        log.error(f"Registro descomprimido excede o limite de {max_size} bytes.")
+        return None
+    return plaintext
+
+def encode_control(payload):
+    """Serializa uma mensagem de controle (dict) para bytes."""
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+def decode_control(data):
+    """Desserializa uma mensagem de controle. Retorna None se inválida."""
+    try:
+        payload = json.loads(bytes(data).decode('utf-8'))
+    except (ValueError, UnicodeDecodeError) as e:
+        log.error(f"Mensagem de controle inválida: {e}")
+        return None
+    if not isinstance(payload, dict):
+        log.error("Mensagem de controle inválida: esperado um objeto JSON.")
+        return None
+    return payload
@@ -80,6 +80,43 @@ def read_from_serial(ser, buffer_size=1024):
         log.error(f"Erro inesperado ao ler da serial {ser.port}: {e}")
         return None
 
+def read_available(ser, buffer_size=1024):
+    """
+    Aguarda dados na porta serial e retorna tudo o que já chegou.
+
+    Bloqueia até o timeout de leitura da porta pelo primeiro byte (sem consumir
+    CPU enquanto a porta está ociosa) e, em seguida, lê sem esperar os bytes que
+    já estão no buffer do sistema, até buffer_size.
+
+    Args:
+        ser (serial.Serial): Objeto da porta serial aberta (com timeout de leitura definido).
+        buffer_size (int): Tamanho máximo de bytes a retornar de uma vez.
+
+    Returns:
+        bytes: Dados lidos. Retorna b'' se o timeout expirou sem dados.
+               Retorna None em caso de erro grave na porta.
+    """
+    if not ser or not ser.is_open:
+        log.error("Tentativa de leitura em porta serial inválida ou fechada.")
+        return None
+    try:
+        data = ser.read(1)
+        if not data:
+            return b''
+        bytes_waiting = ser.in_waiting
+        if bytes_waiting > 0 and buffer_size > 1:
+            data += ser.read(min(bytes_waiting, buffer_size - 1))
+        return data
+    except serial.SerialException as e:
+        log.error(f"Erro de SerialException ao ler da porta {ser.port}: {e}")
+        return None
+    except OSError as e:
+         log.error(f"Erro de OSError ao ler da porta {ser.port}: {e}")
+         return None
+    except Exception as e:
+        log.error(f"Erro inesperado ao ler da serial {ser.port}: {e}")
+        return None
+
 def write_to_serial(ser, data_bytes):
     """
     Escreve dados (bytes) na porta serial.
@@ -102,7 +139,7 @@ def write_to_serial(ser, data_bytes):
         bytes_written = ser.write(data_bytes)
 
 
-        log.debug(f"{bytes_written}/{len(data_bytes)} bytes escritos na porta serial {ser.port}.")
+        log.debug("%s/%d bytes escritos na porta serial %s.", bytes_written, len(data_bytes), ser.port)
         if bytes_written != len(data_bytes):
              log.warning(f"Escrita incompleta na porta serial {ser.port}: {bytes_written}/{len(data_bytes)} bytes.")
 
@@ -0,0 +1,303 @@
+import collections
+import logging
+import threading
+import time
+
+import logging_utils
+import metrics
+import serial_utils
+import spool
+import tracing
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_JOBS_PER_CLIENT = 8
+DEFAULT_REOPEN_INTERVAL = 5.0
+
+metrics.describe("npr_serial_bytes_written_total", "counter", "Bytes escritos na serial, por porta e cliente.")
+metrics.describe("npr_serial_jobs_written_total", "counter", "Jobs escritos na serial, por porta e cliente.")
+metrics.describe("npr_serial_write_seconds", "histogram", "Duração da escrita de um job na serial, por porta.")
+metrics.describe("npr_serial_queue_jobs", "gauge", "Jobs aguardando escrita, por porta.")
+metrics.describe("npr_serial_spool_pending_jobs", "gauge", "Jobs guardados no spool aguardando a porta, por porta.")
+metrics.describe("npr_jobs_dropped_total", "counter", "Jobs perdidos (não escritos nem guardados no spool), por porta.")
+
+
+def create_port_writer(name, open_port, max_jobs_per_client=DEFAULT_MAX_JOBS_PER_CLIENT,
+                       job_spool=None, reopen_interval=DEFAULT_REOPEN_INTERVAL,
+                       summary_interval=logging_utils.DEFAULT_SUMMARY_INTERVAL):
+    """
+    Cria o estado de um escritor dedicado para uma porta serial.
+
+    O escritor é o único dono da porta: os clientes apenas enfileiram jobs, que
+    são escritos por uma thread própria, um job inteiro por vez, alternando
+    entre os clientes com jobs pendentes (round-robin).
+
+    Args:
+        name (str): Nome da porta, usado nos logs.
+        open_port (callable): Função sem argumentos que abre a porta e retorna
+            o objeto serial.Serial, ou None em caso de falha.
+        max_jobs_per_client (int): Tamanho máximo da fila de cada cliente.
+            Quem enfileira além desse limite aguarda (backpressure).
+        job_spool (dict, optional): Spool (ver spool.open_spool) onde são guardados
+            os jobs que não puderam ser escritos. Eles são reescritos, em ordem,
+            assim que a porta volta, antes de qualquer job novo.
+        reopen_interval (float): Intervalo entre tentativas de reabrir a porta
+            enquanto há jobs no spool.
+        summary_interval (float): Intervalo entre os resumos de jobs escritos no log.
+    """
+    return {
+        "name": name,
+        "open_port": open_port,
+        "serial_port": None,
+        "max_jobs_per_client": max_jobs_per_client,
+        "queues": {},
+        "ready_clients": collections.deque(),
+        "condition": threading.Condition(),
+        "stop_requested": False,
+        "thread": None,
+        "spool": job_spool,
+        "reopen_interval": reopen_interval,
+        "last_open_attempt": 0,
+        "jobs_written": 0,
+        "bytes_written": 0,
+        "write_summary": logging_utils.create_summary(
+            log, "Porta serial %(port)s: %(count)d jobs escritos (%(bytes)d bytes) nos últimos %(seconds).0fs.",
+            summary_interval, port=name),
+    }
+
+def start_port_writer(writer):
+    """Inicia a thread do escritor."""
+    writer["stop_requested"] = False
+    thread = threading.Thread(target=port_writer_thread, args=(writer,), name=f"SerialWriter-{writer['name']}")
+    writer["thread"] = thread
+    thread.start()
+    return thread
+
+def stop_port_writer(writer, timeout=5.0):
+    """Encerra a thread do escritor e fecha a porta serial."""
+    with writer["condition"]:
+        writer["stop_requested"] = True
+        writer["condition"].notify_all()
+    thread = writer.get("thread")
+    if thread and thread.is_alive():
+        thread.join(timeout=timeout)
+        if thread.is_alive():
+            log.warning(f"Escritor da porta {writer['name']} não finalizou a tempo.")
+
+def submit_job(writer, client_id, data, on_done=None, block=True, timeout=None, trace=None):
+    """
+    Enfileira um job para ser escrito na porta serial.
+
+    Args:
+        writer (dict): Escritor criado por create_port_writer.
+        client_id: Identificador do cliente dono do job (usado no round-robin).
+        data (bytes): Conteúdo do job.
+        on_done (callable, optional): Chamada na thread do escritor com True/False
+            quando o job for escrito ou descartado.
+        block (bool): Se True, aguarda espaço na fila do cliente.
+        timeout (float, optional): Tempo máximo de espera por espaço na fila.
+        trace (dict, optional): Rastro do job (ver tracing); recebe as etapas
+            'queue' (até sair da fila) e 'write' (escrita na porta).
+
+    Returns:
+        bool: True se o job foi enfileirado; False se a fila continuou cheia
+              ou o escritor está sendo encerrado.
+    """
+    job = {"client_id": client_id, "data": data, "on_done": on_done, "queued_at": time.time(), "trace": trace}
+    deadline = time.time() + timeout if timeout is not None else None
+    condition = writer["condition"]
+    with condition:
+        while True:
+            if writer["stop_requested"]:
+                return False
+            client_queue = writer["queues"].get(client_id)
+            if client_queue is None or len(client_queue) < writer["max_jobs_per_client"]:
+                break
+            if not block:
+                return False
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            condition.wait(remaining)
+
+        if client_queue is None:
+            client_queue = writer["queues"][client_id] = collections.deque()
+        client_queue.append(job)
+        if len(client_queue) == 1:
+            writer["ready_clients"].append(client_id)
+        condition.notify_all()
+    return True
+
+def queue_depths(writer):
+    """Retorna um dict {cliente: jobs pendentes} com as filas não vazias do escritor."""
+    with writer["condition"]:
+        return {client_id: len(client_queue) for client_id, client_queue in writer["queues"].items() if client_queue}
+
+def collect_metrics(writer):
+    """Atualiza os medidores de fila e spool do escritor (chamada a cada coleta de métricas)."""
+    metrics.set_gauge("npr_serial_queue_jobs", sum(queue_depths(writer).values()), port=writer['name'])
+    if writer["spool"]:
+        metrics.set_gauge("npr_serial_spool_pending_jobs", spool.spool_pending_count(writer["spool"]), port=writer['name'])
+
+def _next_job(writer):
+    """Retira o próximo job em round-robin. Deve ser chamada com a condição adquirida."""
+    client_id = writer["ready_clients"].popleft()
+    client_queue = writer["queues"][client_id]
+    job = client_queue.popleft()
+    if client_queue:
+        writer["ready_clients"].append(client_id)
+    else:
+        del writer["queues"][client_id]
+    writer["condition"].notify_all()
+    return job
+
+def _ensure_port(writer):
+    """Retorna a porta aberta, tentando reabri-la se necessário."""
+    ser = writer["serial_port"]
+    if ser and ser.is_open:
+        return ser
+    log.info(f"Tentando abrir porta serial {writer['name']}...")
+    writer["last_open_attempt"] = time.time()
+    ser = writer["open_port"]()
+    writer["serial_port"] = ser
+    return ser
+
+def _client_label(client_id):
+    return client_id[0] if isinstance(client_id, tuple) else str(client_id)
+
+def _write_data(writer, ser, data, client_id):
+    started = time.perf_counter()
+    if serial_utils.write_to_serial(ser, data):
+        metrics.observe("npr_serial_write_seconds", time.perf_counter() - started, port=writer['name'])
+        metrics.inc("npr_serial_bytes_written_total", len(data), port=writer['name'], client=_client_label(client_id))
+        metrics.inc("npr_serial_jobs_written_total", port=writer['name'], client=_client_label(client_id))
+        writer["jobs_written"] += 1
+        writer["bytes_written"] += len(data)
+        log.debug("[%s] %d bytes escritos com sucesso na porta serial %s.", client_id, len(data), writer['name'])
+        logging_utils.count_event(writer["write_summary"], len(data))
+        return True
+    serial_utils.close_serial_port(ser)
+    writer["serial_port"] = None
+    return False
+
+def _spool_job(writer, job, reason):
+    """Guarda um job no spool. Retorna True se o job ficou em disco."""
+    job_spool = writer["spool"]
+    if job_spool and spool.spool_append(job_spool, job["data"]) is not None:
+        # O job é confirmado ao cliente assim que esta função retorna True, e o
+        # cliente então o apaga do seu spool: ele precisa estar em disco já.
+        if not spool.spool_sync(job_spool, force=True):
+            log.error(f"[{job['client_id']}] {reason} Não foi possível gravar o job no spool da porta {writer['name']}.")
+            return False
+        log.warning(f"[{job['client_id']}] {reason} Job de {len(job['data'])} bytes guardado no spool da porta {writer['name']}.")
+        return True
+    log.error(f"[{job['client_id']}] {reason} Dados perdidos.")
+    metrics.inc("npr_jobs_dropped_total", port=writer['name'])
+    return False
+
+def _write_job(writer, job):
+    """Escreve um job na porta, reabrindo-a se necessário; em caso de falha, guarda no spool."""
+    ser = _ensure_port(writer)
+    if not ser:
+        return _spool_job(writer, job, f"Porta serial {writer['name']} não está disponível.")
+    if _write_data(writer, ser, job["data"], job["client_id"]):
+        return True
+    return _spool_job(writer, job, f"Falha ao escrever na porta serial {writer['name']}.")
+
+def _spool_has_pending(writer):
+    return writer["spool"] is not None and spool.spool_pending_count(writer["spool"]) > 0
+
+def _replay_spool(writer):
+    """
+    Reescreve na porta, em ordem, os jobs guardados no spool.
+
+    Returns:
+        bool: True se o spool foi esvaziado; False se a porta continua indisponível.
+    """
+    ser = writer["serial_port"]
+    if not ser or not ser.is_open:
+        if time.time() - writer["last_open_attempt"] < writer["reopen_interval"]:
+            return False
+        ser = _ensure_port(writer)
+        if not ser:
+            return False
+
+    job_spool = writer["spool"]
+    entries = spool.spool_pending(job_spool)
+    log.info(f"Reenviando {len(entries)} jobs do spool para a porta serial {writer['name']}...")
+    for entry in entries:
+        data = spool.spool_read(job_spool, entry)
+        if data is None:
+            # Registro ilegível: tentar de novo travaria o spool. O job é dado
+            # como perdido, não como entregue.
+            log.error(f"Job {entry['seq']} do spool da porta {writer['name']} não pôde ser lido. Dados perdidos.")
+            metrics.inc("npr_jobs_dropped_total", port=writer['name'])
+        elif not _write_data(writer, ser, data, "spool"):
+            log.warning(f"Falha ao reenviar job {entry['seq']} do spool para a porta {writer['name']}. Tentará novamente.")
+            return False
+        spool.spool_ack(job_spool, entry["seq"])
+        if writer["stop_requested"]:
+            return False
+    spool.spool_sync(job_spool, force=True)
+    return True
+
+def _finish_job(job, success):
+    if job["on_done"]:
+        try:
+            job["on_done"](success)
+        except Exception as e:
+            log.error(f"Erro no callback de conclusão do job de {job['client_id']}: {e}", exc_info=True)
+
+def port_writer_thread(writer):
+    """Thread que drena as filas do escritor e escreve os jobs na porta serial."""
+    log.info(f"Escritor da porta serial {writer['name']} iniciado.")
+    condition = writer["condition"]
+
+    while True:
+        with condition:
+            while not writer["ready_clients"] and not writer["stop_requested"] and not _spool_has_pending(writer):
+                condition.wait()
+            if writer["stop_requested"]:
+                break
+            job = _next_job(writer) if writer["ready_clients"] else None
+
+        try:
+            if _spool_has_pending(writer) and not _replay_spool(writer):
+                # Porta ainda indisponível: jobs novos vão para o final do spool,
+                # preservando a ordem de chegada.
+                if job:
+                    _finish_job(job, _spool_job(writer, job, f"Porta serial {writer['name']} não está disponível."))
+                else:
+                    spool.spool_sync(writer["spool"], force=True)
+                    with condition:
+                        if not writer["ready_clients"] and not writer["stop_requested"]:
+                            condition.wait(writer["reopen_interval"])
+                continue
+
+            if job:
+                tracing.stamp(job["trace"], "queue")
+                success = _write_job(writer, job)
+                tracing.stamp(job["trace"], "write")
+                tracing.finish_trace(job["trace"])
+                _finish_job(job, success)
+        except Exception as e:
+            log.error(f"Erro inesperado no escritor da porta {writer['name']}: {e}", exc_info=True)
+            if job:
+                _finish_job(job, False)
+
+    with condition:
+        remaining = []
+        while writer["ready_clients"]:
+            remaining.append(_next_job(writer))
+    if remaining:
+        log.warning(f"{len(remaining)} jobs ainda na fila no encerramento do escritor da porta {writer['name']}.")
+    for job in remaining:
+        _finish_job(job, _spool_job(writer, job, "Escritor encerrado antes da escrita."))
+
+    logging_utils.flush_summary(writer["write_summary"])
+    if writer["spool"]:
+        spool.close_spool(writer["spool"])
+    serial_utils.close_serial_port(writer["serial_port"])
+    writer["serial_port"] = None
+    log.info(f"Escritor da porta serial {writer['name']} finalizado.")
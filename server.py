@@ -1,3 +1,4 @@
+import base64
 import time
 import threading
 import logging
@@ -6,52 +7,148 @@ import select
 import os
 
 import config_manager
+import crypto_pool
 import crypto_utils
+import job_segmenter
+import logging_utils
+import metrics
 import network_utils
+import protocol
 import serial_utils
+import serial_writer
+import spool
+import tracing
 
 log = logging.getLogger(__name__)
 
 
 server_state = {
     "server_socket": None,
-    "serial_port": None,
+    "engine": None,
+    "port_writer": None,
+    "port_writers": {},
+    "routes": [],
     "clients": {},
+    "streams": {},
+    "streams_lock": threading.Lock(),
     "stop_event": threading.Event(),
     "config": {},
     "server_private_key": None,
     "server_public_key": None,
+    "server_public_key_bytes": None,
+    "server_key_fingerprint": None,
+    "ticket_key": None,
+    "ticket_replay": {},
+    "ticket_replay_lock": threading.Lock(),
     "listener_thread": None,
     "log_file_path": None
 }
 
 
-def ensure_serial_open():
-    """Tenta abrir/reabrir a porta serial se necessário."""
-    if server_state["serial_port"] and server_state["serial_port"].is_open:
-        return True
-
+def open_printer_port(serial_port, baud_rate):
+    """Abre uma porta serial de impressora. Usada pelo escritor dedicado da porta."""
     config = server_state["config"]
-    log.info(f"Tentando abrir porta serial {config['serial_port']}...")
-    server_state["serial_port"] = serial_utils.open_serial_port(
-        config['serial_port'],
-        config['baud_rate'],
+    ser = serial_utils.open_serial_port(
+        serial_port,
+        baud_rate,
         timeout=0.1,
         write_timeout=config.get('serial_timeout', 1.0)
     )
-    if server_state["serial_port"]:
-        log.info(f"Porta serial {config['serial_port']} aberta.")
-        return True
+    if ser:
+        log.info(f"Porta serial {serial_port} aberta.")
     else:
-        log.error(f"Falha ao abrir porta serial {config['serial_port']}. Tentará novamente mais tarde.")
-        return False
+        log.error(f"Falha ao abrir porta serial {serial_port}. Tentará novamente no próximo job.")
+    return ser
+
+def load_routes(config):
+    """
+    Lê a tabela de roteamento (opção avançada "routes") da configuração.
+
+    Cada rota associa uma fila pedida pelo cliente ("queue") ou a impressão
+    digital da chave do cliente ("fingerprint", SHA-256 em hexadecimal) a uma
+    porta serial ("serial_port", com "baud_rate" opcional). Rotas inválidas são
+    ignoradas.
+
+    Returns:
+        list: Rotas normalizadas, na ordem da configuração.
+    """
+    routes = []
+    for index, route in enumerate(config.get('routes') or []):
+        if not isinstance(route, dict) or not route.get('serial_port'):
+            log.error(f"Rota {index + 1} inválida (sem 'serial_port'). Ignorando.")
+            continue
+        fingerprint = route.get('fingerprint')
+        if fingerprint:
+            try:
+                fingerprint = bytes.fromhex(fingerprint.replace(':', ''))
+            except (AttributeError, ValueError):
+                log.error(f"Rota {index + 1}: impressão digital inválida ({fingerprint}). Ignorando.")
+                continue
+        if not route.get('queue') and not fingerprint:
+            log.error(f"Rota {index + 1} sem 'queue' nem 'fingerprint'. Ignorando.")
+            continue
+        routes.append({
+            "queue": route.get('queue'),
+            "fingerprint": fingerprint or None,
+            "serial_port": route['serial_port'],
+            "baud_rate": route.get('baud_rate', config['baud_rate']),
+        })
+    return routes
+
+def create_port_writers(config):
+    """Cria um escritor para a porta padrão e um para cada porta citada nas rotas."""
+    ports = {config['serial_port']: config['baud_rate']}
+    for route in server_state["routes"]:
+        ports.setdefault(route["serial_port"], route["baud_rate"])
+
+    writers = {}
+    for serial_port, baud_rate in ports.items():
+        job_spool = None
+        if config.get('spool_enabled', True):
+            spool_base_dir = config.get('spool_dir') or os.path.join(config_manager.get_base_dir(), "spool")
+            job_spool = spool.open_spool(spool.spool_directory(spool_base_dir, f"server-{serial_port}"))
+            if not job_spool:
+                log.warning(f"Spool da porta {serial_port} indisponível. Jobs que não puderem ser escritos serão perdidos.")
+        writers[serial_port] = serial_writer.create_port_writer(
+            serial_port,
+            lambda serial_port=serial_port, baud_rate=baud_rate: open_printer_port(serial_port, baud_rate),
+            max_jobs_per_client=config.get('writer_queue_jobs', serial_writer.DEFAULT_MAX_JOBS_PER_CLIENT),
+            job_spool=job_spool,
+            summary_interval=config.get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL)
+        )
+    return writers
+
+def route_client(client_info, channel, queue_name=None):
+    """
+    Escolhe o escritor (porta serial) dos jobs de um canal do cliente.
+
+    A fila pedida pelo cliente tem prioridade sobre a impressão digital da sua
+    chave; sem rota correspondente, os jobs vão para a porta padrão.
+    """
+    addr = client_info["addr"]
+    target = None
+    if queue_name:
+        target = next((route for route in server_state["routes"] if route["queue"] == queue_name), None)
+        if not target:
+            log.warning(f"[{addr}] Fila '{queue_name}' não configurada nas rotas. Usando a porta padrão.")
+    if not target and client_info["key_fingerprint"]:
+        target = next((route for route in server_state["routes"]
+                       if route["fingerprint"] == client_info["key_fingerprint"]), None)
+
+    writer = server_state["port_writers"].get(target["serial_port"]) if target else server_state["port_writer"]
+    if writer is not channel["port_writer"]:
+        log.info(f"[{addr}] Jobs do canal {channel['id']} deste cliente serão escritos na porta {writer['name']}.")
+    channel["port_writer"] = writer
+    return writer
 
 def close_client_connection(conn, addr):
     """Fecha a conexão com um cliente específico."""
     client_info = server_state["clients"].pop(conn, None)
     if client_info:
         log.info(f"Fechando conexão com cliente {addr}...")
+        logging_utils.flush_summary(client_info["receive_summary"])
         client_info["stop_event"].set()
+        release_client_stream(client_info)
         try:
             conn.shutdown(socket.SHUT_RDWR)
         except OSError: pass
@@ -69,102 +166,703 @@ def close_client_connection(conn, addr):
 
 
 
-def handle_client_thread(conn, addr, stop_event):
-    """Thread para lidar com um cliente individual."""
-    log.info(f"Thread iniciada para cliente {addr}.")
-    config = server_state["config"]
-    client_public_key = None
-    buffer_size = config.get('buffer_size', 1024)
-    serial_ok = False
-    last_serial_check = 0
-    serial_check_interval = 5.0
 
-    try:
-
-        log.info(f"[{addr}] Aguardando chave pública do cliente...")
-        client_pub_key_bytes = network_utils.receive_data(conn, timeout=10.0)
-        if client_pub_key_bytes is None or client_pub_key_bytes == b'':
-             log.error(f"[{addr}] Cliente desconectou ou timeout ao esperar chave pública.")
-             return
+HANDSHAKE_TIMEOUT = 10.0
+MAX_TICKET_REPLAY_ENTRIES = 65536
+
+metrics.describe("npr_server_connections_total", "counter", "Conexões de clientes aceitas.")
+metrics.describe("npr_server_clients", "gauge", "Clientes conectados.")
+metrics.describe("npr_server_handshake_seconds", "histogram", "Tempo da conexão até o início dos dados, por tipo de abertura.")
+metrics.describe("npr_server_bytes_received_total", "counter", "Bytes cifrados recebidos, por cliente.")
+metrics.describe("npr_server_bytes_decrypted_total", "counter", "Bytes de jobs descriptografados, por cliente.")
+metrics.describe("npr_server_jobs_received_total", "counter", "Jobs completos recebidos, por cliente.")
+metrics.describe("npr_server_crypto_cpu_seconds_total", "counter", "Tempo de CPU gasto com criptografia, por operação.")
+
+
+def create_client_info(addr, send):
+    """
+    Cria o estado de um cliente conectado, compartilhado pelos motores de I/O.
+
+    Args:
+        addr: Endereço remoto do cliente.
+        send (callable): Função que envia uma mensagem (bytes) ao cliente.
+    """
+    metrics.inc("npr_server_connections_total")
+    return {
+        "addr": addr,
+        "host": addr[0] if isinstance(addr, tuple) else str(addr),
+        "send": send,
+        "phase": "key_exchange",
+        "public_key": None,
+        "key_fingerprint": None,
+        "channels": {0: create_client_channel(0)},
+        "session": None,
+        "mode": None,
+        "decompressor": None,
+        "send_lock": threading.Lock(),
+        "delivery_failed": False,
+        "thread": None,
+        "stop_event": threading.Event(),
+        "connected_at": time.time(),
+        "receive_summary": logging_utils.create_summary(
+            log, "[%(addr)s] %(count)d jobs recebidos (%(bytes)d bytes) nos últimos %(seconds).0fs.",
+            server_state["config"].get('log_summary_interval', logging_utils.DEFAULT_SUMMARY_INTERVAL), addr=addr),
+    }
+
+def create_client_channel(channel_id):
+    """
+    Cria o estado de um canal de um cliente: uma porta serial do cliente, com
+    seu próprio fluxo de jobs, escritor de destino e buffer do job em montagem.
+    """
+    return {
+        "id": channel_id,
+        "stream": None,
+        "port_writer": server_state["port_writer"],
+        "job_buffer": bytearray(),
+        "trace": None,
+        "segmenter": None,
+    }
+
+def create_legacy_segmenter():
+    """
+    Cria o segmentador que remonta os jobs de um cliente do modo legado.
+
+    Esses clientes enviam a serial em chunks soltos, sem delimitar os jobs; o
+    servidor só entrega ao escritor jobs completos, para que os chunks de
+    clientes diferentes não se intercalem na impressora.
+    """
+    config = server_state["config"]
+    return job_segmenter.create_segmenter(
+        formats=config.get('legacy_job_formats', job_segmenter.DEFAULT_JOB_FORMATS),
+        idle_gap=config.get('legacy_job_idle_gap', job_segmenter.DEFAULT_IDLE_GAP),
+        max_job_size=protocol.MAX_SERVER_JOB_SIZE
+    )
 
-        client_public_key = crypto_utils.load_public_key_from_data(client_pub_key_bytes)
+def exchange_public_keys(client_info, message):
+    """
+    Identifica a chave pública do cliente e responde com a chave do servidor.
+
+    O cliente pode enviar o PEM completo ou apenas as impressões digitais das
+    chaves (protocol.KEY_FINGERPRINT_MAGIC). Se a chave do cliente não estiver
+    no cache, o PEM completo é solicitado e a troca continua na próxima mensagem.
+
+    Returns:
+        bool: True se a troca terminou, False se aguarda o PEM do cliente, ou
+              None em caso de falha.
+    """
+    addr = client_info["addr"]
+    server_pub_key_bytes = server_state["server_public_key_bytes"]
+    server_fingerprint = server_state["server_key_fingerprint"]
+
+    fingerprints = protocol.parse_fingerprint_hello(message)
+    if fingerprints:
+        client_fingerprint, known_server_fingerprint = fingerprints
+        client_public_key = crypto_utils.get_cached_public_key(client_fingerprint)
+        if not client_public_key:
+            log.info(f"[{addr}] Chave pública do cliente não está no cache. Solicitando chave completa.")
+            if not client_info["send"](protocol.KEY_REQUEST_MAGIC):
+                log.error(f"[{addr}] Falha ao solicitar chave pública do cliente.")
+                return None
+            return False
+        log.info(f"[{addr}] Chave pública do cliente reconhecida pela impressão digital.")
+        if known_server_fingerprint == server_fingerprint:
+            server_pub_key_bytes = protocol.build_fingerprint_reply(server_fingerprint)
+    else:
+        client_public_key, client_fingerprint = crypto_utils.load_public_key_cached(message)
         if not client_public_key:
             log.error(f"[{addr}] Falha ao carregar/validar chave pública do cliente.")
-            return
-
+            return None
         log.info(f"[{addr}] Chave pública do cliente recebida e carregada.")
 
-        if conn in server_state["clients"]:
-            server_state["clients"][conn]["public_key"] = client_public_key
-
-
-        server_pub_key_bytes = crypto_utils.get_public_key_bytes(server_state["server_public_key"])
-        if not server_pub_key_bytes or not network_utils.send_data(conn, server_pub_key_bytes):
-            log.error(f"[{addr}] Falha ao enviar chave pública do servidor para o cliente.")
-            return
-        log.info(f"[{addr}] Chave pública do servidor enviada.")
-
-
-        while not stop_event.is_set() and not server_state["stop_event"].is_set():
+    client_info["public_key"] = client_public_key
+    client_info["key_fingerprint"] = client_fingerprint
+    route_client(client_info, client_info["channels"][0])
 
-            ready_to_read, _, _ = select.select([conn], [], [], 0.1)
-
-            if ready_to_read:
-                encrypted_data = network_utils.receive_data(conn, buffer_size)
-
-                if encrypted_data is None:
-                    log.info(f"[{addr}] Cliente desconectou.")
-                    break
-                elif encrypted_data == b'':
+    if not client_info["send"](server_pub_key_bytes):
+        log.error(f"[{addr}] Falha ao enviar chave pública do servidor para o cliente.")
+        return None
+    log.info(f"[{addr}] Chave pública do servidor enviada.")
+    return True
 
-                    pass
-                else:
-                    log.debug(f"[{addr}] Recebidos {len(encrypted_data)} bytes criptografados.")
+def open_client_session(client_info, encrypted_session_key, encrypted_hello):
+    """
+    Abre a sessão AES-GCM proposta pelo cliente e responde com a confirmação.
+
+    Returns:
+        dict: Estado da sessão, ou None em caso de falha.
+    """
+    addr = client_info["addr"]
+    started = metrics.timed()
+    session_key = crypto_utils.decrypt_message(server_state["server_private_key"], encrypted_session_key)
+    metrics.add_cpu_time("npr_server_crypto_cpu_seconds_total", started, operation="rsa_decrypt")
+    session = crypto_utils.create_session(session_key, 'server') if session_key else None
+    if not session:
+        log.error(f"[{addr}] Falha ao recuperar a chave de sessão enviada pelo cliente.")
+        return None
+    return start_client_session(client_info, session, encrypted_hello)
+
+def resume_client_session(client_info, ticket, client_random, encrypted_hello):
+    """
+    Retoma uma sessão a partir do ticket apresentado pelo cliente, sem RSA.
+
+    Returns:
+        dict: Estado da sessão, ou None se o ticket for recusado.
+    """
+    addr = client_info["addr"]
+    if not server_state["ticket_key"]:
+        return None
+    ticket_bytes = crypto_utils.open_ticket(server_state["ticket_key"], ticket)
+    ticket_payload = protocol.decode_control(ticket_bytes) if ticket_bytes else None
+    if not ticket_payload:
+        return None
+    expires = ticket_payload.get("expires", 0)
+    if expires <= time.time():
+        log.info(f"[{addr}] Ticket de sessão expirado.")
+        return None
+    if not register_ticket_use(client_random, expires):
+        log.warning(f"[{addr}] Ticket de sessão reapresentado com o mesmo valor aleatório. Recusado.")
+        return None
 
+    try:
+        secret = base64.b64decode(ticket_payload["secret"])
+        session_key = crypto_utils.derive_key(secret, client_random, crypto_utils.RESUMED_SESSION_INFO)
+    except (KeyError, TypeError, ValueError) as e:
+        log.error(f"[{addr}] Conteúdo do ticket de sessão inválido: {e}")
+        return None
+    session = crypto_utils.create_session(session_key, 'server')
+    if not session:
+        return None
+    if ticket_payload.get("fingerprint"):
+        client_info["key_fingerprint"] = bytes.fromhex(ticket_payload["fingerprint"])
+    return start_client_session(client_info, session, encrypted_hello)
+
+def register_ticket_use(client_random, expires):
+    """
+    Registra o valor aleatório de uma retomada, recusando valores repetidos.
+
+    Impede que uma mensagem de retomada capturada seja reapresentada, o que
+    reabriria uma sessão com a mesma chave. Os registros valem até o
+    vencimento do ticket correspondente.
+    """
+    now = time.time()
+    with server_state["ticket_replay_lock"]:
+        seen = server_state["ticket_replay"]
+        if len(seen) >= MAX_TICKET_REPLAY_ENTRIES:
+            for random_value, valid_until in list(seen.items()):
+                if valid_until <= now:
+                    del seen[random_value]
+        if client_random in seen or len(seen) >= MAX_TICKET_REPLAY_ENTRIES:
+            return False
+        seen[client_random] = expires
+    return True
 
-                    decrypted_data = crypto_utils.decrypt_message(
-                        server_state["server_private_key"],
-                        encrypted_data
-                    )
+def issue_session_ticket(client_info, session):
+    """Emite um ticket que permite ao cliente retomar esta sessão em uma nova conexão."""
+    lifetime = server_state["config"].get('session_ticket_lifetime', protocol.DEFAULT_SESSION_TICKET_LIFETIME)
+    fingerprint = client_info["key_fingerprint"]
+    ticket_payload = {
+        "secret": base64.b64encode(crypto_utils.derive_resumption_secret(session)).decode('ascii'),
+        "fingerprint": fingerprint.hex() if fingerprint else None,
+        "expires": int(time.time() + lifetime),
+    }
+    ticket = crypto_utils.seal_ticket(server_state["ticket_key"], protocol.encode_control(ticket_payload))
+    return base64.b64encode(ticket).decode('ascii')
+
+def start_client_session(client_info, session, encrypted_hello):
+    """
+    Valida o hello cifrado do cliente, negocia as opções da sessão e envia a confirmação.
+
+    Returns:
+        dict: Estado da sessão, ou None em caso de falha.
+    """
+    addr = client_info["addr"]
+    hello_bytes = crypto_utils.session_decrypt(session, encrypted_hello)
+    hello = protocol.decode_control(hello_bytes) if hello_bytes else None
+    if not hello:
+        log.error(f"[{addr}] Mensagem de abertura de sessão inválida.")
+        return None
+
+    welcome_payload = {"version": protocol.PROTOCOL_VERSION, "pong": True, "channels": {}}
+    main_channel = client_info["channels"][0]
+    queue_name = hello.get("queue")
+    route_client(client_info, main_channel, queue_name if isinstance(queue_name, str) else None)
+    stream_id = hello.get("stream")
+    if valid_stream_id(stream_id):
+        stream = attach_client_stream(client_info, main_channel, stream_id)
+        welcome_payload["acks"] = True
+        welcome_payload["acked_seq"] = stream["delivered"]
+        channels = hello.get("channels")
+        for channel_key, channel_hello in (channels.items() if isinstance(channels, dict) else ()):
+            channel_id = int(channel_key) if str(channel_key).isdigit() else 0
+            if not 0 < channel_id <= protocol.MAX_CHANNEL_ID or not isinstance(channel_hello, dict):
+                log.warning(f"[{addr}] Canal inválido no hello ({channel_key}). Ignorando.")
+                continue
+            if not valid_stream_id(channel_hello.get("stream")):
+                log.warning(f"[{addr}] Canal {channel_id} sem identificador de fluxo válido. Ignorando.")
+                continue
+            channel = client_info["channels"][channel_id] = create_client_channel(channel_id)
+            queue_name = channel_hello.get("queue")
+            route_client(client_info, channel, queue_name if isinstance(queue_name, str) else None)
+            stream = attach_client_stream(client_info, channel, channel_hello["stream"])
+            welcome_payload["channels"][str(channel_id)] = {"acked_seq": stream["delivered"]}
+    offered_compression = hello.get("compression")
+    if (server_state["config"].get('compression', True) and isinstance(offered_compression, list)
+            and protocol.COMPRESSION_ZLIB in offered_compression):
+        client_info["decompressor"] = protocol.create_decompressor()
+        welcome_payload["compression"] = protocol.COMPRESSION_ZLIB
+    if server_state["ticket_key"] and hello.get("tickets"):
+        welcome_payload["ticket"] = issue_session_ticket(client_info, session)
+
+    welcome = crypto_utils.session_encrypt(session, protocol.encode_control(welcome_payload))
+    if not welcome or not client_info["send"](welcome):
+        log.error(f"[{addr}] Falha ao confirmar a sessão para o cliente.")
+        release_client_stream(client_info)
+        return None
+
+    log.info(f"[{addr}] Sessão AES-GCM estabelecida (cliente protocolo v{hello.get('version')}).")
+    return session
+
+def valid_stream_id(stream_id):
+    """Indica se stream_id é um identificador de fluxo aceitável."""
+    return isinstance(stream_id, str) and 0 < len(stream_id) <= protocol.MAX_STREAM_ID_LENGTH
+
+def attach_client_stream(client_info, channel, stream_id):
+    """
+    Associa um canal da conexão ao fluxo de jobs identificado por stream_id, criando-o se necessário.
+
+    O fluxo guarda, entre reconexões do mesmo cliente, a maior sequência já
+    aceita (enfileirada para escrita) e a maior já entregue (escrita na serial
+    ou guardada no spool). Jobs retransmitidos com sequência já aceita são
+    descartados, e as confirmações vão sempre para a conexão mais recente.
+    """
+    with server_state["streams_lock"]:
+        stream = server_state["streams"].get(stream_id)
+        if stream is None:
+            stream = server_state["streams"][stream_id] = {
+                "id": stream_id,
+                "accepted": 0,
+                "delivered": 0,
+                "generation": 0,
+                "client": None,
+                "channel": 0,
+            }
+        stream["client"] = client_info
+        stream["channel"] = channel["id"]
+    channel["stream"] = stream
+    log.info(f"[{client_info['addr']}] Fluxo {stream_id[:8]} associado ao canal {channel['id']} "
+             f"(última sequência entregue: {stream['delivered']}).")
+    return stream
+
+def release_client_stream(client_info):
+    """Desassocia a conexão dos fluxos dos seus canais, se ela ainda for a conexão atual deles."""
+    with server_state["streams_lock"]:
+        for channel in client_info["channels"].values():
+            stream = channel["stream"]
+            if stream and stream["client"] is client_info:
+                stream["client"] = None
+
+def send_session_record(client_info, record_type, flags=0, payload=b''):
+    """Envia um registro cifrado com a sessão do cliente. Pode ser chamada de qualquer thread."""
+    with client_info["send_lock"]:
+        encrypted = crypto_utils.session_encrypt(client_info["session"], protocol.pack_record(record_type, flags, payload))
+        return bool(encrypted) and client_info["send"](encrypted)
+
+def send_ack(client_info, seq, channel_id=0):
+    """Confirma ao cliente a entrega de todos os jobs do canal com sequência até seq."""
+    if channel_id:
+        sent = send_session_record(client_info, protocol.RECORD_ACK, protocol.RECORD_FLAG_CHANNEL,
+                                   protocol.pack_channel(channel_id, protocol.pack_sequenced(seq)))
+    else:
+        sent = send_session_record(client_info, protocol.RECORD_ACK, 0, protocol.pack_sequenced(seq))
+    if not sent:
+        log.warning(f"[{client_info['addr']}] Falha ao enviar confirmação da sequência {seq}.")
+
+def record_delivery(stream, seq, generation, success):
+    """
+    Registra o resultado da escrita de um job sequenciado e confirma ao cliente.
+
+    Se um job foi perdido, a sequência aceita volta para a última entregue e a
+    conexão atual é marcada para ser encerrada: o cliente reconecta e retransmite
+    a partir dali. Resultados de jobs enfileirados antes da falha são ignorados.
+    """
+    with server_state["streams_lock"]:
+        if generation != stream["generation"]:
+            return
+        client_info = stream["client"]
+        channel_id = stream["channel"]
+        if success:
+            stream["delivered"] = max(stream["delivered"], seq)
+        else:
+            stream["generation"] += 1
+            stream["accepted"] = stream["delivered"]
+            if client_info:
+                client_info["delivery_failed"] = True
+    if success and client_info:
+        send_ack(client_info, seq, channel_id)
+
+def handle_client_message(client_info, message, decrypted_data=None):
+    """
+    Processa uma mensagem recebida de um cliente, independente do motor de I/O.
+
+    Conduz a troca de chaves, a abertura de sessão (ou a escolha do modo legado)
+    e a descriptografia dos dados. Respostas ao cliente são enviadas por
+    client_info["send"]; a escrita na serial fica a cargo do chamador.
+
+    Args:
+        decrypted_data (bytes, optional): No modo legado, o bloco já
+            descriptografado pelo pool (ver uses_crypto_pool); se None, o
+            bloco é descriptografado aqui.
+
+    Returns:
+        list: Jobs ({"data": bytes, "seq": int ou None, "channel": int, "trace":
+              rastro ou None}) a serem escritos na serial (pode ser vazia), ou
+              None se a conexão deve ser encerrada. No modo legado os chunks
+              são remontados em jobs; o último job de uma rajada só é emitido
+              por flush_legacy_jobs.
+    """
+    addr = client_info["addr"]
+    metrics.inc("npr_server_bytes_received_total", len(message), client=client_info["host"])
+
+    if client_info["delivery_failed"]:
+        log.warning(f"[{addr}] Um job deste cliente não pôde ser entregue. Encerrando conexão para retransmissão.")
+        return None
+
+    if client_info["phase"] == "key_exchange":
+        resume_parts = protocol.parse_resume_hello(message)
+        if resume_parts:
+            session = resume_client_session(client_info, *resume_parts)
+            if session:
+                log.info(f"[{addr}] Sessão retomada a partir de ticket.")
+                client_info["session"] = session
+                client_info["mode"] = "sessão AES-GCM (retomada)"
+                client_info["phase"] = "data"
+                observe_handshake(client_info, "resumed")
+                return []
+            log.info(f"[{addr}] Ticket de sessão recusado. Seguindo com a troca de chaves.")
+            if not client_info["send"](protocol.TICKET_REJECTED_MAGIC):
+                return None
+            return []
+        exchanged = exchange_public_keys(client_info, message)
+        if exchanged is None:
+            return None
+        if exchanged:
+            client_info["phase"] = "first_message"
+        return []
+
+    log.debug("[%s] Recebidos %d bytes criptografados.", addr, len(message))
+
+    if client_info["phase"] == "first_message":
+        client_info["phase"] = "data"
+        rsa_block_size = server_state["server_private_key"].key_size // 8
+        hello_parts = protocol.parse_session_hello(message, rsa_block_size)
+        if hello_parts:
+            session = open_client_session(client_info, *hello_parts)
+            if not session:
+                return None
+            client_info["session"] = session
+            client_info["mode"] = "sessão AES-GCM"
+            observe_handshake(client_info, "session")
+            return []
+        log.info(f"[{addr}] Cliente sem suporte a sessão. Usando modo legado (RSA por chunk).")
+        client_info["mode"] = "legado RSA"
+        client_info["channels"][0]["segmenter"] = create_legacy_segmenter()
+        observe_handshake(client_info, "legacy")
+
+    if client_info["session"]:
+        return handle_session_record(client_info, message)
+
+    received_at = time.time()
+    if decrypted_data is None:
+        started = metrics.timed()
+        decrypted_data = crypto_utils.decrypt_message(
+            server_state["server_private_key"],
+            bytes(message)
+        )
+        metrics.add_cpu_time("npr_server_crypto_cpu_seconds_total", started, operation="rsa_decrypt")
+
+    if decrypted_data is None:
+        log.error(f"[{addr}] Falha ao descriptografar dados recebidos. Ignorando.")
+        return []
+    elif decrypted_data == b'':
+        log.warning(f"[{addr}] Descriptografia resultou em dados vazios. Ignorando.")
+        return []
+    elif decrypted_data == protocol.LEGACY_PING and job_segmenter.job_started_at(client_info["channels"][0]["segmenter"]) is None:
+        # Só entre jobs: no meio de um job, os mesmos quatro bytes nulos podem
+        # ser o fim de um job binário.
+        log.debug("[%s] Keep-alive (modo legado) recebido.", addr)
+        return []
+
+    log.debug("[%s] Dados descriptografados (%d bytes).", addr, len(decrypted_data))
+    metrics.inc("npr_server_bytes_decrypted_total", len(decrypted_data), client=client_info["host"])
+
+    # Como no modo de sessão, o rastro começa no primeiro chunk do job.
+    channel = client_info["channels"][0]
+    if channel["trace"] is None:
+        channel["trace"] = tracing.start_trace("server", received_at, client=client_info["host"], channel=0)
+    else:
+        tracing.stamp(channel["trace"], "receive", received_at)
+    tracing.stamp(channel["trace"], "decrypt")
+    return legacy_jobs(client_info, job_segmenter.feed(channel["segmenter"], decrypted_data, received_at))
+
+def legacy_jobs(client_info, datas):
+    """Monta os jobs (como os de handle_client_message) remontados pelo segmentador do modo legado."""
+    channel = client_info["channels"][0]
+    jobs = []
+    for data in datas:
+        trace = channel["trace"]
+        channel["trace"] = None
+        log.debug("[%s] Job completo recebido (%d bytes). Tentando escrever na serial...", client_info["addr"], len(data))
+        logging_utils.count_event(client_info["receive_summary"], len(data))
+        metrics.inc("npr_server_jobs_received_total", client=client_info["host"])
+        jobs.append({"data": data, "seq": None, "channel": 0, "trace": trace})
+    if jobs and job_segmenter.job_started_at(channel["segmenter"]) is not None:
+        # Sobrou o início do próximo job no mesmo chunk.
+        channel["trace"] = tracing.start_trace("server", client=client_info["host"], channel=0)
+    return jobs
+
+def flush_legacy_jobs(client_info, final=False):
+    """
+    Emite o job pendente de um cliente do modo legado se não chegaram dados por
+    legacy_job_idle_gap segundos, ou imediatamente com final=True (desconexão).
+
+    Returns:
+        list: O job emitido, ou lista vazia.
+    """
+    segmenter = client_info["channels"][0]["segmenter"]
+    if not segmenter:
+        return []
+    if final:
+        data = job_segmenter.flush(segmenter)
+    else:
+        data = job_segmenter.flush_idle(segmenter, time.time())
+    return legacy_jobs(client_info, [data] if data else [])
+
+def legacy_flush_timeout(client_info):
+    """Segundos até o job pendente do modo legado ser emitido por inatividade, ou None se não há pendências."""
+    segmenter = client_info["channels"][0]["segmenter"]
+    if not segmenter:
+        return None
+    return job_segmenter.time_until_idle_flush(segmenter, time.time())
+
+def uses_crypto_pool(client_info):
+    """Indica se os blocos deste cliente (modo legado, já na fase de dados) vão para o pool de descriptografia."""
+    return client_info["phase"] == "data" and not client_info["session"] and crypto_pool.pool_enabled()
+
+def decrypt_legacy_messages(client_info, messages):
+    """
+    Descriptografa no pool, de uma vez, os blocos do modo legado recebidos de um cliente.
+
+    Returns:
+        list: O texto claro de cada mensagem, na ordem recebida. None (para
+              todas, se o pool não é usado, ou para um bloco que falhou) indica
+              que handle_client_message deve descriptografá-la.
+    """
+    if uses_crypto_pool(client_info):
+        results = crypto_pool.decrypt_blocks([bytes(message) for message in messages])
+        if results is not None:
+            return results
+    return [None] * len(messages)
+
+def observe_handshake(client_info, kind):
+    """Registra o tempo entre a conexão do cliente e o início da fase de dados."""
+    metrics.observe("npr_server_handshake_seconds", time.time() - client_info["connected_at"], kind=kind)
+
+def collect_metrics():
+    """Atualiza os medidores lidos sob demanda (chamada a cada coleta de métricas)."""
+    metrics.set_gauge("npr_server_clients", len(server_state["clients"]))
+    for writer in list(server_state["port_writers"].values()):
+        serial_writer.collect_metrics(writer)
+
+def handle_session_record(client_info, message):
+    """
+    Descriptografa um registro do modo de sessão e acumula os dados do job atual.
+
+    Returns:
+        list: O job completo quando o registro encerra um job, ou lista vazia;
+              None se a conexão deve ser encerrada.
+    """
+    addr = client_info["addr"]
+    received_at = time.time()
+    started = metrics.timed()
+    plaintext = crypto_utils.session_decrypt(client_info["session"], message)
+    metrics.add_cpu_time("npr_server_crypto_cpu_seconds_total", started, operation="session_decrypt")
+    # Um registro perdido quebraria o job atual: encerra a conexão para que o
+    # cliente reconecte e retransmita os jobs ainda não confirmados.
+    if plaintext is None:
+        log.error(f"[{addr}] Falha ao descriptografar dados recebidos. Encerrando conexão.")
+        return None
+
+    record = protocol.unpack_record(plaintext)
+    if record is None:
+        log.error(f"[{addr}] Registro inválido recebido. Encerrando conexão.")
+        return None
+    record_type, flags, payload = record
+
+    if record_type == protocol.RECORD_PING:
+        log.debug("[%s] Keep-alive recebido.", addr)
+        if payload and not send_session_record(client_info, protocol.RECORD_PONG, 0, payload):
+            log.warning(f"[{addr}] Falha ao responder ao keep-alive.")
+        return []
+    if record_type != protocol.RECORD_DATA:
+        log.error(f"[{addr}] Tipo de registro desconhecido ({record_type}). Encerrando conexão.")
+        return None
+
+    channel = client_info["channels"][0]
+    if flags & protocol.RECORD_FLAG_CHANNEL:
+        channel_part = protocol.unpack_channel(payload)
+        if channel_part is None:
+            return None
+        channel_id, payload = channel_part
+        channel = client_info["channels"].get(channel_id)
+        if channel is None:
+            log.error(f"[{addr}] Registro de um canal não declarado ({channel_id}).")
+            return None
+
+    seq = None
+    stream = channel["stream"]
+    if stream:
+        sequenced = protocol.unpack_sequenced(payload)
+        if sequenced is None:
+            return None
+        seq, payload = sequenced
+
+    if flags & protocol.RECORD_FLAG_COMPRESSED:
+        # Sempre descomprime, mesmo uma duplicata: o fluxo deflate é contínuo.
+        if client_info["decompressor"] is None:
+            log.error(f"[{addr}] Registro comprimido sem compressão negociada.")
+            return None
+        payload = protocol.decompress_payload(client_info["decompressor"], payload, protocol.MAX_SERVER_JOB_SIZE)
+        if payload is None:
+            return None
+    metrics.inc("npr_server_bytes_decrypted_total", len(payload), client=client_info["host"])
+
+    if stream:
+        if seq and seq <= stream["accepted"]:
+            # Retransmissão de um job já aceito: não escreve de novo.
+            if flags & protocol.RECORD_FLAG_JOB_END:
+                log.info(f"[{addr}] Job {seq} retransmitido já havia sido aceito. Descartando duplicata.")
+                delivered = stream["delivered"]
+                if seq <= delivered:
+                    send_ack(client_info, delivered, channel["id"])
+            return []
+
+    # O rastro do job começa no primeiro registro; o tempo entre registros é
+    # atribuído à recepção e o de cada registro, à descriptografia.
+    trace = channel["trace"]
+    if trace is None:
+        trace = channel["trace"] = tracing.start_trace("server", received_at, client=client_info["host"], channel=channel["id"])
+    else:
+        tracing.stamp(trace, "receive", received_at)
+    tracing.stamp(trace, "decrypt")
+
+    job_buffer = channel["job_buffer"]
+    job_buffer += payload
+    job_end = flags & protocol.RECORD_FLAG_JOB_END
+    if not job_end and len(job_buffer) < protocol.MAX_SERVER_JOB_SIZE:
+        return []
+
+    job = bytes(job_buffer)
+    job_buffer.clear()
+    channel["trace"] = None
+    if trace:
+        trace["info"]["seq"] = seq
+    log.debug("[%s] Job completo recebido (%d bytes). Tentando escrever na serial...", addr, len(job))
+    logging_utils.count_event(client_info["receive_summary"], len(job))
+    metrics.inc("npr_server_jobs_received_total", client=client_info["host"])
+    # Uma parte de job grande demais é escrita sem sequência; só o final é confirmado.
+    return [{"data": job, "seq": seq if job_end else None, "channel": channel["id"], "trace": trace}]
+
+def submit_client_data(client_info, job, on_done=None, block=True):
+    """
+    Enfileira um job de um cliente no escritor da porta serial.
+
+    Com block=True, aguarda espaço na fila do cliente, o que segura a leitura do
+    socket e aplica backpressure ao remetente. Jobs sequenciados são confirmados
+    ao cliente quando o escritor termina de entregá-los.
+    """
+    channel = client_info["channels"][job.get("channel", 0)]
+    writer = channel["port_writer"]
+    if not writer:
+        log.error(f"[{client_info['addr']}] Escritor da porta serial não está ativo. Dados perdidos.")
+        # Só o escritor da porta padrão pode faltar (antes do início ou após a
+        # parada do servidor); o rótulo segue o de serial_writer (nome da porta).
+        metrics.inc("npr_jobs_dropped_total", port=server_state["config"]['serial_port'])
+        return False
 
-                    if decrypted_data is None:
-                        log.error(f"[{addr}] Falha ao descriptografar dados recebidos. Ignorando.")
+    stream = channel["stream"]
+    seq = job["seq"]
+    if not stream or not seq:
+        return serial_writer.submit_job(writer, client_info["addr"], job["data"], on_done=on_done, block=block,
+                                        trace=job["trace"])
 
-                        continue
-                    elif decrypted_data == b'':
-                         log.warning(f"[{addr}] Descriptografia resultou em dados vazios. Ignorando.")
-                         continue
+    with server_state["streams_lock"]:
+        generation = stream["generation"]
+        previous_accepted = stream["accepted"]
+        stream["accepted"] = max(previous_accepted, seq)
 
-                    log.info(f"[{addr}] Dados descriptografados ({len(decrypted_data)} bytes). Tentando escrever na serial...")
+    def job_done(success):
+        record_delivery(stream, seq, generation, success)
+        if on_done:
+            on_done(success)
 
+    if serial_writer.submit_job(writer, client_info["addr"], job["data"], on_done=job_done, block=block,
+                                trace=job["trace"]):
+        return True
+    with server_state["streams_lock"]:
+        if stream["generation"] == generation and stream["accepted"] == seq:
+            stream["accepted"] = previous_accepted
+    return False
+
+def submit_client_jobs(client_info, jobs):
+    """
+    Enfileira, aguardando espaço, os jobs de um cliente do motor de threads.
+
+    Returns:
+        bool: False se um job foi recusado; a conexão deve ser encerrada para
+              que o cliente reenvie os jobs não confirmados.
+    """
+    for job in jobs:
+        if not submit_client_data(client_info, job):
+            log.error(f"[{client_info['addr']}] Job não pôde ser enfileirado. Encerrando conexão para que o cliente o reenvie.")
+            return False
+    return True
 
-                    now = time.time()
-                    if not serial_ok or not server_state["serial_port"] or not server_state["serial_port"].is_open:
-                         if now - last_serial_check > serial_check_interval:
-                              serial_ok = ensure_serial_open()
-                              last_serial_check = now
-                         else:
-                              serial_ok = False
-                    else:
-                        serial_ok = True
+def handle_client_thread(conn, addr, stop_event):
+    """
+    Thread para lidar com um cliente individual.
 
-                    if serial_ok and server_state["serial_port"]:
+    O socket só é lido quando select indica dados, e cada leitura entrega ao
+    decodificador de frames o que já chegou: um cliente lento ou que para no
+    meio de uma mensagem nunca prende a thread além do intervalo de verificação.
+    """
+    log.info(f"Thread iniciada para cliente {addr}.")
+    client_info = server_state["clients"].get(conn)
+    decoder = network_utils.create_frame_decoder()
 
-                        if serial_utils.write_to_serial(server_state["serial_port"], decrypted_data):
-                            log.info(f"[{addr}] {len(decrypted_data)} bytes escritos com sucesso na porta serial {config['serial_port']}.")
-                        else:
-                            log.error(f"[{addr}] Falha ao escrever na porta serial {config['serial_port']}. Dados perdidos.")
+    try:
+        if client_info is None:
+            return
 
-                            serial_utils.close_serial_port(server_state["serial_port"])
-                            server_state["serial_port"] = None
-                            serial_ok = False
-                            last_serial_check = 0
-                    else:
-                        log.error(f"[{addr}] Porta serial não está disponível. Dados perdidos.")
-                        last_serial_check = 0
-            else:
+        log.info(f"[{addr}] Aguardando chave pública do cliente...")
+        while not stop_event.is_set() and not server_state["stop_event"].is_set():
+            if client_info["phase"] == "key_exchange" and time.time() - client_info["connected_at"] > HANDSHAKE_TIMEOUT:
+                log.error(f"[{addr}] Timeout ao esperar a troca de chaves do cliente.")
+                return
 
-                 pass
+            ready_to_read, _, _ = select.select([conn], [], [], 0.1)
+            if not ready_to_read:
+                if not submit_client_jobs(client_info, flush_legacy_jobs(client_info)):
+                    return
+                continue
+
+            messages = network_utils.receive_frames(conn, decoder)
+            if messages is None:
+                log.info(f"[{addr}] Cliente desconectou.")
+                break
+            for message, decrypted_data in zip(messages, decrypt_legacy_messages(client_info, messages)):
+                jobs = handle_client_message(client_info, message, decrypted_data)
+                if jobs is None or not submit_client_jobs(client_info, jobs):
+                    return
 
     except ConnectionResetError:
         log.info(f"[{addr}] Conexão redefinida pelo cliente.")
@@ -174,6 +872,9 @@ def handle_client_thread(conn, addr, stop_event):
         log.error(f"[{addr}] Erro inesperado na thread do cliente: {e}", exc_info=True)
     finally:
         log.info(f"Encerrando thread para cliente {addr}.")
+        if client_info:
+            # O cliente legado já considera enviado o que estava sendo remontado.
+            submit_client_jobs(client_info, flush_legacy_jobs(client_info, final=True))
         close_client_connection(conn, addr)
 
 
@@ -202,18 +903,15 @@ def accept_connections_thread():
                     continue
 
 
-                client_stop_event = threading.Event()
+                network_utils.enable_keepalive(conn)
+                client_info = create_client_info(addr, lambda data, conn=conn: network_utils.send_data(conn, data))
                 client_thread = threading.Thread(
                     target=handle_client_thread,
-                    args=(conn, addr, client_stop_event),
+                    args=(conn, addr, client_info["stop_event"]),
                     name=f"ClientThread-{addr}"
                 )
-                server_state["clients"][conn] = {
-                    "addr": addr,
-                    "thread": client_thread,
-                    "stop_event": client_stop_event,
-                    "public_key": None
-                }
+                client_info["thread"] = client_thread
+                server_state["clients"][conn] = client_info
                 client_thread.start()
                 log.info(f"Cliente {addr} adicionado. Clientes conectados: {len(server_state['clients'])}")
 
@@ -250,8 +948,13 @@ def show_connected_clients():
         for conn, info in clients_copy.items():
             addr = info.get('addr', 'N/A')
 
-            key_info = "Sim" if info.get('public_key') else "Não (Aguardando)"
-            print(f"{i}. Endereço: {addr}, Chave Pública Recebida: {key_info}")
+            key_info = info["key_fingerprint"].hex()[:16] if info.get('key_fingerprint') else "Não (Aguardando)"
+            mode_info = info.get('mode') or "Aguardando"
+            writers = {channel["port_writer"]["name"]: channel["port_writer"]
+                       for channel in info["channels"].values() if channel["port_writer"]}
+            depth = sum(serial_writer.queue_depths(writer).get(addr, 0) for writer in writers.values())
+            port_info = ", ".join(writers) or "N/A"
+            print(f"{i}. Endereço: {addr}, Chave Pública: {key_info}, Modo: {mode_info}, Porta: {port_info}, Jobs na fila: {depth}")
             i += 1
     print("--------------------------\n")
 
@@ -279,12 +982,9 @@ def show_recent_logs(num_lines=20):
         return
 
     try:
-        with open(log_path, 'r') as f:
-
-            lines = f.readlines()
-            for line in lines[-num_lines:]:
-                print(line.strip())
-    except Exception as e:
+        for line in logging_utils.tail_lines(log_path, num_lines):
+            print(line.strip())
+    except OSError as e:
         print(f"Erro ao ler arquivo de log: {e}")
     print("---------------------------------\n")
 
@@ -292,6 +992,7 @@ def show_recent_logs(num_lines=20):
 
 def run_server(start_config=None):
     """Função principal para configurar e iniciar o servidor."""
+    startup_timer = logging_utils.create_startup_timer('server')
     if start_config:
         server_state["config"] = start_config
     config = server_state["config"]
@@ -300,30 +1001,22 @@ def run_server(start_config=None):
     log_level_str = config.get("log_level", "INFO").upper()
     log_level = getattr(logging, log_level_str, logging.INFO)
 
-    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    logging.basicConfig(level=log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
+    logging.basicConfig(level=log_level, format=logging_utils.LOG_FORMAT, datefmt=logging_utils.LOG_DATE_FORMAT)
+    logging_utils.setup_logging(log_level)
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
     log_file = os.path.join(script_dir, "server_activity.log")
+    trace_dump_file = os.path.join(script_dir, "server_job_stages.json")
     server_state["log_file_path"] = log_file
-    file_handler = logging.FileHandler(log_file, mode='a')
-    file_handler.setFormatter(log_formatter)
-    file_handler.setLevel(log_level)
-
+    logging_utils.add_log_file(log_file, log_level,
+                               max_bytes=config.get('log_max_bytes', logging_utils.DEFAULT_LOG_MAX_BYTES),
+                               backup_count=config.get('log_backup_count', logging_utils.DEFAULT_LOG_BACKUP_COUNT),
+                               when=config.get('log_rotate_when'))
 
-
-    log.addHandler(file_handler)
-    logging.getLogger('crypto_utils').addHandler(file_handler)
-    logging.getLogger('network_utils').addHandler(file_handler)
-    logging.getLogger('serial_utils').addHandler(file_handler)
-    logging.getLogger('config_manager').addHandler(file_handler)
-
-
-    logging.getLogger().setLevel(log_level)
     log.info(f"Nível de log configurado para: {log_level_str}")
     log.info("Logs também estão sendo salvos em: server_activity.log")
     log.info("--- Iniciando Servidor Network Print Redirector v2.0.2 ---")
+    logging_utils.mark_startup(startup_timer, "log")
 
 
     priv_key = crypto_utils.load_private_key('server')
@@ -337,11 +1030,27 @@ def run_server(start_config=None):
             return False
     server_state["server_private_key"] = priv_key
     server_state["server_public_key"] = pub_key
+    server_state["server_public_key_bytes"] = crypto_utils.get_public_key_bytes(pub_key)
+    server_state["server_key_fingerprint"] = crypto_utils.cache_public_key(pub_key)
+    if not server_state["server_public_key_bytes"]:
+        log.critical("Falha ao serializar a chave pública do servidor. Encerrando.")
+        return False
     log.info("Chaves RSA do servidor carregadas/geradas.")
+    logging_utils.mark_startup(startup_timer, "chaves")
 
+    # A chave dos tickets de sessão vive só na memória: tickets emitidos antes
+    # de uma reinicialização são recusados e o cliente refaz a troca de chaves.
+    server_state["ticket_key"] = crypto_utils.generate_session_key() if config.get('session_tickets', True) else None
+    server_state["ticket_replay"] = {}
 
 
-    server_state["serial_port"] = None
+
+    server_state["routes"] = load_routes(config)
+    server_state["port_writers"] = create_port_writers(config)
+    server_state["port_writer"] = server_state["port_writers"][config['serial_port']]
+    if server_state["routes"]:
+        log.info(f"{len(server_state['routes'])} rotas configuradas para {len(server_state['port_writers'])} portas seriais.")
+    logging_utils.mark_startup(startup_timer, "portas")
 
 
 
@@ -361,10 +1070,28 @@ def run_server(start_config=None):
         return False
 
 
+    if config.get('metrics_port'):
+        if metrics.start_metrics_server(config['metrics_port'], config.get('metrics_listen_ip', metrics.DEFAULT_METRICS_LISTEN_IP)):
+            metrics.register_collector(collect_metrics)
+    tracing.configure(config, trace_dump_file)
+    if config.get('crypto_workers', 0):
+        crypto_pool.start_pool(priv_key, config['crypto_workers'],
+                               config.get('crypto_batch_size', crypto_pool.DEFAULT_CRYPTO_BATCH_SIZE))
+
     server_state["stop_event"].clear()
-    listener_thread = threading.Thread(target=accept_connections_thread, name="ListenerThread")
+    for writer in server_state["port_writers"].values():
+        serial_writer.start_port_writer(writer)
+    server_state["engine"] = config.get('server_engine', 'threads')
+    if server_state["engine"] == 'asyncio':
+        import server_async
+        log.info("Usando motor asyncio (um event loop para todos os clientes).")
+        listener_thread = threading.Thread(target=server_async.run_async_server_thread, name="AsyncServerThread")
+    else:
+        listener_thread = threading.Thread(target=accept_connections_thread, name="ListenerThread")
     server_state["listener_thread"] = listener_thread
     listener_thread.start()
+    logging_utils.mark_startup(startup_timer, "threads")
+    logging_utils.log_startup(startup_timer, log)
 
 
     return True
@@ -376,7 +1103,10 @@ def stop_server():
 
 
     server_socket = server_state.get("server_socket")
-    if server_socket:
+    if server_state.get("engine") == 'asyncio':
+        import server_async
+        server_async.stop_async_server()
+    elif server_socket:
         try:
             server_socket.close()
             log.info("Socket do servidor fechado.")
@@ -394,7 +1124,7 @@ def stop_server():
 
     log.info("Fechando conexões de clientes...")
 
-    clients_copy = dict(server_state["clients"])
+    clients_copy = dict(server_state["clients"]) if server_state.get("engine") != 'asyncio' else {}
     threads_to_join = []
     for conn, client_info in clients_copy.items():
          addr = client_info.get('addr', 'N/A')
@@ -410,6 +1140,10 @@ def stop_server():
               thread.join(timeout=1.0)
 
 
-    serial_utils.close_serial_port(server_state.get("serial_port"))
+    for writer in server_state.get("port_writers", {}).values():
+        serial_writer.stop_port_writer(writer)
 
+    crypto_pool.stop_pool()
+    tracing.shutdown()
+    metrics.stop_metrics_server()
     log.info("Servidor encerrado.")
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import struct
+import time
+
+import crypto_pool
+import logging_utils
+import network_utils
+import server
+
+log = logging.getLogger(__name__)
+
+
+async_state = {
+    "loop": None,
+    "stop_event": None
+}
+
+
+async def read_messages(reader, decoder):
+    """
+    Aguarda dados de um StreamReader até completar ao menos uma mensagem.
+
+    Returns:
+        list: As mensagens completas (ver network_utils.feed_frames).
+        None: Se o cliente fechou a conexão.
+
+    Raises:
+        ValueError: Se o cliente anuncia um frame maior que o limite.
+    """
+    while True:
+        data = await reader.read(network_utils.DEFAULT_RECEIVE_BUFFER_SIZE)
+        if not data:
+            return None
+        messages = network_utils.feed_frames(decoder, data)
+        if messages:
+            return messages
+
+async def decrypt_legacy_messages(client_info, messages):
+    """Como server.decrypt_legacy_messages, mas aguarda o pool sem bloquear o event loop."""
+    if server.uses_crypto_pool(client_info):
+        futures = crypto_pool.submit_blocks([bytes(message) for message in messages])
+        if futures:
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+            results = crypto_pool.collect_results(futures)
+            if results is not None:
+                return results
+    return [None] * len(messages)
+
+def make_sender(loop, writer):
+    """
+    Cria a função de envio de um cliente.
+
+    A escrita é sempre agendada no event loop, então a função pode ser chamada
+    tanto do próprio loop quanto do executor (troca de chaves) ou do escritor serial.
+    """
+    def send(data_bytes):
+        if writer.is_closing():
+            return False
+        header = struct.pack(network_utils.MSG_LEN_HEADER_FORMAT, len(data_bytes))
+        try:
+            loop.call_soon_threadsafe(writer.writelines, (header, data_bytes))
+        except RuntimeError:
+            return False
+        return True
+    return send
+
+async def handle_client(reader, writer):
+    """Corrotina que atende um cliente individual."""
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    config = server.server_state["config"]
+    max_clients = config.get('max_clients', 5)
+    log.info(f"Nova conexão recebida de {addr}.")
+
+    if len(server.server_state["clients"]) >= max_clients:
+        log.warning(f"Número máximo de clientes ({max_clients}) atingido. Rejeitando {addr}.")
+        writer.write(b"ERRO: Servidor cheio.\n")
+        writer.close()
+        return
+
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        network_utils.enable_keepalive(sock)
+    client_info = server.create_client_info(addr, make_sender(loop, writer))
+    client_info["task"] = asyncio.current_task()
+    # Vagas na fila de cada escritor de destino dos canais (o escritor guarda
+    # uma fila por cliente, compartilhada pelos canais roteados à mesma porta).
+    write_slots = {}
+
+    def channel_write_slots(channel_id):
+        port_writer = client_info["channels"][channel_id]["port_writer"]
+        name = port_writer["name"] if port_writer else None
+        if name not in write_slots:
+            write_slots[name] = asyncio.Semaphore(port_writer["max_jobs_per_client"] if port_writer else 1)
+        return write_slots[name]
+    server.server_state["clients"][writer] = client_info
+    log.info(f"Cliente {addr} adicionado. Clientes conectados: {len(server.server_state['clients'])}")
+
+    async def submit_jobs(jobs):
+        """Enfileira os jobs; retorna False se um foi recusado e a conexão deve ser encerrada."""
+        for job in jobs:
+            # Uma vaga por job na fila do escritor: o enfileiramento nunca
+            # bloqueia o loop, e um cliente lento para de ser lido.
+            slots = channel_write_slots(job["channel"])
+            await slots.acquire()
+
+            def release_write_slot(success, slots=slots):
+                try:
+                    loop.call_soon_threadsafe(slots.release)
+                except RuntimeError:
+                    pass
+
+            if not server.submit_client_data(client_info, job, on_done=release_write_slot, block=False):
+                slots.release()
+                log.error(f"[{addr}] Job não pôde ser enfileirado. Encerrando conexão para que o cliente o reenvie.")
+                return False
+        return True
+
+    decoder = network_utils.create_frame_decoder()
+    read_task = None
+    try:
+        connected = True
+        while connected:
+            if client_info["phase"] == "key_exchange":
+                # Como no motor de threads, o prazo conta desde a conexão, não
+                # desde a última leitura.
+                timeout = server.HANDSHAKE_TIMEOUT - (time.time() - client_info["connected_at"])
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+            else:
+                timeout = server.legacy_flush_timeout(client_info)
+            # A leitura não é cancelada pelo prazo: continua na próxima volta.
+            if read_task is None:
+                read_task = asyncio.ensure_future(read_messages(reader, decoder))
+            done, _ = await asyncio.wait({read_task}, timeout=timeout)
+            if not done:
+                if client_info["phase"] == "key_exchange":
+                    raise asyncio.TimeoutError()
+                if not await submit_jobs(server.flush_legacy_jobs(client_info)):
+                    break
+                continue
+            messages = read_task.result()
+            read_task = None
+            if messages is None:
+                log.info(f"[{addr}] Cliente desconectou.")
+                break
+
+            decrypted = await decrypt_legacy_messages(client_info, messages)
+            for message, decrypted_data in zip(messages, decrypted):
+                if client_info["session"] or decrypted_data is not None:
+                    jobs = server.handle_client_message(client_info, message, decrypted_data)
+                else:
+                    # Troca de chaves e modo legado usam RSA; ficam fora do event loop.
+                    jobs = await loop.run_in_executor(None, server.handle_client_message, client_info, message)
+                if jobs is None or not await submit_jobs(jobs):
+                    connected = False
+                    break
+            await writer.drain()
+
+        # O cliente legado já considera enviado o que estava sendo remontado.
+        await submit_jobs(server.flush_legacy_jobs(client_info, final=True))
+
+    except ValueError as e:
+        log.error(f"[{addr}] Fluxo de mensagens inválido: {e}")
+    except asyncio.TimeoutError:
+        log.error(f"[{addr}] Timeout ao esperar chave pública.")
+    except ConnectionResetError:
+        log.info(f"[{addr}] Conexão redefinida pelo cliente.")
+    except asyncio.CancelledError:
+        log.debug(f"[{addr}] Atendimento cancelado.")
+    except Exception as e:
+        log.error(f"[{addr}] Erro inesperado no atendimento do cliente: {e}", exc_info=True)
+    finally:
+        if read_task is not None:
+            read_task.cancel()
+        for job in server.flush_legacy_jobs(client_info, final=True):
+            # Conexão interrompida: sem aguardar vaga na fila do escritor.
+            if not server.submit_client_data(client_info, job, block=False):
+                log.warning(f"[{addr}] Job pendente do modo legado descartado no encerramento.")
+        server.server_state["clients"].pop(writer, None)
+        logging_utils.flush_summary(client_info["receive_summary"])
+        server.release_client_stream(client_info)
+        writer.close()
+        log.info(f"Conexão com cliente {addr} fechada.")
+
+async def serve():
+    """Aceita conexões no socket já criado por run_server até que a parada seja solicitada."""
+    async_state["stop_event"] = asyncio.Event()
+    async_state["loop"] = asyncio.get_running_loop()
+    if server.server_state["stop_event"].is_set():
+        return
+
+    async_server = await asyncio.start_server(handle_client, sock=server.server_state["server_socket"])
+    log.info("Motor asyncio aguardando conexões...")
+
+    await async_state["stop_event"].wait()
+
+    async_server.close()
+    tasks = [info["task"] for info in list(server.server_state["clients"].values()) if info.get("task")]
+    if tasks:
+        log.info(f"Encerrando {len(tasks)} conexões de clientes...")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    await async_server.wait_closed()
+
+def run_async_server_thread():
+    """Thread que executa o event loop do motor asyncio do servidor."""
+    log.info("Thread do motor asyncio iniciada.")
+    try:
+        asyncio.run(serve())
+    except Exception as e:
+        log.error(f"Erro inesperado no motor asyncio: {e}", exc_info=True)
+    finally:
+        async_state["loop"] = None
+        async_state["stop_event"] = None
+    log.info("Thread do motor asyncio finalizada.")
+
+def stop_async_server():
+    """Solicita, de qualquer thread, o encerramento do event loop."""
+    loop = async_state["loop"]
+    stop_event = async_state["stop_event"]
+    if loop and stop_event:
+        try:
+            loop.call_soon_threadsafe(stop_event.set)
+        except RuntimeError:
+            pass
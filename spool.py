@@ -0,0 +1,372 @@
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+SPOOL_RECORD_HEADER_FORMAT = '!IQI'
+SPOOL_RECORD_HEADER_SIZE = struct.calcsize(SPOOL_RECORD_HEADER_FORMAT)
+SPOOL_ACK_FORMAT = '!Q'
+SEGMENT_SUFFIX = ".spool"
+ACK_FILE = "ack"
+ID_FILE = "id"
+
+DEFAULT_SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 0.05
+DEFAULT_FSYNC_BATCH = 32
+
+
+def spool_directory(base_dir, name):
+    """Monta o caminho do spool `name` dentro de base_dir, com um nome seguro para o sistema de arquivos."""
+    return os.path.join(base_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', name))
+
+def open_spool(directory, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES,
+               fsync_interval=DEFAULT_FSYNC_INTERVAL, fsync_batch=DEFAULT_FSYNC_BATCH):
+    """
+    Abre (ou cria) um spool em disco e recupera os registros ainda não confirmados.
+
+    O spool é um diretório de segmentos append-only. Cada registro recebe um
+    número de sequência crescente; registros confirmados com spool_ack deixam
+    de ser reenviados, e segmentos totalmente confirmados são apagados. Todas
+    as escritas de dados são sequenciais, e o fsync é feito em lotes.
+
+    Args:
+        directory (str): Diretório do spool.
+        segment_max_bytes (int): Tamanho a partir do qual um novo segmento é iniciado.
+        fsync_interval (float): Intervalo máximo, em segundos, entre fsyncs com dados pendentes.
+        fsync_batch (int): Quantidade de registros que força um fsync imediato.
+
+    Returns:
+        dict: Estado do spool, ou None em caso de erro.
+    """
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        log.error(f"Erro ao criar diretório do spool '{directory}': {e}")
+        return None
+
+    spool = {
+        "directory": directory,
+        "segment_max_bytes": segment_max_bytes,
+        "fsync_interval": fsync_interval,
+        "fsync_batch": fsync_batch,
+        "lock": threading.RLock(),
+        "acked_seq": _read_ack(directory),
+        "ack_dirty": False,
+        "next_seq": 1,
+        "segments": [],
+        "pending": [],
+        "current_file": None,
+        "current_path": None,
+        "current_size": 0,
+        "unsynced_records": 0,
+        "last_sync": time.time(),
+    }
+    spool["next_seq"] = spool["acked_seq"] + 1
+    spool["id"] = _read_or_create_id(directory)
+    if not spool["id"]:
+        return None
+
+    try:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                _recover_segment(spool, os.path.join(directory, name))
+    except OSError as e:
+        log.error(f"Erro ao recuperar o spool '{directory}': {e}")
+        return None
+
+    _delete_acked_segments(spool)
+    if spool["pending"]:
+        log.info(f"Spool '{directory}': {len(spool['pending'])} registros pendentes recuperados do disco.")
+    return spool
+
+def _read_or_create_id(directory):
+    """
+    Lê o identificador aleatório do spool, criando-o na primeira abertura.
+
+    Junto com os números de sequência, o identificador distingue os registros
+    deste spool dos de qualquer outro (por exemplo, após apagar o diretório).
+    """
+    id_path = os.path.join(directory, ID_FILE)
+    try:
+        with open(id_path, 'r', encoding='ascii') as f:
+            spool_id = f.read().strip()
+        if spool_id:
+            return spool_id
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.warning(f"Identificador do spool '{directory}' ilegível ({e}). Criando um novo.")
+
+    spool_id = os.urandom(16).hex()
+    try:
+        with open(id_path, 'w', encoding='ascii') as f:
+            f.write(spool_id)
+            f.flush()
+            os.fsync(f.fileno())
+    except OSError as e:
+        log.error(f"Erro ao gravar identificador do spool '{directory}': {e}")
+        return None
+    return spool_id
+
+def _read_ack(directory):
+    try:
+        with open(os.path.join(directory, ACK_FILE), 'rb') as f:
+            return struct.unpack(SPOOL_ACK_FORMAT, f.read(struct.calcsize(SPOOL_ACK_FORMAT)))[0]
+    except FileNotFoundError:
+        return 0
+    except (OSError, struct.error) as e:
+        log.warning(f"Arquivo de confirmação do spool '{directory}' ilegível ({e}). Reenviando tudo.")
+        return 0
+
+def _recover_segment(spool, path):
+    """Lê um segmento existente, descartando um possível registro final incompleto."""
+    last_seq = 0
+    valid_size = 0
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(SPOOL_RECORD_HEADER_SIZE)
+            if len(header) < SPOOL_RECORD_HEADER_SIZE:
+                break
+            length, seq, checksum = struct.unpack(SPOOL_RECORD_HEADER_FORMAT, header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                log.warning(f"Registro incompleto ou corrompido no spool '{path}' (seq {seq}). Descartando o restante do segmento.")
+                break
+            offset = valid_size + SPOOL_RECORD_HEADER_SIZE
+            valid_size = offset + length
+            last_seq = seq
+            if seq > spool["acked_seq"]:
+                spool["pending"].append({"seq": seq, "path": path, "offset": offset, "length": length})
+            spool["next_seq"] = max(spool["next_seq"], seq + 1)
+
+    if valid_size < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(valid_size)
+    spool["segments"].append({"path": path, "last_seq": last_seq})
+
+def _delete_acked_segments(spool):
+    """Apaga os segmentos (exceto o atual) cujos registros já foram todos confirmados."""
+    deletable = [segment for segment in spool["segments"]
+                 if segment["path"] != spool["current_path"] and segment["last_seq"] <= spool["acked_seq"]]
+    if not deletable:
+        return
+    if spool["ack_dirty"]:
+        # A confirmação precisa estar em disco antes de apagar os registros;
+        # caso contrário, números de sequência poderiam ser reutilizados após um crash.
+        try:
+            _write_ack(spool)
+            spool["ack_dirty"] = False
+        except OSError as e:
+            log.error(f"Erro ao gravar confirmação do spool '{spool['directory']}': {e}")
+            return
+
+    remaining = []
+    for segment in spool["segments"]:
+        if segment["path"] != spool["current_path"] and segment["last_seq"] <= spool["acked_seq"]:
+            try:
+                os.remove(segment["path"])
+                log.debug(f"Segmento do spool confirmado e removido: {segment['path']}")
+            except OSError as e:
+                log.warning(f"Erro ao remover segmento do spool {segment['path']}: {e}")
+                remaining.append(segment)
+        else:
+            remaining.append(segment)
+    spool["segments"] = remaining
+
+def _open_new_segment(spool):
+    _close_current_segment(spool)
+    path = os.path.join(spool["directory"], f"{spool['next_seq']:020d}{SEGMENT_SUFFIX}")
+    spool["current_file"] = open(path, 'ab')
+    spool["current_path"] = path
+    spool["current_size"] = 0
+    spool["segments"].append({"path": path, "last_seq": 0})
+
+def _close_current_segment(spool):
+    if spool["current_file"]:
+        try:
+            spool["current_file"].flush()
+            os.fsync(spool["current_file"].fileno())
+            spool["current_file"].close()
+        except OSError as e:
+            log.warning(f"Erro ao fechar segmento do spool {spool['current_path']}: {e}")
+    spool["current_file"] = None
+    spool["current_path"] = None
+    spool["current_size"] = 0
+
+def spool_append(spool, payload):
+    """
+    Acrescenta um registro ao spool.
+
+    Returns:
+        int: Número de sequência do registro, ou None em caso de erro de I/O.
+    """
+    with spool["lock"]:
+        try:
+            if not spool["current_file"] or spool["current_size"] >= spool["segment_max_bytes"]:
+                _open_new_segment(spool)
+            seq = spool["next_seq"]
+            header = struct.pack(SPOOL_RECORD_HEADER_FORMAT, len(payload), seq, zlib.crc32(payload))
+            f = spool["current_file"]
+            f.write(header)
+            f.write(payload)
+            f.flush()
+        except OSError as e:
+            log.error(f"Erro de I/O ao gravar no spool '{spool['directory']}': {e}")
+            _discard_failed_append(spool)
+            return None
+
+        offset = spool["current_size"] + SPOOL_RECORD_HEADER_SIZE
+        spool["current_size"] = offset + len(payload)
+        spool["segments"][-1]["last_seq"] = seq
+        spool["pending"].append({"seq": seq, "path": spool["current_path"], "offset": offset, "length": len(payload)})
+        spool["next_seq"] = seq + 1
+        spool["unsynced_records"] += 1
+        if spool["unsynced_records"] >= spool["fsync_batch"]:
+            spool_sync(spool, force=True)
+        return seq
+
+def _discard_failed_append(spool):
+    """
+    Desfaz o que um spool_append com erro possa ter gravado pela metade.
+
+    O segmento atual é fechado e truncado no fim do último registro completo;
+    o próximo registro abre um novo segmento. Se nem o truncamento for
+    possível, o número de sequência do registro não é reutilizado.
+    """
+    f = spool["current_file"]
+    path = spool["current_path"]
+    size = spool["current_size"]
+    spool["current_file"] = None
+    spool["current_path"] = None
+    spool["current_size"] = 0
+    if f is None:
+        return
+    try:
+        # Fechar tenta gravar o restante do buffer; o truncamento vem depois.
+        f.close()
+    except OSError:
+        pass
+    try:
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, size)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        log.warning(f"Não foi possível truncar o segmento do spool {path}: {e}")
+        spool["next_seq"] += 1
+        return
+    spool["unsynced_records"] = 0
+    if size == 0:
+        spool["segments"].pop()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def spool_sync(spool, force=False):
+    """
+    Grava em disco (fsync) os registros e a confirmação pendentes.
+
+    Sem force, só sincroniza se o intervalo de fsync já passou; deve ser chamada
+    periodicamente pelo dono do spool (por exemplo, antes de aguardar novos dados).
+
+    Returns:
+        bool: False se a sincronização falhou.
+    """
+    with spool["lock"]:
+        if not spool["unsynced_records"] and not spool["ack_dirty"]:
+            return True
+        if not force and time.time() - spool["last_sync"] < spool["fsync_interval"]:
+            return True
+        try:
+            if spool["unsynced_records"] and spool["current_file"]:
+                os.fsync(spool["current_file"].fileno())
+            if spool["ack_dirty"]:
+                _write_ack(spool)
+        except OSError as e:
+            log.error(f"Erro ao sincronizar o spool '{spool['directory']}': {e}")
+            return False
+        spool["unsynced_records"] = 0
+        spool["ack_dirty"] = False
+        spool["last_sync"] = time.time()
+        return True
+
+def _write_ack(spool):
+    ack_path = os.path.join(spool["directory"], ACK_FILE)
+    tmp_path = ack_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack(SPOOL_ACK_FORMAT, spool["acked_seq"]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ack_path)
+
+def spool_pending(spool):
+    """Retorna a lista, em ordem, dos registros ainda não confirmados."""
+    with spool["lock"]:
+        return list(spool["pending"])
+
+def spool_read(spool, entry):
+    """Lê o conteúdo de um registro retornado por spool_pending. Retorna None em caso de erro."""
+    try:
+        with open(entry["path"], 'rb') as f:
+            f.seek(entry["offset"])
+            return f.read(entry["length"])
+    except OSError as e:
+        log.error(f"Erro ao ler registro {entry['seq']} do spool: {e}")
+        return None
+
+def spool_find(spool, seq):
+    """Retorna o registro pendente com a sequência seq (para spool_read), ou None se já foi confirmado."""
+    with spool["lock"]:
+        pending = spool["pending"]
+        if not pending:
+            return None
+        # As sequências são consecutivas, exceto após descartar um registro corrompido.
+        index = seq - pending[0]["seq"]
+        if 0 <= index < len(pending) and pending[index]["seq"] == seq:
+            return pending[index]
+        for entry in pending:
+            if entry["seq"] == seq:
+                return entry
+        return None
+
+def spool_ack(spool, seq):
+    """
+    Confirma todos os registros com sequência até seq (inclusive).
+
+    Segmentos totalmente confirmados são apagados; se o segmento atual ficar
+    totalmente confirmado, ele é fechado e apagado também.
+    """
+    with spool["lock"]:
+        if seq <= spool["acked_seq"]:
+            return
+        spool["acked_seq"] = seq
+        spool["ack_dirty"] = True
+        pending = spool["pending"]
+        index = 0
+        while index < len(pending) and pending[index]["seq"] <= seq:
+            index += 1
+        del pending[:index]
+
+        if not pending and spool["current_file"] and spool["current_size"] >= spool["segment_max_bytes"] // 4:
+            _close_current_segment(spool)
+        _delete_acked_segments(spool)
+
+def spool_pending_count(spool):
+    """Quantidade de registros ainda não confirmados."""
+    with spool["lock"]:
+        return len(spool["pending"])
+
+def close_spool(spool):
+    """Sincroniza e fecha o spool."""
+    with spool["lock"]:
+        spool_sync(spool, force=True)
+        _close_current_segment(spool)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import capture_buffer
+
+
+def _records(ring):
+    return [(channel_id, bytes(view)) for channel_id, view, _ in capture_buffer.get_chunks(ring)]
+
+def _start_put(ring, data, results):
+    thread = threading.Thread(target=lambda: results.append(capture_buffer.put_chunk(ring, 0, data, 0.0)), daemon=True)
+    thread.start()
+    return thread
+
+
+def test_chunks_keep_order_across_wraparound():
+    ring = capture_buffer.create_capture_buffer(100)
+    for i in range(20):
+        data = b"%02d" % i * 10
+        assert capture_buffer.put_chunk(ring, i % 2, data, float(i)) == 0
+        assert _records(ring) == [(i % 2, data)]
+        capture_buffer.release_chunks(ring)
+    assert capture_buffer.buffered_bytes(ring) == 0
+
+def test_write_wraps_to_start_when_tail_is_too_small():
+    ring = capture_buffer.create_capture_buffer(100)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.get_chunks(ring)
+    capture_buffer.put_chunk(ring, 0, b"b" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"c" * 25, 0.0)
+    capture_buffer.release_chunks(ring)
+    capture_buffer.put_chunk(ring, 0, b"d" * 20, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"e" * 10, 0.0)
+    # 'e' não cabe depois de 'd' (95..100) e recomeça do início, antes de 'b'.
+    assert ring["records"][-1][1] == 0
+    assert [data for _, data in _records(ring)] == [b"b" * 25, b"c" * 25, b"d" * 20, b"e" * 10]
+
+def test_large_reads_are_split():
+    ring = capture_buffer.create_capture_buffer(100)
+    assert capture_buffer.put_chunk(ring, 0, b"x" * 60, 0.0) == 0
+    assert [len(data) for _, data in _records(ring)] == [25, 25, 10]
+
+def test_drop_oldest_keeps_newest_reads():
+    ring = capture_buffer.create_capture_buffer(100, 'drop_oldest')
+    dropped = sum(capture_buffer.put_chunk(ring, 0, b"%04d" % i, 0.0) for i in range(100))
+    data = b"".join(data for _, data in _records(ring))
+    assert len(data) + dropped == 400
+    assert data.endswith(b"0099")
+    assert len(data) <= 100
+
+def test_drop_oldest_never_drops_reads_being_consumed():
+    ring = capture_buffer.create_capture_buffer(100, 'drop_oldest')
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    chunks = capture_buffer.get_chunks(ring)
+    for data in (b"b" * 25, b"c" * 25, b"d" * 25):
+        capture_buffer.put_chunk(ring, 0, data, 0.0)
+    results = []
+    thread = _start_put(ring, b"e" * 10, results)
+    time.sleep(0.2)
+    # Descartar 'b' não abriria espaço contíguo: o produtor espera a liberação.
+    assert thread.is_alive()
+    assert bytes(chunks[0][1]) == b"a" * 25
+    capture_buffer.release_chunks(ring)
+    thread.join(2)
+    assert results == [0]
+    assert [data for _, data in _records(ring)] == [b"b" * 25, b"c" * 25, b"d" * 25, b"e" * 10]
+
+def test_drop_oldest_drops_last_unread_when_it_frees_space():
+    ring = capture_buffer.create_capture_buffer(100, 'drop_oldest')
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.get_chunks(ring)
+    capture_buffer.put_chunk(ring, 0, b"b" * 20, 0.0)
+    assert capture_buffer.put_chunk(ring, 0, b"c" * 20, 0.0) == 20
+    capture_buffer.release_chunks(ring)
+    assert [data for _, data in _records(ring)] == [b"c" * 20]
+
+def test_block_policy_waits_and_honors_stop_event():
+    ring = capture_buffer.create_capture_buffer(100)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"a" * 25, 0.0)
+    capture_buffer.put_chunk(ring, 0, b"a" * 20, 0.0)
+    stop_event = threading.Event()
+    threading.Timer(0.1, stop_event.set).start()
+    assert capture_buffer.put_chunk(ring, 0, b"b" * 10, 0.0, stop_event) == -1
+    assert capture_buffer.buffered_bytes(ring) == 95
+
+def test_wakeup_interrupts_get_chunks():
+    ring = capture_buffer.create_capture_buffer(100)
+    capture_buffer.wakeup(ring)
+    started = time.time()
+    assert capture_buffer.get_chunks(ring, 5) == []
+    assert time.time() - started < 1
@@ -0,0 +1,60 @@
+import socket
+import struct
+
+import pytest
+
+import network_utils
+
+
+def _frame(payload):
+    return struct.pack(network_utils.MSG_LEN_HEADER_FORMAT, len(payload)) + payload
+
+
+def test_frames_split_at_every_byte():
+    stream = _frame(b"primeiro") + _frame(b"segundo")
+    decoder = network_utils.create_frame_decoder()
+    messages = []
+    for i in range(len(stream)):
+        messages += network_utils.feed_frames(decoder, stream[i:i + 1])
+    assert messages == [b"primeiro", b"segundo"]
+    assert not network_utils.frame_in_progress(decoder)
+
+@pytest.mark.parametrize("split", range(1, network_utils.MSG_LEN_HEADER_SIZE))
+def test_decoder_resumes_split_header(split):
+    stream = _frame(b"ab") + _frame(b"cde")
+    boundary = len(_frame(b"ab")) + split
+    decoder = network_utils.create_frame_decoder()
+    assert network_utils.feed_frames(decoder, stream[:boundary]) == [b"ab"]
+    assert network_utils.frame_in_progress(decoder)
+    assert network_utils.feed_frames(decoder, stream[boundary:]) == [b"cde"]
+
+def test_several_frames_in_one_read_and_empty_frames_skipped():
+    decoder = network_utils.create_frame_decoder()
+    stream = _frame(b"um") + _frame(b"") + _frame(b"dois") + _frame(b"tr")[:5]
+    assert network_utils.feed_frames(decoder, stream) == [b"um", b"dois"]
+    assert network_utils.feed_frames(decoder, b"r") == [b"tr"]
+
+def test_oversized_frame_is_rejected():
+    decoder = network_utils.create_frame_decoder(max_frame_size=10)
+    with pytest.raises(ValueError):
+        network_utils.feed_frames(decoder, struct.pack(network_utils.MSG_LEN_HEADER_FORMAT, 11))
+
+def test_receive_frames_resumes_across_reads():
+    # Com um buffer de leitura de 8 bytes, cada frame chega em várias chamadas.
+    decoder = network_utils.create_frame_decoder(read_size=8)
+    large = bytes(range(256)) * 4
+    left, right = socket.socketpair()
+    try:
+        left.sendall(_frame(b"pequeno") + _frame(large) + _frame(b"fim"))
+        left.close()
+        messages = []
+        while True:
+            received = network_utils.receive_frames(right, decoder)
+            if received is None:
+                break
+            messages += received
+        assert messages == [b"pequeno", large, b"fim"]
+        assert not network_utils.frame_in_progress(decoder)
+    finally:
+        left.close()
+        right.close()
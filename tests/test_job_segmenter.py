@@ -0,0 +1,62 @@
+import job_segmenter
+
+
+def test_zpl_jobs_split_at_job_end():
+    segmenter = job_segmenter.create_segmenter()
+    jobs = job_segmenter.feed(segmenter, b"^XA^FDum^FS^XZ^XA^FDdois^FS^xz^XA^FDtr", 1.0)
+    assert jobs == [b"^XA^FDum^FS^XZ", b"^XA^FDdois^FS^xz"]
+    assert job_segmenter.flush(segmenter) == b"^XA^FDtr"
+
+def test_zpl_job_end_split_between_reads():
+    segmenter = job_segmenter.create_segmenter()
+    assert job_segmenter.feed(segmenter, b"^XA^FDum^FS^", 1.0) == []
+    assert job_segmenter.feed(segmenter, b"X", 1.0) == []
+    assert job_segmenter.feed(segmenter, b"Z^XA", 1.0) == [b"^XA^FDum^FS^XZ"]
+    assert job_segmenter.job_started_at(segmenter) == 1.0
+
+def test_pjl_job_ends_at_closing_uel():
+    uel = job_segmenter.PJL_UEL
+    job = uel + b"@PJL ENTER LANGUAGE=PCL\r\n\x1bE texto \x1bE" + uel
+    segmenter = job_segmenter.create_segmenter()
+    # O UEL de abertura não encerra o job.
+    assert job_segmenter.feed(segmenter, job[:len(uel) + 10], 1.0) == []
+    assert job_segmenter.feed(segmenter, job[len(uel) + 10:] + uel + b"@PJL", 1.0) == [job]
+
+def test_pjl_eoj_before_uel_ends_job():
+    uel = job_segmenter.PJL_UEL
+    job = uel + b"@PJL JOB\r\ndados\r\n@PJL EOJ\r\n" + uel
+    segmenter = job_segmenter.create_segmenter()
+    assert job_segmenter.feed(segmenter, job, 1.0) == [job]
+
+def test_escpos_cuts_only_when_enabled():
+    receipt = b"\x1b@cupom\n\x1dV\x00"
+    default = job_segmenter.create_segmenter()
+    assert job_segmenter.feed(default, receipt + b"proximo", 1.0) == []
+    escpos = job_segmenter.create_segmenter(formats=('escpos',))
+    assert job_segmenter.feed(escpos, receipt + b"proximo", 1.0) == [receipt]
+
+def test_idle_gap_flushes_pending_data():
+    segmenter = job_segmenter.create_segmenter(idle_gap=0.25)
+    assert job_segmenter.feed(segmenter, b"texto sem marcador", 10.0) == []
+    assert job_segmenter.flush_idle(segmenter, 10.125) is None
+    assert job_segmenter.time_until_idle_flush(segmenter, 10.125) == 0.125
+    assert job_segmenter.flush_idle(segmenter, 10.25) == b"texto sem marcador"
+    assert job_segmenter.flush_idle(segmenter, 11.0) is None
+    assert job_segmenter.time_until_idle_flush(segmenter, 11.0) is None
+
+def test_new_data_postpones_idle_flush():
+    segmenter = job_segmenter.create_segmenter(idle_gap=0.25)
+    job_segmenter.feed(segmenter, b"parte 1 ", 10.0)
+    job_segmenter.feed(segmenter, b"parte 2", 10.125)
+    assert job_segmenter.flush_idle(segmenter, 10.25) is None
+    assert job_segmenter.flush_idle(segmenter, 10.375) == b"parte 1 parte 2"
+
+def test_max_job_size_emits_partial_job():
+    segmenter = job_segmenter.create_segmenter(max_job_size=10)
+    assert job_segmenter.feed(segmenter, b"12345", 1.0) == []
+    assert job_segmenter.feed(segmenter, b"6789012", 1.0) == [b"123456789012"]
+    assert job_segmenter.job_started_at(segmenter) is None
+
+def test_unknown_format_is_ignored():
+    segmenter = job_segmenter.create_segmenter(formats=('zpl', 'inexistente'))
+    assert job_segmenter.feed(segmenter, b"^XA^XZ", 1.0) == [b"^XA^XZ"]
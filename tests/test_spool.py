@@ -0,0 +1,93 @@
+import errno
+import os
+
+import spool
+
+
+def _segment_paths(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(spool.SEGMENT_SUFFIX))
+
+def _pending_payloads(job_spool):
+    return [(entry["seq"], spool.spool_read(job_spool, entry)) for entry in spool.spool_pending(job_spool)]
+
+
+class FailingFile:
+    """Arquivo cuja escrita grava só parte dos dados e falha, como em um disco cheio."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        self.f.write(bytes(data)[:len(data) // 2])
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def test_reopen_recovers_unacked_records(tmp_path):
+    job_spool = spool.open_spool(str(tmp_path))
+    for payload in (b"job 1", b"job 2", b"job 3"):
+        spool.spool_append(job_spool, payload)
+    spool.spool_ack(job_spool, 1)
+    spool.close_spool(job_spool)
+
+    job_spool = spool.open_spool(str(tmp_path))
+    assert _pending_payloads(job_spool) == [(2, b"job 2"), (3, b"job 3")]
+    assert spool.spool_append(job_spool, b"job 4") == 4
+    spool.close_spool(job_spool)
+
+def test_reopen_discards_torn_final_record(tmp_path):
+    job_spool = spool.open_spool(str(tmp_path))
+    spool.spool_append(job_spool, b"inteiro")
+    spool.spool_append(job_spool, b"cortado no meio")
+    spool.close_spool(job_spool)
+    segment = _segment_paths(str(tmp_path))[-1]
+    complete_size = spool.SPOOL_RECORD_HEADER_SIZE + len(b"inteiro")
+    with open(segment, 'r+b') as f:
+        f.truncate(complete_size + spool.SPOOL_RECORD_HEADER_SIZE + 3)
+
+    job_spool = spool.open_spool(str(tmp_path))
+    assert _pending_payloads(job_spool) == [(1, b"inteiro")]
+    assert os.path.getsize(segment) == complete_size
+    assert spool.spool_append(job_spool, b"depois") == 2
+    spool.close_spool(job_spool)
+
+    job_spool = spool.open_spool(str(tmp_path))
+    assert _pending_payloads(job_spool) == [(1, b"inteiro"), (2, b"depois")]
+    spool.close_spool(job_spool)
+
+def test_failed_write_leaves_no_partial_record(tmp_path):
+    job_spool = spool.open_spool(str(tmp_path))
+    assert spool.spool_append(job_spool, b"antes") == 1
+    job_spool["current_file"] = FailingFile(job_spool["current_file"])
+    assert spool.spool_append(job_spool, b"x" * 1000) is None
+
+    seq = spool.spool_append(job_spool, b"depois")
+    assert seq is not None
+    assert _pending_payloads(job_spool) == [(1, b"antes"), (seq, b"depois")]
+    spool.close_spool(job_spool)
+
+    job_spool = spool.open_spool(str(tmp_path))
+    assert _pending_payloads(job_spool) == [(1, b"antes"), (seq, b"depois")]
+    spool.close_spool(job_spool)
+
+def test_failed_first_write_of_a_segment(tmp_path, monkeypatch):
+    job_spool = spool.open_spool(str(tmp_path), segment_max_bytes=1)
+    assert spool.spool_append(job_spool, b"antes") == 1
+    real_open_new_segment = spool._open_new_segment
+
+    def open_failing_segment(job_spool):
+        real_open_new_segment(job_spool)
+        job_spool["current_file"] = FailingFile(job_spool["current_file"])
+
+    monkeypatch.setattr(spool, "_open_new_segment", open_failing_segment)
+    assert spool.spool_append(job_spool, b"perdido") is None
+    monkeypatch.undo()
+    assert spool.spool_append(job_spool, b"depois") == 2
+    spool.close_spool(job_spool)
+
+    job_spool = spool.open_spool(str(tmp_path))
+    assert _pending_payloads(job_spool) == [(1, b"antes"), (2, b"depois")]
+    spool.close_spool(job_spool)
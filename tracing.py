@@ -0,0 +1,204 @@
+import bisect
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_DUMP_INTERVAL = 300.0
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+metrics.describe("npr_job_stage_seconds", "histogram", "Tempo gasto por job em cada etapa do caminho até a impressora (com job_tracing ativo).", STAGE_BUCKETS)
+
+# Estado do rastreamento de jobs. Desativado, start_trace retorna None e as
+# demais funções retornam imediatamente.
+tracing_state = {
+    "enabled": False,
+    "sample_rate": DEFAULT_SAMPLE_RATE,
+    "dump_path": None,
+    "dump_interval": DEFAULT_DUMP_INTERVAL,
+    "dump_thread": None,
+    "dump_stop_event": None,
+    "lock": threading.Lock(),
+    "ids": itertools.count(1),
+    "stages": {},
+}
+
+
+def configure(config, dump_path=None):
+    """
+    Ativa ou desativa o rastreamento conforme as opções 'job_tracing',
+    'job_trace_sample_rate' e 'job_trace_dump_interval'.
+
+    Args:
+        config (dict): Configuração do cliente ou servidor.
+        dump_path (str, optional): Arquivo JSON onde os histogramas por etapa
+            são gravados periodicamente e no encerramento.
+    """
+    stop_dump_thread()
+    tracing_state["enabled"] = bool(config.get('job_tracing', False))
+    tracing_state["sample_rate"] = config.get('job_trace_sample_rate', DEFAULT_SAMPLE_RATE)
+    tracing_state["dump_interval"] = config.get('job_trace_dump_interval', DEFAULT_DUMP_INTERVAL)
+    tracing_state["dump_path"] = dump_path
+    with tracing_state["lock"]:
+        tracing_state["stages"] = {}
+    if tracing_state["enabled"]:
+        log.info(f"Rastreamento de jobs ativo (amostragem de {tracing_state['sample_rate']:.2%} no log).")
+        if dump_path and tracing_state["dump_interval"]:
+            start_dump_thread()
+
+def dump_thread(stop_event, interval):
+    """Thread que grava os histogramas a cada interval segundos, fora das threads que finalizam os jobs."""
+    while not stop_event.wait(interval):
+        write_histogram_dump()
+
+def start_dump_thread():
+    """Inicia a gravação periódica dos histogramas em tracing_state["dump_path"]."""
+    stop_event = threading.Event()
+    thread = threading.Thread(target=dump_thread, args=(stop_event, tracing_state["dump_interval"]),
+                              name="JobTraceDump", daemon=True)
+    tracing_state["dump_stop_event"] = stop_event
+    tracing_state["dump_thread"] = thread
+    thread.start()
+
+def stop_dump_thread():
+    """Encerra a gravação periódica dos histogramas, aguardando uma gravação em andamento."""
+    thread = tracing_state["dump_thread"]
+    if thread is None:
+        return
+    tracing_state["dump_stop_event"].set()
+    thread.join()
+    tracing_state["dump_thread"] = None
+    tracing_state["dump_stop_event"] = None
+
+def start_trace(side, started_at=None, **info):
+    """
+    Inicia o rastreamento de um job.
+
+    Args:
+        side (str): 'client' ou 'server'.
+        started_at (float, optional): Instante (time.time()) em que o job
+            começou; por padrão, agora.
+        **info: Campos que identificam o job no log de amostras (porta, seq...).
+
+    Returns:
+        dict: O rastro do job, ou None se o rastreamento está desativado.
+    """
+    if not tracing_state["enabled"]:
+        return None
+    started_at = started_at or time.time()
+    return {"id": next(tracing_state["ids"]), "side": side, "info": info,
+            "started_at": started_at, "mark": started_at, "stages": {}}
+
+def stamp(trace, stage, now=None):
+    """
+    Atribui à etapa stage o tempo decorrido desde a marca anterior do job.
+
+    Uma etapa percorrida mais de uma vez (retransmissões, registros de um job
+    grande) acumula os tempos.
+    """
+    if trace is None:
+        return
+    now = now or time.time()
+    trace["stages"][stage] = trace["stages"].get(stage, 0.0) + max(0.0, now - trace["mark"])
+    trace["mark"] = now
+
+def finish_trace(trace):
+    """Encerra o rastro de um job, somando suas etapas aos histogramas e, por amostragem, registrando-o no log."""
+    if trace is None:
+        return
+    side = trace["side"]
+    total = trace["mark"] - trace["started_at"]
+    with tracing_state["lock"]:
+        for stage, seconds in itertools.chain(trace["stages"].items(), (("total", total),)):
+            histogram = tracing_state["stages"].get((side, stage))
+            if histogram is None:
+                histogram = tracing_state["stages"][(side, stage)] = {
+                    "counts": [0] * (len(STAGE_BUCKETS) + 1), "sum": 0.0, "count": 0, "max": 0.0}
+            histogram["counts"][bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            histogram["max"] = max(histogram["max"], seconds)
+    for stage, seconds in trace["stages"].items():
+        metrics.observe("npr_job_stage_seconds", seconds, side=side, stage=stage)
+
+    if random.random() < tracing_state["sample_rate"]:
+        info = " ".join(f"{key}={value}" for key, value in trace["info"].items())
+        stages = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in trace["stages"].items())
+        log.info(f"Job #{trace['id']} ({side}) {info} total={total * 1000:.1f}ms {stages}")
+
+def _percentile(histogram, fraction):
+    """Estima um percentil por interpolação linear dentro do bucket em que ele cai."""
+    target = fraction * histogram["count"]
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(STAGE_BUCKETS, histogram["counts"]):
+        if count and cumulative + count >= target:
+            return min(lower + (bound - lower) * (target - cumulative) / count, histogram["max"])
+        cumulative += count
+        lower = bound
+    return histogram["max"]
+
+def histogram_dump():
+    """
+    Retorna os histogramas por etapa acumulados até agora.
+
+    Returns:
+        dict: {lado: {etapa: {"count", "sum", "mean", "max", "p50", "p90",
+              "p99", "buckets": [[limite, contagem acumulada], ...]}}}
+    """
+    dump = {}
+    with tracing_state["lock"]:
+        stages = {key: dict(histogram, counts=list(histogram["counts"]))
+                  for key, histogram in tracing_state["stages"].items()}
+    for (side, stage), histogram in stages.items():
+        cumulative = list(itertools.accumulate(histogram["counts"]))
+        dump.setdefault(side, {})[stage] = {
+            "count": histogram["count"],
+            "sum": histogram["sum"],
+            "mean": histogram["sum"] / histogram["count"],
+            "max": histogram["max"],
+            "p50": _percentile(histogram, 0.50),
+            "p90": _percentile(histogram, 0.90),
+            "p99": _percentile(histogram, 0.99),
+            "buckets": [[bound, count] for bound, count in zip(STAGE_BUCKETS + ("+Inf",), cumulative)],
+        }
+    return dump
+
+def write_histogram_dump(path=None):
+    """Grava histogram_dump() em JSON no arquivo path (por padrão, o configurado). Retorna True se gravou."""
+    path = path or tracing_state["dump_path"]
+    if not path:
+        return False
+    try:
+        with open(path, 'w') as f:
+            json.dump(histogram_dump(), f, indent=2)
+        return True
+    except OSError as e:
+        log.error(f"Erro ao gravar histogramas de etapas em {path}: {e}")
+        return False
+
+def log_summary():
+    """Registra no log, por etapa, contagem, média e percentis dos jobs rastreados."""
+    for side, stages in histogram_dump().items():
+        for stage, summary in stages.items():
+            log.info(f"Etapa {side}/{stage}: {summary['count']} jobs, média {summary['mean'] * 1000:.1f}ms, "
+                     f"p50 {summary['p50'] * 1000:.1f}ms, p90 {summary['p90'] * 1000:.1f}ms, "
+                     f"p99 {summary['p99'] * 1000:.1f}ms, máx {summary['max'] * 1000:.1f}ms")
+
+def shutdown():
+    """Grava os histogramas finais, registra o resumo e desativa o rastreamento."""
+    if not tracing_state["enabled"]:
+        return
+    tracing_state["enabled"] = False
+    stop_dump_thread()
+    log_summary()
+    if write_histogram_dump():
+        log.info(f"Histogramas de etapas dos jobs gravados em {tracing_state['dump_path']}.")